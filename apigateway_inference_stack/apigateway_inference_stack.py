@@ -8,6 +8,9 @@ from aws_cdk import (
     aws_ec2 as _ec2,
     aws_apigateway as _apigateway,
     aws_iam as _iam,
+    aws_s3 as _s3,
+    aws_s3_notifications as _aws_s3_notifications,
+    aws_sns as _sns,
     custom_resources as _cr,
     CfnParameter,
     CfnOutput,
@@ -21,8 +24,10 @@ from constructs import Construct
 
 class APIGWInferenceStack(Stack):
 
-    def __init__(self, scope: Construct, construct_id: str, vpc: _ec2.Vpc, **kwargs) -> None:
+    def __init__(self, scope: Construct, construct_id: str, vpc: _ec2.Vpc, bucket_name: str, comprehendcustomnotificationtopic: _sns.Topic, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
+
+        bucket = _s3.Bucket.from_bucket_name(self, "ComprehendCustomBucket", bucket_name)
         
         documentclassifierarn = CfnParameter(self, "documentclassifierarn", description="DocumentClassifierARN")
         
@@ -93,7 +98,8 @@ class APIGWInferenceStack(Stack):
                                       timeout=Duration.minutes(5),
                                       memory_size=3008,
                                      environment={
-                                         "ENDPOINT_ARN": custom_resource.get_att_string('EndpointArn')
+                                         "ENDPOINT_ARN": custom_resource.get_att_string('EndpointArn'),
+                                         "BUCKET_NAME": bucket_name
                                           }
                                       )
                                       
@@ -102,6 +108,16 @@ class APIGWInferenceStack(Stack):
             actions=["comprehend:ClassifyDocument","comprehend:DescribeEndpoint"],
             resources=["arn:aws:comprehend:"+Stack.of(self).region+":"+Stack.of(self).account+":document-classifier-endpoint/*"]
             ))
+
+        # the local model answers while the endpoint is not in service
+        invoke_comprehend_lambda.role.add_to_policy(_iam.PolicyStatement(
+            actions=["s3:GetObject"],
+            resources=[bucket.bucket_arn+"/local_model/*"]
+            ))
+        invoke_comprehend_lambda.role.add_to_policy(_iam.PolicyStatement(
+            actions=["s3:ListBucket"],
+            resources=[bucket.bucket_arn]
+            ))
         
  
      
@@ -123,6 +139,83 @@ class APIGWInferenceStack(Stack):
         CfnOutput(self, "Comprehend-CustomClassfier-InvokeAPI", 
             value=f"https://{restapi.rest_api_id}.execute-api.{restapi.env.region}.amazonaws.com/{restapi.deployment_stage.stage_name}{restapiresource.path}"
         )
+
+        # Create the data access role of the bulk classification jobs, Amazon
+        # Comprehend reads their input shards and writes their results with it
+        bulk_data_access_role = _iam.Role(self, "ComprehendBulkDataAccessRole",
+                                    assumed_by=_iam.ServicePrincipal(
+                                    "comprehend.amazonaws.com"),
+                                    description="IAM data access role for Comprehend bulk classification jobs")
+
+        bulk_data_access_role.add_to_policy(
+            _iam.PolicyStatement(
+                effect=_iam.Effect.ALLOW,
+                actions=[
+                    "s3:GetObject",
+                    "s3:ListBucket",
+                    "s3:PutObject"
+                    ],
+                    resources=[bucket.bucket_arn, bucket.bucket_arn+"/bulk_input/*", bucket.bucket_arn+"/bulk_output/*"]
+                )
+            )
+
+        # Create Bulk Classify Lambda function that shards the tickets of a
+        # bulk request uploaded to bulk_requests/, starts an asynchronous
+        # classification job on them and joins the job output in bulk_output/
+        # to the ticket ids in bulk_results/. The job is not bound by the
+        # inference units of the endpoint.
+        bulk_classify_lambda  = _lambda.Function(self, "BulkClassifyLambda",
+                                    description="Lambda function for bulk classification with Comprehend jobs",
+                                      runtime=_lambda.Runtime.PYTHON_3_8,
+                                      code=_lambda.Code.from_asset(
+                                          "./lambdas"),
+                                      handler="bulk_classify_lambda.lambda_handler",
+                                      vpc=vpc,
+                                      timeout=Duration.minutes(15),
+                                      memory_size=3008,
+                                     environment={
+                                         "MODEL_ARN": documentclassifierarn.value_as_string,
+                                         "COMPREHEND_DATA_ACCESS_ROLE_ARN": bulk_data_access_role.role_arn,
+                                         "TOPIC_ARN": comprehendcustomnotificationtopic.topic_arn
+                                          }
+                                      )
+
+        bulk_classify_lambda.role.add_to_policy(_iam.PolicyStatement(
+                    actions=[
+                    "s3:GetObject",
+                    "s3:ListBucket",
+                    "s3:PutObject",
+                    "s3:DeleteObject",
+                    "s3:AbortMultipartUpload"
+                    ],
+                    resources=[bucket.bucket_arn,bucket.bucket_arn+"/*"]
+            ))
+
+        bulk_classify_lambda.role.add_to_policy(_iam.PolicyStatement(
+            actions=["comprehend:StartDocumentClassificationJob"],
+            resources=["arn:aws:comprehend:"+Stack.of(self).region+":"+Stack.of(self).account+":document-classifier/*",
+                       "arn:aws:comprehend:"+Stack.of(self).region+":"+Stack.of(self).account+":document-classification-job/*"]
+            ))
+
+        bulk_classify_lambda.role.add_to_policy(_iam.PolicyStatement(
+            actions=["sns:Publish"],
+            resources=[comprehendcustomnotificationtopic.topic_arn]
+            ))
+
+        bulk_pass_role_policy = _iam.Policy(self, "PassBulkRoleToComprehend", statements=[_iam.PolicyStatement(
+            actions=["iam:PassRole"], resources=[bulk_data_access_role.role_arn])])
+        bulk_classify_lambda.role.attach_inline_policy(bulk_pass_role_policy)
+
+        bulk_s3_notification = _aws_s3_notifications.LambdaDestination(bulk_classify_lambda)
+
+        # assign notifications for the bulk requests and the output archives
+        # of their jobs
+        bucket.add_event_notification(_s3.EventType.OBJECT_CREATED,
+                                      bulk_s3_notification,
+                                      _s3.NotificationKeyFilter(prefix="bulk_requests/", suffix=".jsonl"))
+        bucket.add_event_notification(_s3.EventType.OBJECT_CREATED,
+                                      bulk_s3_notification,
+                                      _s3.NotificationKeyFilter(prefix="bulk_output/", suffix="output.tar.gz"))
        
       
 
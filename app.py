@@ -29,6 +29,9 @@ etlendpointcreateStack=ExtractLoadTransformEndPointCreateStack(app, "ExtractLoad
                                         file_system_id=efsStack.file_system_id,
                                         comprehendcustomnotificationtopic=snsStack.comprehendcustomnotificationtopic,
                                         env = cdk.Environment(account=os.environ["CDK_DEFAULT_ACCOUNT"], region=os.environ["CDK_DEFAULT_REGION"]))
-apigwinferenceStack = APIGWInferenceStack(app, "APIGWInferenceStack", vpc=vpcStack.vpc, env = cdk.Environment(account=os.environ["CDK_DEFAULT_ACCOUNT"], region=os.environ["CDK_DEFAULT_REGION"]))
+apigwinferenceStack = APIGWInferenceStack(app, "APIGWInferenceStack", vpc=vpcStack.vpc,
+                                        bucket_name=s3Stack.bucket_name,
+                                        comprehendcustomnotificationtopic=snsStack.comprehendcustomnotificationtopic,
+                                        env = cdk.Environment(account=os.environ["CDK_DEFAULT_ACCOUNT"], region=os.environ["CDK_DEFAULT_REGION"]))
 
 app.synth()
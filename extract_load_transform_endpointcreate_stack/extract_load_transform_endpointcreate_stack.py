@@ -70,9 +70,14 @@ class ExtractLoadTransformEndPointCreateStack(Stack):
                                       timeout=Duration.minutes(5),
                                       memory_size=3008,
                                       environment={
-                                          "TOPIC_ARN": comprehendcustomnotificationtopic.topic_arn},
+                                          "TOPIC_ARN": comprehendcustomnotificationtopic.topic_arn,
+                                          "ETL_CORPUS_CACHE": "on"},
                                       filesystem=_lambda.FileSystem.from_efs_access_point(efs_ap, "/mnt/data")
                                       )
+        # 4 GB of ephemeral storage so that most projects are decompressed to
+        # /tmp instead of EFS, the aws-cdk-lib version in use has no property
+        # for it yet
+        etl_lambda.node.default_child.add_property_override("EphemeralStorage.Size", 4096)
 
         # adding permissions to use S3 bucket, logging, EFS and SNS
 
@@ -81,6 +86,8 @@ class ExtractLoadTransformEndPointCreateStack(Stack):
                     "s3:GetObject",
                     "s3:ListBucket",
                     "s3:PutObject",
+                    "s3:DeleteObject",
+                    "s3:AbortMultipartUpload",
                     "s3:HeadObject"
                     ],
                     resources=[bucket.bucket_arn,bucket.bucket_arn+"/*"]
@@ -90,7 +97,52 @@ class ExtractLoadTransformEndPointCreateStack(Stack):
             actions=["sns:Publish"],
             resources=[comprehendcustomnotificationtopic.topic_arn]
             ))
+
+        # a run that does not finish before the timeout continues in a new
+        # invocation. A separate policy, the default policy of the role would
+        # make the function depend on its own ARN.
+        _iam.Policy(self, "ExtractDatasetLambdaContinuePolicy",
+                    roles=[etl_lambda.role],
+                    statements=[_iam.PolicyStatement(
+                        actions=["lambda:InvokeFunction"],
+                        resources=[etl_lambda.function_arn]
+                    )])
             
+        # Create the Lambda function deriving training data from the corpus
+        # cache of the ETL, invoked on demand with the settings of the new
+        # training set. It writes the training data of the ETL, on the same EFS
+        # mount it takes the lock of the bucket that the ETL runs take.
+        derive_lambda = _lambda.Function(self, "DeriveTrainingDataLambda",
+                                         description="Lambda function for deriving training data from the corpus cache",
+                                         runtime=_lambda.Runtime.PYTHON_3_8,
+                                         code=_lambda.Code.from_asset(
+                                             "./lambdas"),
+                                         handler="derive_training_data_lambda.lambda_handler",
+                                         vpc=vpc,
+                                         timeout=Duration.minutes(5),
+                                         memory_size=3008,
+                                         environment={
+                                             "BUCKET_NAME": bucket_name,
+                                             "TOPIC_ARN": comprehendcustomnotificationtopic.topic_arn},
+                                         filesystem=_lambda.FileSystem.from_efs_access_point(efs_ap, "/mnt/data")
+                                         )
+        derive_lambda.node.default_child.add_property_override("EphemeralStorage.Size", 4096)
+
+        derive_lambda.role.add_to_policy(_iam.PolicyStatement(
+                    actions=[
+                    "s3:GetObject",
+                    "s3:ListBucket",
+                    "s3:PutObject",
+                    "s3:DeleteObject"
+                    ],
+                    resources=[bucket.bucket_arn,bucket.bucket_arn+"/*"]
+            ))
+
+        derive_lambda.role.add_to_policy(_iam.PolicyStatement(
+            actions=["sns:Publish"],
+            resources=[comprehendcustomnotificationtopic.topic_arn]
+            ))
+
         s3_notification = _aws_s3_notifications.LambdaDestination(etl_lambda)
         
         # assign notification for the s3 event type (ex: MulitPart Uploads)
@@ -136,6 +188,35 @@ class ExtractLoadTransformEndPointCreateStack(Stack):
              
              
             
+        # Create Train Local Model Lambda function that trains the local
+        # model the inference function answers with while the endpoint is
+        # not in service, from the same training data
+        train_local_model_lambda = _lambda.Function(self, "TrainLocalModelLambda",
+                                                    description="Lambda function for training the local fallback model",
+                                                    runtime=_lambda.Runtime.PYTHON_3_8,
+                                                    code=_lambda.Code.from_asset(
+                                                        "./lambdas"),
+                                                    handler="train_local_model_lambda.lambda_handler",
+                                                    vpc=vpc,
+                                                    timeout=Duration.minutes(15),
+                                                    memory_size=3008,
+                                                    environment={
+                                                       "BUCKET_NAME": bucket_name})
+
+        train_local_model_lambda.role.add_to_policy(_iam.PolicyStatement(
+                    actions=[
+                    "s3:GetObject",
+                    "s3:ListBucket",
+                    "s3:PutObject"
+                    ],
+                    resources=[bucket.bucket_arn,bucket.bucket_arn+"/*"]
+            ))
+
+        comprehendcustomnotificationtopic.add_subscription(_aws_sns_subscriptions.LambdaSubscription(train_local_model_lambda,
+             filter_policy={
+             "event_type": _sns.SubscriptionFilter.string_filter(
+             allowlist=["ETL completed and prepped data uploaded to S3"])}))
+
         # Create Extract Comprehend Document Classifier Model Lambda function
         extract_comprehend_model_name_lambda  = _lambda.Function(self, "ExtractComprehendCustomModelARNLambda",
                                       description="Lambda function for  Extracting Comprehend Model ARN",
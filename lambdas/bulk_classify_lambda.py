@@ -0,0 +1,375 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import time
+import hashlib
+import tarfile
+import botocore
+import boto3
+import urllib.parse
+import logging
+import etl_output
+import metrics
+import text_normalization
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3 = boto3.resource("s3")
+comprehend = boto3.client("comprehend")
+sns = boto3.resource("sns")
+
+# Bulk classification of many tickets with an asynchronous Amazon Comprehend
+# job instead of the endpoint, which is not sized for it. A request is a JSON
+# lines object uploaded to bulk_requests/<run>.jsonl with an "id" and a
+# "text" per ticket; the results are written to bulk_results/<run>.jsonl with
+# the "id" and the "classes" or an "error" per ticket.
+REQUEST_PREFIX = "bulk_requests/"
+REQUEST_SUFFIX = ".jsonl"
+INPUT_PREFIX = "bulk_input/"
+STATE_PREFIX = "bulk_state/"
+OUTPUT_PREFIX = "bulk_output/"
+RESULT_PREFIX = "bulk_results/"
+
+# Size of the input shards in bytes. Comprehend works on the files of a job
+# in parallel, so a request is split into several.
+SHARD_BYTES = int(os.environ.get("BULK_SHARD_BYTES", 8 * 1024 * 1024))
+
+# Tickets normalized and checked at a time while the request is read
+READ_BATCH = 1000
+READ_CHUNK = 1024 * 1024
+UPLOAD_WORKERS = int(os.environ.get("BULK_UPLOAD_WORKERS", 4))
+
+
+def _lines(body, chunk_size=READ_CHUNK):
+    # the lines of a streamed object, without holding more than a chunk
+    rest = b""
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+def _batches(lines, size=READ_BATCH):
+    batch = []
+    for line in lines:
+        if line.strip():
+            batch.append(line)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _state_key(run):
+    return STATE_PREFIX + run + "/job.json"
+
+
+def _load_state(bucket, run):
+    try:
+        body = s3.meta.client.get_object(Bucket=bucket, Key=_state_key(run))["Body"].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            return None
+        raise
+    return json.loads(body)
+
+
+def _save_state(bucket, state):
+    s3.meta.client.put_object(Bucket=bucket, Key=_state_key(state["run"]),
+                              Body=json.dumps(state, indent=2, sort_keys=True).encode("utf-8"),
+                              ContentType="application/json")
+
+
+class _ShardWriter:
+    """Writes documents, one per line, to numbered shards of about
+    shard_bytes and the ticket ids of every shard, line by line, to a
+    companion object under bulk_state/. Comprehend reports results by file
+    and line, the ids join them back to the tickets."""
+
+    def __init__(self, bucket, run, executor, shard_bytes=SHARD_BYTES):
+        self.bucket = bucket
+        self.run = run
+        self.executor = executor
+        self.shard_bytes = shard_bytes
+        self.shards = []
+        self._futures = []
+        self._docs = bytearray()
+        self._ids = []
+
+    def write(self, ticket_id, text):
+        self._docs += text.encode("utf-8") + b"\n"
+        self._ids.append(ticket_id)
+        if len(self._docs) >= self.shard_bytes:
+            self._flush()
+
+    def _flush(self):
+        name = "part-%05d" % len(self.shards)
+        shard = {"file": name + ".txt",
+                 "key": INPUT_PREFIX + self.run + "/" + name + ".txt",
+                 "ids": STATE_PREFIX + self.run + "/" + name + ".ids",
+                 "documents": len(self._ids)}
+        ids = "".join(json.dumps(ticket_id) + "\n" for ticket_id in self._ids).encode("utf-8")
+        self._futures.append(self.executor.submit(self._put, shard["ids"], ids))
+        self._futures.append(self.executor.submit(self._put, shard["key"], bytes(self._docs)))
+        self.shards.append(shard)
+        self._docs = bytearray()
+        self._ids = []
+
+    def _put(self, key, body):
+        s3.meta.client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def close(self):
+        if self._ids:
+            self._flush()
+        for future in self._futures:
+            future.result()
+        return self.shards
+
+
+def _client_token(run, etag):
+    # the same request never starts two jobs, even when S3 delivers its event twice
+    return hashlib.sha256(("%s#%s" % (run, etag)).encode("utf-8")).hexdigest()
+
+
+def _write_shards(bucket, key, run):
+
+    # normalizes the tickets of a request the way the training data was and
+    # writes them to the input shards; returns the shards and the tickets
+    # that cannot be classified
+    rejected = []
+    invalid = 0
+    body = s3.meta.client.get_object(Bucket=bucket, Key=key)["Body"]
+    with ThreadPoolExecutor(UPLOAD_WORKERS, thread_name_prefix="bulk") as pool:
+        writer = _ShardWriter(bucket, run, pool, SHARD_BYTES)
+        for batch in _batches(_lines(body)):
+            tickets = []
+            for line in batch:
+                try:
+                    ticket = json.loads(line)
+                    tickets.append((ticket["id"], ticket.get("text")))
+                except (ValueError, KeyError, TypeError) as e:
+                    logger.warning("Skipping an invalid line of s3://%s/%s (%s)", bucket, key, e)
+                    invalid += 1
+            texts = text_normalization.normalize_many(
+                [text if isinstance(text, str) else None for _, text in tickets])
+            for (ticket_id, _), text in zip(tickets, texts):
+                # one document per line, normalization folds the line breaks
+                # but may be off
+                text = " ".join(text.splitlines()).strip() if text else ""
+                if not text:
+                    rejected.append({"id": ticket_id, "error": {"code": "EmptyText",
+                                                                "message": "The ticket has no text to classify"}})
+                else:
+                    writer.write(ticket_id, text)
+        shards = writer.close()
+    return shards, rejected, invalid
+
+
+def _delete_shards(bucket, state):
+    # the shards of an earlier request of the same run, the new one may have fewer
+    for shard in state.get("shards", []):
+        for shard_key in (shard["key"], shard["ids"]):
+            s3.meta.client.delete_object(Bucket=bucket, Key=shard_key)
+
+
+def _submit(bucket, key, record):
+
+    run = key[len(REQUEST_PREFIX):-len(REQUEST_SUFFIX)]
+    etag = record['s3']['object'].get('eTag', "")
+    result = {"bucket": bucket, "key": key, "run": run}
+    previous = _load_state(bucket, run)
+    if previous is not None and previous["request_etag"] == etag:
+        logger.info("s3://%s/%s was already submitted, ignoring the duplicate event", bucket, key)
+        metrics.put("Duplicates", 1, "Count", "submit")
+        return dict(result, status="DUPLICATE", job_id=previous.get("job_id"))
+    if previous is not None:
+        _delete_shards(bucket, previous)
+
+    with metrics.timer("shard"):
+        shards, rejected, invalid = _write_shards(bucket, key, run)
+    documents = sum(shard["documents"] for shard in shards)
+    metrics.put("Documents", documents, "Count", "submit")
+    metrics.put("Rejected", len(rejected) + invalid, "Count", "submit")
+    state = {"run": run, "request_key": key, "request_etag": etag, "shards": shards,
+             "documents": documents, "rejected": rejected, "invalid": invalid,
+             "model_arn": os.environ.get("MODEL_ARN"), "job_id": None, "submitted": time.time()}
+
+    if not shards:
+        # nothing to classify, the results are the rejected tickets
+        _save_state(bucket, state)
+        return dict(result, **_collect_results(bucket, state, None))
+
+    try:
+        response = comprehend.start_document_classification_job(
+            JobName=("bulk-" + run)[:256],
+            DocumentClassifierArn=state["model_arn"],
+            InputDataConfig={
+                "S3Uri": "s3://" + bucket + "/" + INPUT_PREFIX + run + "/",
+                "InputFormat": "ONE_DOC_PER_LINE"},
+            OutputDataConfig={
+                "S3Uri": "s3://" + bucket + "/" + OUTPUT_PREFIX + run + "/"},
+            DataAccessRoleArn=os.environ.get("COMPREHEND_DATA_ACCESS_ROLE_ARN"),
+            ClientRequestToken=_client_token(run, etag))
+    except Exception as e:
+        logger.error("Exception (%s)", e)
+        raise e
+    state["job_id"] = response["JobId"]
+    state["job_arn"] = response.get("JobArn")
+    _save_state(bucket, state)
+    logger.info("Started Amazon Comprehend classification job %s for %d documents in %d shards",
+                state["job_id"], documents, len(shards))
+    return dict(result, status="SUBMITTED", job_id=state["job_id"], documents=documents,
+                shards=len(shards), rejected=len(rejected), invalid=invalid)
+
+
+def _predictions(body):
+    # the prediction lines of a job output archive, streamed from S3
+    with tarfile.open(fileobj=body, mode="r|gz") as archive:
+        for member in archive:
+            if not member.isfile() or not os.path.basename(member.name).startswith("predictions"):
+                continue
+            for line in archive.extractfile(member):
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _load_ids(bucket, key):
+    body = s3.meta.client.get_object(Bucket=bucket, Key=key)["Body"]
+    return [json.loads(line) for line in _lines(body) if line]
+
+
+def _collect_results(bucket, state, output_key):
+
+    # joins the predictions of the job to the ticket ids and streams them to
+    # bulk_results/<run>.jsonl, in the order of the archive
+    shards = {shard["file"]: shard for shard in state["shards"]}
+    ids, seen = {}, {}
+    counts = {"classified": 0, "errors": 0, "missing": 0}
+    result_key = RESULT_PREFIX + state["run"] + ".jsonl"
+
+    def row(value):
+        writer.write((json.dumps(value, sort_keys=True) + "\n").encode("utf-8"))
+
+    with ThreadPoolExecutor(UPLOAD_WORKERS, thread_name_prefix="bulk") as pool:
+        writer = etl_output.MultipartWriter(s3.meta.client, bucket, result_key, pool)
+        try:
+            if output_key is not None:
+                body = s3.meta.client.get_object(Bucket=bucket, Key=output_key)["Body"]
+                for prediction in _predictions(body):
+                    name = os.path.basename(prediction.get("File", ""))
+                    if name not in shards:
+                        logger.warning("Prediction for unknown file %s", name)
+                        continue
+                    if name not in ids:
+                        ids[name] = _load_ids(bucket, shards[name]["ids"])
+                        seen[name] = bytearray(len(ids[name]))
+                    line = int(prediction.get("Line", 0))
+                    seen[name][line] = 1
+                    if "ErrorCode" in prediction:
+                        counts["errors"] += 1
+                        row({"id": ids[name][line], "error": {"code": prediction["ErrorCode"],
+                                                              "message": prediction.get("ErrorMessage", "")}})
+                    else:
+                        counts["classified"] += 1
+                        row({"id": ids[name][line],
+                             "classes": prediction.get("Classes", prediction.get("Labels", []))})
+            # tickets the job did not report on
+            for name, shard in shards.items():
+                if name not in ids:
+                    ids[name] = _load_ids(bucket, shard["ids"])
+                    seen[name] = bytearray(len(ids[name]))
+                for line, ticket_id in enumerate(ids[name]):
+                    if not seen[name][line]:
+                        counts["missing"] += 1
+                        row({"id": ticket_id, "error": {"code": "NoPrediction",
+                                                        "message": "The job returned no result for the ticket"}})
+            for rejected in state["rejected"]:
+                row(rejected)
+            written = writer.close()
+        except Exception as e:
+            logger.error("Exception (%s)", e)
+            writer.abort()
+            raise e
+
+    for name in ("classified", "errors", "missing"):
+        metrics.put(name.capitalize(), counts[name], "Count", "collect")
+    counts["rejected"] = len(state["rejected"]) + state.get("invalid", 0)
+    # the job is collected once, a repeated output event stops at this marker
+    state["collected"] = dict(counts, results=written["key"], finished=time.time())
+    _save_state(bucket, state)
+    _notify_completed(bucket, state["run"], result_key, counts)
+    return dict(status="SUCCEEDED", results=written["key"], **counts)
+
+
+def _notify_completed(bucket, run, result_key, counts):
+    topic_arn = os.environ.get("TOPIC_ARN")
+    if not topic_arn:
+        return
+    # the event_type tells subscribers apart, it does not start a training
+    sns.Topic(arn=topic_arn).publish(
+        Message='Completed Amazon Comprehend bulk classification %s: %d documents classified, %d errors, '
+                '%d missing, %d rejected. Results in s3://%s/%s' % (
+                    run, counts["classified"], counts["errors"], counts["missing"], counts["rejected"],
+                    bucket, result_key),
+        MessageAttributes={
+            'event_type': {
+                'DataType': 'String',
+                'StringValue': 'Bulk classification completed'
+            }
+        }
+    )
+
+
+def _collect(bucket, key):
+
+    # output key: bulk_output/<run>/<account>-CLN-<job id>/output/output.tar.gz
+    parts = key[len(OUTPUT_PREFIX):].split("/")
+    run = "/".join(parts[:-3])
+    result = {"bucket": bucket, "key": key, "run": run}
+    state = _load_state(bucket, run)
+    if state is None or not state.get("job_id") or not parts[-3].endswith(state["job_id"]):
+        # the output of a job that was superseded by a newer request
+        logger.info("s3://%s/%s is not the output of the current job of %s, ignoring it", bucket, key, run)
+        return dict(result, status="STALE")
+    if state.get("collected"):
+        logger.info("The results of job %s were already collected, ignoring the duplicate event", state["job_id"])
+        metrics.put("Duplicates", 1, "Count", "collect")
+        return dict(result, status="DUPLICATE", results=state["collected"]["results"])
+    with metrics.timer("collect"):
+        result.update(_collect_results(bucket, state, key))
+    logger.info("Wrote %d results of job %s to s3://%s/%s", result["classified"], state["job_id"],
+                bucket, result["results"])
+    return result
+
+
+@metrics.handler
+def lambda_handler(event, context):
+
+    logger.info("Received event: " + json.dumps(event))
+
+    results = []
+    for record in event.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+        if key.startswith(REQUEST_PREFIX) and key.endswith(REQUEST_SUFFIX):
+            results.append(_submit(bucket, key, record))
+        elif key.startswith(OUTPUT_PREFIX) and key.endswith("output.tar.gz"):
+            results.append(_collect(bucket, key))
+        else:
+            logger.info("Ignoring s3://%s/%s", bucket, key)
+
+    return {
+        'statusCode': 200,
+        'results': results
+    }
@@ -0,0 +1,149 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Calibration of the confidence thresholds of the cascade: the local model
+# answers a request when its top class scores at least the threshold of
+# that class, and escalates it to the Amazon Comprehend endpoint otherwise.
+# The thresholds are chosen on a held-out split of the training data so
+# that the local answers reach a target precision. Run as a script to
+# report the trade-off between endpoint calls saved and accuracy:
+#
+#   python lambdas/cascade_calibration.py prepped_data/*.csv --output calibration.json
+#   python lambdas/cascade_calibration.py prepped_data/*.csv --model model.bin
+
+import os
+import sys
+import csv
+import json
+import zlib
+import argparse
+import logging
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+CALIBRATION_KEY = "local_model/calibration.json"
+
+# share of the training data held out for the calibration, chosen by a hash
+# of the text so that every run holds out the same rows
+HOLDOUT_SHARE = float(os.environ.get("LOCAL_MODEL_HOLDOUT_SHARE", 0.1))
+# precision the local answers of a class must reach on the held-out split,
+# and the held-out predictions of a class needed to calibrate it; classes
+# without enough are always escalated
+TARGET_PRECISION = float(os.environ.get("CASCADE_TARGET_PRECISION", 0.95))
+MIN_SUPPORT = int(os.environ.get("CASCADE_MIN_SUPPORT", 20))
+
+TRADEOFF_THRESHOLDS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99)
+
+
+def held_out(text, share=None):
+    share = HOLDOUT_SHARE if share is None else share
+    return zlib.crc32(text.encode("utf-8")) % 10000 < share * 10000
+
+
+def evaluate(model, rows):
+    # (label, predicted class, score) of every held-out (label, text) row
+    predictions = []
+    for label, text in rows:
+        top = model.classify(text, top=1)[0]
+        predictions.append((label, top['Name'], top['Score']))
+    return predictions
+
+
+def thresholds(predictions, target_precision=None, min_support=None):
+    """The lowest score per predicted class above which the predictions of
+    the class reach target_precision on the held-out split, None for classes
+    that never do or have fewer than min_support predictions."""
+    target_precision = TARGET_PRECISION if target_precision is None else target_precision
+    min_support = MIN_SUPPORT if min_support is None else min_support
+    by_class = {}
+    for label, predicted, score in predictions:
+        by_class.setdefault(predicted, []).append((score, label == predicted))
+    result = {}
+    for name, scored in sorted(by_class.items()):
+        result[name] = None
+        if len(scored) < min_support:
+            continue
+        scored.sort(key=lambda item: -item[0])
+        correct = 0
+        for i, (score, right) in enumerate(scored):
+            correct += right
+            # the lowest score whose predictions at or above it are precise
+            # enough; ties with the next score cannot be told apart
+            if correct / (i + 1) >= target_precision and (i + 1 == len(scored) or scored[i + 1][0] < score):
+                result[name] = score
+    return result
+
+
+def _answered(predictions, threshold_of):
+    local = [(label, predicted) for label, predicted, score in predictions
+             if threshold_of(predicted) is not None and score >= threshold_of(predicted)]
+    correct = sum(label == predicted for label, predicted in local)
+    return {
+        "local_share": round(len(local) / len(predictions), 4) if predictions else 0.0,
+        "local_accuracy": round(correct / len(local), 4) if local else None,
+        "local_errors": len(local) - correct,
+        # the share of all requests the cascade gets wrong where the
+        # endpoint might have been right
+        "error_share": round((len(local) - correct) / len(predictions), 4) if predictions else 0.0,
+    }
+
+
+def tradeoff(predictions, calibrated=None, grid=TRADEOFF_THRESHOLDS):
+    """Share of the requests answered locally, i.e. endpoint calls saved,
+    and the accuracy of those answers, for every global threshold of grid
+    and for the calibrated per class thresholds."""
+    rows = [dict(_answered(predictions, lambda name: threshold), threshold=threshold) for threshold in grid]
+    report = {"held_out": len(predictions),
+              "accuracy": round(sum(l == p for l, p, _ in predictions) / len(predictions), 4) if predictions else None,
+              "thresholds": rows}
+    if calibrated is not None:
+        report["calibrated"] = _answered(predictions, calibrated.get)
+    return report
+
+
+def _csv_rows(paths):
+    def rows():
+        for path in paths:
+            with open(path, newline="", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    if len(row) >= 2:
+                        yield row[0], row[1]
+    return rows
+
+
+def main(argv=None):
+    import local_model
+
+    parser = argparse.ArgumentParser(description="Report the cost and accuracy trade-off of the cascade thresholds")
+    parser.add_argument("csv", nargs="+", help="training data CSVs (label,text) as in prepped_data/")
+    parser.add_argument("--model", help="a trained local model, trained on the CSVs without the held-out split if not given")
+    parser.add_argument("--target-precision", type=float, default=TARGET_PRECISION)
+    parser.add_argument("--min-support", type=int, default=MIN_SUPPORT)
+    parser.add_argument("--output", help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    rows = _csv_rows(args.csv)
+    if args.model:
+        with open(args.model, "rb") as f:
+            model = local_model.LocalModel.from_bytes(f.read())
+    else:
+        model = local_model.train(lambda: ((label, text) for label, text in rows() if not held_out(text)))
+    predictions = evaluate(model, ((label, text) for label, text in rows() if held_out(text)))
+    calibrated = thresholds(predictions, args.target_precision, args.min_support)
+    report = dict(tradeoff(predictions, calibrated), target_precision=args.target_precision,
+                  calibrated_thresholds=calibrated)
+
+    print("held-out rows: %d, local model accuracy: %s" % (report["held_out"], report["accuracy"]))
+    print("%-12s %12s %15s %12s" % ("threshold", "calls saved", "local accuracy", "error share"))
+    for row in report["thresholds"] + [dict(report["calibrated"], threshold="calibrated")]:
+        print("%-12s %12s %15s %12s" % (row["threshold"], row["local_share"], row["local_accuracy"], row["error_share"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,6 +6,7 @@ import boto3
 import time
 import os
 import logging
+import metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -14,6 +15,7 @@ comprehend = boto3.client("comprehend")
 sns = boto3.resource("sns")
 
 
+@metrics.handler
 def on_event(event, context):
     
     request_type = event['RequestType'].lower()
@@ -0,0 +1,296 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import csv
+import json
+import shutil
+import tempfile
+import time
+import botocore
+import boto3
+import logging
+import etl_corpus
+import etl_dedup
+import etl_manifest
+import etl_marker
+import etl_query
+import etl_sampling
+import etl_stats
+import etl_training_data
+import metrics
+import text_normalization
+from s3_range_file import S3RangeFile
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3 = boto3.resource("s3")
+sns = boto3.resource("sns")
+
+# Projects derived in parallel. The corpus files are read with ranged GETs of
+# DERIVE_RANGE_BLOCK_SIZE, so only the columns the query refers to are fetched.
+DERIVE_WORKERS = int(os.environ.get("DERIVE_WORKERS", os.cpu_count() or 1))
+DERIVE_RANGE_BLOCK_SIZE = int(os.environ.get("DERIVE_RANGE_BLOCK_SIZE", 256 * 1024))
+
+# The training data is written under the lock of the bucket that ETL runs
+# take, in ETL_MARKER_DIR on the EFS mount the functions share. A derivation
+# waits DERIVE_LOCK_WAIT seconds at most for a running ETL, polling every
+# ETL_BUCKET_LOCK_POLL seconds.
+MARKER_DIR = os.environ.get("ETL_MARKER_DIR", "/mnt/data/etl-markers")
+LOCK_WAIT = float(os.environ.get("DERIVE_LOCK_WAIT", 60))
+BUCKET_LOCK_POLL = float(os.environ.get("ETL_BUCKET_LOCK_POLL", 5))
+
+
+def _settings(event):
+    # the event overrides the ETL settings of the function environment
+    def setting(name, env, default):
+        if name in event:
+            return event[name]
+        return os.environ.get(env, default)
+
+    spec = event.get("query_spec")
+    return {
+        "query": etl_query.load_spec(json.dumps(spec) if spec is not None else os.environ.get("ETL_QUERY_SPEC")),
+        "dedup": str(setting("dedup", "ETL_DEDUP", "off")).lower(),
+        "dedup_threshold": float(setting("dedup_threshold", "ETL_DEDUP_THRESHOLD",
+                                         etl_dedup.NEAR_DUPLICATE_THRESHOLD)),
+        "cap": int(setting("sample_cap", "ETL_SAMPLE_CAP", 0)),
+        "class_caps": etl_sampling.parse_class_caps(
+            json.dumps(event["sample_class_caps"]) if "sample_class_caps" in event
+            else os.environ.get("ETL_SAMPLE_CLASS_CAPS")),
+        "floor": int(setting("sample_floor", "ETL_SAMPLE_FLOOR", 0)),
+        "seed": int(setting("sample_seed", "ETL_SAMPLE_SEED", 0)),
+    }
+
+
+def _config(settings):
+    # the configuration an ETL run with the same settings and the per_class
+    # output records in the manifest
+    return etl_training_data.config(settings["query"], settings["dedup"], "per_class", settings["dedup_threshold"],
+                                    settings["cap"], settings["class_caps"], settings["floor"], settings["seed"])
+
+
+def _load_corpus_index(bucket):
+    try:
+        body = s3.meta.client.get_object(Bucket=bucket, Key=etl_corpus.CORPUS_INDEX_KEY)['Body'].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            logger.error("No corpus cache found, run the ETL with ETL_CORPUS_CACHE=on first")
+        else:
+            logger.error("Exception (%s)", e)
+        raise e
+    index = json.loads(body)
+    if index.get("version") != etl_corpus.CORPUS_VERSION:
+        raise ValueError("Unsupported corpus index version %r" % index.get("version"))
+    return index
+
+
+def _derive_project(bucket, entry, work_dir, settings):
+
+    # write the CSVs of one project from its corpus file, like
+    # etl_lambda._extract_bug_summary does from the SQLite database
+    datasets = settings["query"]
+    class_name = entry["class_name"]
+    local_file = os.path.join(work_dir, class_name.lower() + ".csv")
+    derived = {dataset["name"]: {"local_file": os.path.join(work_dir, class_name.lower() + "." + dataset["name"] + ".csv"),
+                                 "rows": 0}
+               for dataset in datasets[1:]}
+    stats = etl_stats.TextStats()
+    try:
+        raw = S3RangeFile(s3.meta.client, bucket, entry["key"], block_size=DERIVE_RANGE_BLOCK_SIZE)
+        reader = etl_corpus.CorpusReader(raw)
+        with metrics.timer("derive", class_name):
+            writers = {}
+            try:
+                for name, d in derived.items():
+                    writers[name] = open(d["local_file"], "w")
+                derived_writers = [(csv.writer(writers[dataset["name"]]), derived[dataset["name"]])
+                                   for dataset in datasets[1:]]
+
+                def primary_rows():
+                    for index, label, text in etl_corpus.iter_rows(reader, datasets, class_name,
+                                                                   text_normalization.normalize_many):
+                        if index == 0:
+                            yield label, text
+                        else:
+                            writer, d = derived_writers[index - 1]
+                            writer.writerow((label, text))
+                            d["rows"] += 1
+
+                cap = etl_sampling.class_cap(class_name, settings["cap"], settings["class_caps"])
+                with open(local_file, "w") as f:
+                    csv_writer = csv.writer(f)
+                    if cap:
+                        rows, source_rows = etl_sampling.reservoir_sample(
+                            primary_rows(), cap, etl_sampling.class_rng(settings["seed"], class_name))
+                        count = len(rows)
+                        csv_writer.writerows(rows)
+                        for row in rows:
+                            stats.add(row[1])
+                    else:
+                        source_rows = 0
+                        for row in primary_rows():
+                            csv_writer.writerow(row)
+                            stats.add(row[1])
+                            source_rows += 1
+                        count = source_rows
+            finally:
+                for f in writers.values():
+                    f.close()
+
+    except Exception as e:
+        logger.error("Exception (%s)", e)
+        logger.error("Error deriving training data from s3://%s/%s", bucket, entry["key"])
+        raise e
+
+    metrics.put("Rows", count, "Count", "derive", class_name)
+    metrics.put("BytesRead", raw.bytes_fetched, "Bytes", "derive", class_name)
+    logger.info("Derived %d of %d rows for %s, fetched %d bytes", count, source_rows, class_name, raw.bytes_fetched)
+    for d in derived.values():
+        d["sha256"] = etl_manifest.file_sha256(d["local_file"])
+    return {
+        "class_name": class_name,
+        "local_file": local_file,
+        "rows": count,
+        "source_rows": source_rows,
+        "sha256": etl_manifest.file_sha256(local_file),
+        "derived": derived,
+        "corpus": entry["key"],
+        "stats": stats.to_dict(),
+    }
+
+
+def _upload_file(bucket, key, local_file):
+    etl_training_data.upload_file(s3, bucket, key, local_file)
+
+
+def _delete_file(bucket, key):
+    etl_training_data.delete_file(s3.meta.client, bucket, key)
+
+
+def _notify(topic_arn, changed, removed, stats):
+    # the same messages as the ETL, a changed training set starts a training
+    if not changed and not removed:
+        sns.Topic(arn=topic_arn).publish(Message='Training data derived, prepped data in S3 is unchanged')
+        return
+    sns.Topic(arn=topic_arn).publish(
+        Message='Training data derived from the corpus cache and uploaded to S3. Changed classes: ' +
+                (", ".join(changed) or "none") + '. Removed classes: ' + (", ".join(removed) or "none") +
+                '. Training data: %d documents in %d classes, %d issues' % (
+                    stats["total"]["rows"], len(stats["classes"]), len(stats["issues"])),
+        MessageAttributes={
+            'event_type': {
+                'DataType': 'String',
+                'StringValue': 'ETL completed and prepped data uploaded to S3'
+            },
+            'dataset_stats': {
+                'DataType': 'String',
+                'StringValue': json.dumps(stats, sort_keys=True)
+            }
+        }
+    )
+
+
+def derive(bucket, settings):
+    """Write the training data of settings to prepped_data/ and derived_data/
+    from the corpus cache of the latest archive.
+
+    The CSVs, the manifest and the notification are the ones an ETL run with
+    the same settings would produce, so a later ETL run of the same archive
+    finds them up to date. The caller holds the lock of the bucket.
+    """
+    index = _load_corpus_index(bucket)
+    manifest = etl_manifest.load_manifest(s3.meta.client, bucket,
+                                          etl_manifest.config_fingerprint(_config(settings)))
+    previous = manifest["members"]
+    work_dir = tempfile.mkdtemp(prefix="derive-")
+    try:
+        with ThreadPoolExecutor(DERIVE_WORKERS, thread_name_prefix="derive") as pool:
+            futures = {member_name: pool.submit(_derive_project, bucket, entry, work_dir, settings)
+                       for member_name, entry in sorted(index["members"].items())}
+            projects = {member_name: future.result() for member_name, future in futures.items()}
+
+        dedup_report = None
+        if settings["dedup"] != "off" and projects:
+            kept_stats = {}
+            with metrics.timer("dedup"):
+                dedup_report = etl_dedup.deduplicate(
+                    {project["class_name"]: project["local_file"] for project in projects.values()},
+                    near=settings["dedup"] == "near", threshold=settings["dedup_threshold"],
+                    kept_stats=lambda class_name: kept_stats.setdefault(class_name, etl_stats.TextStats()))
+            for project in projects.values():
+                project["rows"] = dedup_report[project["class_name"]]["kept"]
+                project["sha256"] = etl_manifest.file_sha256(project["local_file"])
+                if project["class_name"] in kept_stats:
+                    project["stats"] = kept_stats[project["class_name"]].to_dict()
+
+        current, changed, unchanged, uploads = {}, [], [], []
+        for member_name, project in projects.items():
+            current[member_name] = etl_training_data.manifest_entry(index["members"][member_name]["fingerprint"],
+                                                                    project, settings["floor"])
+            is_changed, changed_files, _ = etl_training_data.changes(previous.get(member_name),
+                                                                     current[member_name], project)
+            (changed if is_changed else unchanged).append(project["class_name"])
+            uploads.extend(changed_files)
+        removed = sorted(entry["class_name"] for member_name, entry in previous.items()
+                         if member_name not in current and not entry["excluded"])
+
+        outputs = etl_training_data.outputs(current)
+        with ThreadPoolExecutor(DERIVE_WORKERS, thread_name_prefix="upload") as pool:
+            for future in [pool.submit(_upload_file, bucket, key, local_file) for key, local_file in uploads]:
+                future.result()
+            for future in [pool.submit(_delete_file, bucket, key)
+                           for key in etl_training_data.stale_outputs(manifest, previous, outputs)]:
+                future.result()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    manifest["source"] = index["source"]
+    manifest["members"] = current
+    manifest["outputs"] = outputs
+    if dedup_report is not None:
+        manifest["dedup"] = dedup_report
+    manifest["distribution"] = etl_manifest.class_distribution(current)
+    etl_manifest.save_manifest(s3.meta.client, bucket, manifest)
+    stats = etl_stats.dataset_stats(manifest["source"], current)
+    etl_stats.save_stats(s3.meta.client, bucket, stats)
+    logger.info("Derived %d rows of %d classes, changed: %s, removed: %s",
+                manifest["distribution"]["total_rows"], len(current),
+                ", ".join(sorted(changed)) or "none", ", ".join(removed) or "none")
+    return {
+        "classes": {entry["class_name"]: entry["rows"] for entry in current.values() if not entry["excluded"]},
+        "distribution": manifest["distribution"],
+        "changed": sorted(changed),
+        "unchanged": sorted(unchanged),
+        "removed": removed,
+        "dedup": dedup_report,
+        "stats": etl_stats.summary(stats),
+    }
+
+
+@metrics.handler
+def lambda_handler(event, context):
+
+    # event: optional query_spec, dedup, dedup_threshold, sample_cap,
+    # sample_class_caps, sample_floor and sample_seed; the ETL_* environment
+    # variables of the same meaning are the defaults
+    logger.info("Received event: " + json.dumps(event))
+
+    bucket_name = os.environ.get("BUCKET_NAME")
+    topic_arn = os.environ.get("TOPIC_ARN")
+    settings = _settings(event)
+
+    # an ETL run of the bucket writes the same manifest and training data
+    lock = etl_marker.bucket_lock(MARKER_DIR, bucket_name)
+    started = time.monotonic()
+    if not etl_marker.wait_for(lock, lambda: time.monotonic() - started > LOCK_WAIT, BUCKET_LOCK_POLL):
+        metrics.put("BucketLocked", 1, "Count", "handler")
+        raise RuntimeError("An ETL run of s3://%s did not finish in %d seconds" % (bucket_name, LOCK_WAIT))
+    with lock:
+        results = derive(bucket_name, settings)
+        _notify(topic_arn, results["changed"], results["removed"], results["stats"])
+
+    return dict(results, event=event, status="SUCCEEDED")
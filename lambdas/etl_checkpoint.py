@@ -0,0 +1,159 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import botocore
+import logging
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Progress of an ETL run that did not finish within one invocation, one
+# object per run so that runs of other archives of the bucket keep theirs.
+# Like the manifest it lives in etl_state/, outside of the prefixes that
+# trigger functions.
+CHECKPOINT_PREFIX = "etl_state/checkpoints/"
+CHECKPOINT_VERSION = 1
+
+# Stages a project goes through. Uploaded projects are finished, the files of
+# the earlier stages are reused when they are still on the scratch space.
+DECOMPRESSED = "decompressed"
+EXTRACTED = "extracted"
+DEDUPLICATED = "deduplicated"
+UPLOADED = "uploaded"
+
+
+def run_key(bucket, key, etag=None):
+    # a run belongs to one version of the archive, a new upload starts over
+    return "s3://%s/%s#%s" % (bucket, key, etag or "")
+
+
+def checkpoint_key(run):
+    return CHECKPOINT_PREFIX + hashlib.sha256((run or "").encode("utf-8")).hexdigest()[:32] + ".json"
+
+
+def new_checkpoint(run, config_hash):
+    return {
+        "version": CHECKPOINT_VERSION,
+        "run": run,
+        "config": config_hash,
+        "run_id": uuid.uuid4().hex,
+        "invocations": 0,
+        "members": {},
+        "stages": {},
+        "changed": [],
+        "unchanged": [],
+        "dedup": None,
+        "stream": None,
+    }
+
+
+class Checkpoint:
+    """Per project progress of an ETL run, saved to S3.
+
+    done() records a finished project with its manifest entry, stage() an
+    intermediate result with the scratch files it left behind, streamed() the
+    shards a sharded run finished and the rows they hold. Saves are
+    coalesced to at most one every interval seconds, save(force=True) writes
+    unconditionally. Without a client nothing is persisted.
+    """
+
+    def __init__(self, state, client=None, bucket=None, key=None, interval=5.0):
+        self.state = state
+        self.client = client
+        self.bucket = bucket
+        self.key = key or checkpoint_key(state["run"])
+        self.interval = interval
+        self._saved_at = time.monotonic()
+        self._dirty = False
+
+    @classmethod
+    def load(cls, client, bucket, run, config_hash, key=None, interval=5.0):
+        # returns the checkpoint of the run, or a new one when there is none or
+        # it belongs to another configuration
+        key = key or checkpoint_key(run)
+        try:
+            state = json.loads(client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ("404", "NoSuchKey"):
+                raise e
+            state = None
+        if state is None or state.get("version") != CHECKPOINT_VERSION or state.get("run") != run \
+                or state.get("config") != config_hash:
+            if state is not None:
+                logger.info("Ignoring the checkpoint of %s", state.get("run"))
+            state = new_checkpoint(run, config_hash)
+        else:
+            logger.info("Resuming %s: %d projects done, %d in progress, invocation %d",
+                        run, len(state["members"]), len(state["stages"]), state["invocations"] + 1)
+        state["invocations"] += 1
+        return cls(state, client, bucket, key, interval)
+
+    @property
+    def members(self):
+        return self.state["members"]
+
+    def done(self, member_name, entry):
+        self.state["members"][member_name] = entry
+        self.state["stages"].pop(member_name, None)
+        self._changed()
+
+    def stage(self, member_name, stage, **data):
+        self.state["stages"][member_name] = dict(data, stage=stage)
+        self._changed()
+
+    def streamed(self, rows, shards):
+        # the first rows of the interleaved stream are in the finished shards
+        self.state["stream"] = {"rows": rows, "shards": shards} if shards else None
+        self._changed()
+
+    def resume(self, member_name):
+        # the intermediate result of a project, if its files are still there
+        progress = self.state["stages"].get(member_name)
+        if progress is None:
+            return None
+        files = progress.get("files", {})
+        if all(os.path.exists(path) and os.path.getsize(path) == size for path, size in files.items()):
+            return progress
+        logger.info("Scratch files of %s are gone, redoing it from the start", member_name)
+        del self.state["stages"][member_name]
+        return None
+
+    def _changed(self):
+        self._dirty = True
+        self.save()
+
+    def save(self, force=False):
+        if self.client is None or not (self._dirty or force):
+            return
+        if not force and time.monotonic() - self._saved_at < self.interval:
+            return
+        self.client.put_object(Bucket=self.bucket, Key=self.key,
+                               Body=json.dumps(self.state, sort_keys=True).encode("utf-8"),
+                               ContentType="application/json")
+        self._saved_at = time.monotonic()
+        self._dirty = False
+
+    def delete(self):
+        if self.client is not None:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key)
+
+
+class Deadline:
+    """Time left in the invocation, from the Lambda context.
+
+    expired() turns true margin_ms before the function would time out; work
+    that is already running finishes, no new work starts.
+    """
+
+    def __init__(self, context=None, margin_ms=0):
+        self._remaining = getattr(context, "get_remaining_time_in_millis", None)
+        self.margin_ms = margin_ms
+
+    def expired(self):
+        return self._remaining is not None and self._remaining() < self.margin_ms
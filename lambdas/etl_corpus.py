@@ -0,0 +1,376 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import re
+import sys
+import json
+import zlib
+import hashlib
+import logging
+from array import array
+
+import etl_query
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Issue tables of the projects are cached in a columnar file per project,
+# keyed by the fingerprint of its zip member, so that training sets can be
+# derived again without the archive. The index of the cached projects of the
+# latest archive lives next to the manifest.
+CORPUS_PREFIX = "corpus_cache/"
+CORPUS_INDEX_KEY = "etl_state/corpus.json"
+CORPUS_VERSION = 1
+
+# Layout of a corpus file: MAGIC, the column chunks of every row group, a JSON
+# footer describing them, the footer length (8 bytes, little endian) and
+# MAGIC. A chunk is a zlib compressed column of one row group, encoded as
+#   text  lengths (int32, -1 for NULL) followed by the UTF-8 values
+#   dict  text encoded dictionary followed by the uint32 codes of the rows
+#   int   a NULL flag byte per row followed by the int64 values
+#   real  a NULL flag byte per row followed by the float64 values
+# so a reader fetches and decodes just the columns it needs.
+MAGIC = b"CORPUS1\n"
+DEFAULT_ROW_GROUP_ROWS = 16384
+
+# Text columns with few distinct values per row group (type, status, ...)
+# are dictionary encoded, which also lets filters run once per value
+_DICT_MAX_SHARE = 0.25
+_INT64 = (-2 ** 63, 2 ** 63 - 1)
+
+
+def corpus_key(fingerprint):
+    # cache key of a project, from the fingerprint of its zip member
+    digest = hashlib.sha256(("%d:%s" % (CORPUS_VERSION, fingerprint)).encode("utf-8")).hexdigest()
+    return CORPUS_PREFIX + digest[:40] + ".col"
+
+
+def _little_endian(values):
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _encode_strings(values):
+    lengths = array("i")
+    blobs = []
+    for value in values:
+        if value is None:
+            lengths.append(-1)
+        else:
+            blob = value.encode("utf-8")
+            lengths.append(len(blob))
+            blobs.append(blob)
+    return _little_endian(lengths).tobytes() + b"".join(blobs)
+
+
+def _decode_strings(payload, count, offset=0):
+    lengths = _little_endian(array("i", payload[offset:offset + 4 * count]))
+    pos = offset + 4 * count
+    values = []
+    for length in lengths:
+        if length < 0:
+            values.append(None)
+        else:
+            values.append(payload[pos:pos + length].decode("utf-8"))
+            pos += length
+    return values, pos
+
+
+def _as_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return str(value)
+
+
+def _encode_column(values):
+    # returns the kind of the chunk, its payload and the dictionary size
+    types = set(type(v) for v in values if v is not None)
+    if types == {int} and all(_INT64[0] <= v <= _INT64[1] for v in values if v is not None):
+        nulls = bytes(v is None for v in values)
+        return "int", nulls + _little_endian(array("q", (v or 0 for v in values))).tobytes(), None
+    if types == {float}:
+        nulls = bytes(v is None for v in values)
+        return "real", nulls + _little_endian(array("d", (0.0 if v is None else v for v in values))).tobytes(), None
+
+    # text, and columns of mixed types in their text form
+    values = [_as_text(v) for v in values]
+    dictionary = {None: 0}
+    for value in values:
+        if value not in dictionary:
+            dictionary[value] = len(dictionary)
+            if len(dictionary) > max(1, len(values) * _DICT_MAX_SHARE):
+                return "text", _encode_strings(values), None
+    codes = _little_endian(array("I", (dictionary[v] for v in values)))
+    return "dict", _encode_strings(list(dictionary)) + codes.tobytes(), len(dictionary)
+
+
+class Column:
+    """Values of a column in one row group.
+
+    map() applies a function to every value; dictionary encoded columns apply
+    it once per distinct value.
+    """
+
+    def __init__(self, kind, values, codes=None):
+        self.kind = kind
+        self._values = values
+        self._codes = codes
+
+    def __len__(self):
+        return len(self._values if self._codes is None else self._codes)
+
+    def to_list(self):
+        if self._codes is None:
+            return self._values
+        return [self._values[c] for c in self._codes]
+
+    def map(self, function):
+        mapped = [function(v) for v in self._values]
+        if self._codes is None:
+            return mapped
+        return [mapped[c] for c in self._codes]
+
+
+def _decode_column(chunk, payload, rows):
+    kind = chunk["kind"]
+    if kind == "text":
+        return Column(kind, _decode_strings(payload, rows)[0])
+    if kind == "dict":
+        dictionary, pos = _decode_strings(payload, chunk["dictionary"])
+        return Column(kind, dictionary, _little_endian(array("I", payload[pos:pos + 4 * rows])).tolist())
+    values = _little_endian(array("q" if kind == "int" else "d", payload[rows:])).tolist()
+    for i, null in enumerate(payload[:rows]):
+        if null:
+            values[i] = None
+    return Column(kind, values)
+
+
+class CorpusWriter:
+    """Writes rows of a table to a columnar corpus file, row_group_rows at a time."""
+
+    def __init__(self, f, columns, row_group_rows=DEFAULT_ROW_GROUP_ROWS, metadata=None):
+        self.f = f
+        self.columns = list(columns)
+        self.row_group_rows = row_group_rows
+        self.metadata = metadata or {}
+        self.rows = 0
+        self._row_groups = []
+        self._pending = []
+        self.f.write(MAGIC)
+        self._offset = len(MAGIC)
+
+    def write_rows(self, rows):
+        for row in rows:
+            self._pending.append(row)
+            if len(self._pending) >= self.row_group_rows:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        chunks = {}
+        for name, values in zip(self.columns, zip(*self._pending)):
+            kind, payload, dictionary = _encode_column(values)
+            data = zlib.compress(payload, 6)
+            self.f.write(data)
+            chunks[name] = {"kind": kind, "offset": self._offset, "length": len(data)}
+            if dictionary is not None:
+                chunks[name]["dictionary"] = dictionary
+            self._offset += len(data)
+        self._row_groups.append({"rows": len(self._pending), "chunks": chunks})
+        self.rows += len(self._pending)
+        self._pending = []
+
+    def close(self):
+        self._flush()
+        footer = json.dumps({"version": CORPUS_VERSION, "columns": self.columns, "rows": self.rows,
+                             "row_groups": self._row_groups, "metadata": self.metadata},
+                            separators=(",", ":")).encode("utf-8")
+        self.f.write(footer + len(footer).to_bytes(8, "little") + MAGIC)
+        return self._offset + len(footer) + 8 + len(MAGIC)
+
+
+class CorpusReader:
+    """Reads the column chunks of a corpus file from any seekable binary file,
+    e.g. an S3RangeFile."""
+
+    def __init__(self, f):
+        self.f = f
+        f.seek(-(8 + len(MAGIC)), 2)
+        tail = f.read(8 + len(MAGIC))
+        if tail[8:] != MAGIC:
+            raise ValueError("Not a corpus file")
+        length = int.from_bytes(tail[:8], "little")
+        f.seek(-(8 + len(MAGIC) + length), 2)
+        footer = json.loads(f.read(length))
+        if footer["version"] != CORPUS_VERSION:
+            raise ValueError("Unsupported corpus version %r" % footer["version"])
+        self.columns = footer["columns"]
+        self.rows = footer["rows"]
+        self.row_groups = footer["row_groups"]
+        self.metadata = footer["metadata"]
+
+    def read_column(self, row_group, name):
+        group = self.row_groups[row_group]
+        if name not in group["chunks"]:
+            raise etl_query.QuerySpecError("Unknown column %r" % (name,))
+        chunk = group["chunks"][name]
+        self.f.seek(chunk["offset"])
+        return _decode_column(chunk, zlib.decompress(self.f.read(chunk["length"])), group["rows"])
+
+
+def write_corpus(conn, f, row_group_rows=DEFAULT_ROW_GROUP_ROWS, metadata=None, fetch_size=1000):
+    """Write the issue table of an open SQLite database to f, returns the
+    number of rows and bytes written."""
+    cursor = conn.execute("SELECT * FROM issue")
+    writer = CorpusWriter(f, [d[0] for d in cursor.description], row_group_rows, metadata)
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if not batch:
+            break
+        writer.write_rows(batch)
+    size = writer.close()
+    return writer.rows, size
+
+
+# Evaluation of the data set specs of etl_query on the columns, with the
+# semantics of the SQL they compile to: NULL never matches a comparison,
+# values are compared with the type of the column, LIKE is case insensitive
+# for ASCII letters and TRIM removes spaces.
+
+def _coerce(value, numeric):
+    # a parameter compared with a column, converted like SQLite's column affinity
+    if numeric and isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            try:
+                return float(value)
+            except ValueError:
+                return value
+    if not numeric and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def _compare(op, a, b):
+    if isinstance(a, str) != isinstance(b, str):
+        # SQLite orders every number before every text value
+        a, b = (0, 1) if isinstance(b, str) else (1, 0)
+    if op == "=":
+        return a == b
+    if op == "!=":
+        return a != b
+    if op == "<":
+        return a < b
+    if op == "<=":
+        return a <= b
+    if op == ">":
+        return a > b
+    return a >= b
+
+
+def _like(pattern):
+    regex = "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in str(pattern))
+    return re.compile(regex, re.IGNORECASE | re.ASCII | re.DOTALL)
+
+
+def _predicate(dataset, column):
+    # mask of the rows of a row group in the data set. The conditions are
+    # those of etl_query._predicate, each one a factory of a test of a column
+    # value given whether the column is numeric.
+    conditions = []
+    if dataset["issue_types"]:
+        conditions.append(("type", lambda numeric, types=dataset["issue_types"]: (
+            lambda v, types=set(_coerce(t, numeric) for t in types): v is not None and v in types)))
+    if dataset["require_all"]:
+        for name in dataset["columns"]:
+            conditions.append((name, lambda numeric: (lambda v: v is not None)))
+    for f in dataset["filters"]:
+        op = f.get("op", "=")
+        if op == "like":
+            conditions.append((f["column"], lambda numeric, regex=_like(f["value"]): (
+                lambda v: v is not None and regex.fullmatch(_as_text(v)) is not None)))
+        elif op in ("=", "!=", "<", "<=", ">", ">="):
+            conditions.append((f["column"], lambda numeric, op=op, value=f["value"]: (
+                lambda v, value=_coerce(value, numeric): v is not None and _compare(op, v, value))))
+        elif op in ("in", "not_in"):
+            conditions.append((f["column"], lambda numeric, values=f["value"], inside=op == "in": (
+                lambda v, values=set(_coerce(x, numeric) for x in values):
+                    v is not None and (v in values) == inside)))
+        elif op in ("is_null", "not_null"):
+            conditions.append((f["column"], lambda numeric, null=op == "is_null": (
+                lambda v: (v is None) == null)))
+        else:
+            raise etl_query.QuerySpecError("Unsupported filter operator %r" % (op,))
+
+    mask = None
+    for name, condition in conditions:
+        values = column(name)
+        matches = values.map(condition(values.kind in ("int", "real")))
+        mask = matches if mask is None else [a and b for a, b in zip(mask, matches)]
+    return mask
+
+
+def _label(dataset, column, project, rows):
+    label = dataset["label"]
+    if label == "project":
+        values = [project] * rows
+    elif label == "issue_type":
+        values = column("type").to_list()
+    else:
+        values = column(label["column"]).to_list()
+    if dataset["label_map"]:
+        label_map = dataset["label_map"]
+        values = [label_map.get(v, v) for v in values]
+    return values
+
+
+def _sql_text(value):
+    return value if isinstance(value, str) else _as_text(value)
+
+
+def _text(dataset, column, mask):
+    columns = [column(name).to_list() for name in dataset["columns"]]
+    if dataset["require_all"]:
+        return [" ".join(_sql_text(v) for v in values) if m else None for m, values in zip(mask, zip(*columns))]
+    return [" ".join("" if v is None else _sql_text(v) for v in values).strip(" ") if m else None
+            for m, values in zip(mask, zip(*columns))]
+
+
+def iter_rows(reader, datasets, project, normalize=None):
+    """Stream (data set index, label, text) tuples from a corpus file.
+
+    Produces the rows etl_query.iter_rows produces on the SQLite database the
+    corpus was written from. Every row group is filtered a column at a time,
+    only the columns the data sets refer to are read. normalize maps the texts
+    of a row group at once, as it does for etl_query.iter_rows.
+    """
+    for dataset in datasets:
+        etl_query._label(dataset)  # validates the label spec
+    for row_group in range(len(reader.row_groups)):
+        rows = reader.row_groups[row_group]["rows"]
+        columns = {}
+
+        def column(name):
+            if name not in columns:
+                columns[name] = reader.read_column(row_group, name)
+            return columns[name]
+
+        routed = []
+        for dataset in datasets:
+            mask = _predicate(dataset, column)
+            if mask is None:
+                mask = [True] * rows
+            texts = _text(dataset, column, mask)
+            if normalize is not None:
+                texts = normalize(texts)
+            routed.append((mask, _label(dataset, column, project, rows), texts))
+        for i in range(rows):
+            for index, (mask, labels, texts) in enumerate(routed):
+                if mask[i] and labels[i] is not None:
+                    yield index, labels[i], texts[i]
@@ -0,0 +1,269 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import re
+import csv
+import json
+import zlib
+import sqlite3
+import hashlib
+import logging
+from array import array
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# MinHash signature length and LSH banding. 16 bands of 4 rows make pairs
+# with a Jaccard similarity of 0.8 candidates with a probability > 99.9%,
+# candidates are then verified against NEAR_DUPLICATE_THRESHOLD.
+NUM_BINS = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_BINS // BANDS
+NEAR_DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+
+_TOKEN = re.compile(r"\w+")
+_HASH_VALUES_PER_BIN = 2 ** 32 // NUM_BINS
+_EMPTY_BIN = 2 ** 64 - 1
+
+
+def _normalize(text):
+    return " ".join(text.lower().split())
+
+
+def _exact_key(text):
+    return hashlib.blake2b(_normalize(text).encode("utf-8"), digest_size=16).digest()
+
+
+def minhash(text):
+    # One permutation MinHash: every word shingle is hashed once, the low bits
+    # pick a bin and each bin keeps its minimum. Empty bins are filled from the
+    # next non-empty bin (rotation densification) so short documents still get
+    # comparable signatures.
+    tokens = _TOKEN.findall(text.lower())
+    if len(tokens) < SHINGLE_SIZE:
+        shingles = [" ".join(tokens)]
+    else:
+        shingles = [" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)]
+
+    signature = array("Q", [_EMPTY_BIN]) * NUM_BINS
+    for shingle in shingles:
+        h = zlib.crc32(shingle.encode("utf-8"))
+        b = h % NUM_BINS
+        v = h // NUM_BINS
+        if v < signature[b]:
+            signature[b] = v
+
+    if _EMPTY_BIN in signature:
+        filled = [i for i in range(NUM_BINS) if signature[i] != _EMPTY_BIN]
+        if filled:
+            for i in range(NUM_BINS):
+                if signature[i] == _EMPTY_BIN:
+                    distance, source = min(((j - i) % NUM_BINS, j) for j in filled)
+                    signature[i] = signature[source] + distance * _HASH_VALUES_PER_BIN
+    return signature
+
+
+def similarity(a, b):
+    # estimated Jaccard similarity of the shingle sets behind two signatures
+    return sum(1 for x, y in zip(a, b) if x == y) / NUM_BINS
+
+
+class _MemoryIndex:
+    # documents kept so far, in dictionaries
+
+    def __init__(self):
+        self.exact = {}
+        self.bands = [{} for _ in range(BANDS)]
+        self.signatures = {}
+        self.labels = {}
+
+    def find_exact(self, key):
+        return self.exact.get(key)
+
+    def band_candidate(self, band, band_key):
+        return self.bands[band].get(band_key)
+
+    def label(self, doc_id):
+        return self.labels[doc_id]
+
+    def signature(self, doc_id):
+        return self.signatures[doc_id]
+
+    def add(self, doc_id, key, label, signature, band_keys):
+        self.exact[key] = doc_id
+        self.labels[doc_id] = label
+        if signature is not None:
+            self.signatures[doc_id] = signature
+            for band_key, index in zip(band_keys, self.bands):
+                index.setdefault(band_key, doc_id)
+
+    def close(self):
+        pass
+
+
+class _SqliteIndex:
+    # documents kept so far, in a SQLite database on local storage. Memory
+    # stays at the page cache size however many documents there are.
+
+    def __init__(self, path, cache_kb=2048):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            PRAGMA cache_size = -%d;
+            CREATE TABLE doc (id TEXT PRIMARY KEY, exact BLOB UNIQUE, label TEXT, signature BLOB) WITHOUT ROWID;
+            CREATE TABLE band (band INTEGER, key INTEGER, id TEXT, PRIMARY KEY (band, key)) WITHOUT ROWID;
+        """ % cache_kb)
+
+    def _one(self, sql, params):
+        row = self.conn.execute(sql, params).fetchone()
+        return None if row is None else row[0]
+
+    def find_exact(self, key):
+        doc_id = self._one("SELECT id FROM doc WHERE exact = ?", (key,))
+        return None if doc_id is None else tuple(json.loads(doc_id))
+
+    def band_candidate(self, band, band_key):
+        doc_id = self._one("SELECT id FROM band WHERE band = ? AND key = ?", (band, band_key))
+        return None if doc_id is None else tuple(json.loads(doc_id))
+
+    def label(self, doc_id):
+        return self._one("SELECT label FROM doc WHERE id = ?", (json.dumps(doc_id),))
+
+    def signature(self, doc_id):
+        return array("Q", self._one("SELECT signature FROM doc WHERE id = ?", (json.dumps(doc_id),)))
+
+    def add(self, doc_id, key, label, signature, band_keys):
+        encoded = json.dumps(doc_id)
+        self.conn.execute("INSERT INTO doc VALUES (?, ?, ?, ?)",
+                          (encoded, key, label, None if signature is None else signature.tobytes()))
+        if signature is not None:
+            self.conn.executemany("INSERT OR IGNORE INTO band VALUES (?, ?, ?)",
+                                  [(band, band_key, encoded) for band, band_key in enumerate(band_keys)])
+
+    def close(self):
+        self.conn.close()
+        os.remove(self.path)
+
+
+class Deduplicator:
+    """Streaming exact and near-duplicate detector over labelled documents.
+
+    Documents are offered in order with add(). The first occurrence of a
+    text is kept and later exact or near duplicates are dropped. When the
+    duplicate carries another label, the first occurrence is remembered in
+    conflicts as well, because a text labelled with two classes only
+    confuses the classifier.
+
+    The index of kept documents grows with the corpus. With index_path it is
+    kept in a SQLite database at that path instead of in memory, document
+    ids must then be tuples of JSON values. close() removes it.
+    """
+
+    def __init__(self, near=True, threshold=NEAR_DUPLICATE_THRESHOLD, index_path=None):
+        self.near = near
+        self.threshold = threshold
+        self.index = _MemoryIndex() if index_path is None else _SqliteIndex(index_path)
+        self.conflicts = set()
+
+    def add(self, doc_id, label, text):
+        # returns None when the document is kept, else the reason it is dropped
+        key = _exact_key(text)
+        original = self.index.find_exact(key)
+        signature = None
+        reason = "exact"
+        if original is None and self.near:
+            signature = minhash(text)
+            original = self._find_similar(signature)
+            reason = "near"
+
+        if original is not None:
+            if self.index.label(original) != label:
+                self.conflicts.add(original)
+                return "cross_label"
+            return reason
+
+        self.index.add(doc_id, key, label, signature,
+                       list(self._band_keys(signature)) if signature is not None else None)
+        return None
+
+    def close(self):
+        self.index.close()
+
+    def _band_keys(self, signature):
+        for start in range(0, NUM_BINS, ROWS_PER_BAND):
+            yield hash(tuple(signature[start:start + ROWS_PER_BAND]))
+
+    def _find_similar(self, signature):
+        seen = set()
+        for band, band_key in enumerate(self._band_keys(signature)):
+            candidate = self.index.band_candidate(band, band_key)
+            if candidate is None or candidate in seen:
+                continue
+            seen.add(candidate)
+            if similarity(signature, self.index.signature(candidate)) >= self.threshold:
+                return candidate
+        return None
+
+
+def deduplicate(files, near=True, threshold=NEAR_DUPLICATE_THRESHOLD, index_path=None, kept_stats=None):
+    """Remove duplicate training rows from the per class CSV files in place.
+
+    files maps class names to local CSV files with (label, text) rows. The
+    classes are visited in sorted order so the result does not depend on the
+    order the projects were extracted in. index_path keeps the index of the
+    Deduplicator on local storage. kept_stats is called with the name of
+    every class whose file is rewritten and returns an etl_stats.TextStats
+    for its kept rows. Returns the number of rows kept and removed per class.
+    """
+    deduplicator = Deduplicator(near=near, threshold=threshold, index_path=index_path)
+    dropped = {}
+    report = {}
+
+    # first pass: stream every class through the detector
+    try:
+        for class_name in sorted(files):
+            counts = {"rows": 0, "exact": 0, "near": 0, "cross_label": 0}
+            dropped[class_name] = set()
+            with open(files[class_name], newline="") as f:
+                for index, row in enumerate(csv.reader(f)):
+                    counts["rows"] += 1
+                    reason = deduplicator.add((class_name, index), row[0], row[1])
+                    if reason is not None:
+                        counts[reason] += 1
+                        dropped[class_name].add(index)
+            report[class_name] = counts
+    finally:
+        deduplicator.close()
+
+    for class_name, index in deduplicator.conflicts:
+        dropped[class_name].add(index)
+        report[class_name]["cross_label"] += 1
+
+    # second pass: rewrite the classes that lost rows
+    for class_name in sorted(files):
+        counts = report[class_name]
+        counts["removed"] = len(dropped[class_name])
+        counts["kept"] = counts["rows"] - counts["removed"]
+        if dropped[class_name]:
+            _rewrite(files[class_name], dropped[class_name], kept_stats(class_name) if kept_stats else None)
+        logger.info("Deduplicated %s: kept %d of %d rows (%d exact, %d near, %d cross-labelled duplicates)",
+                    class_name, counts["kept"], counts["rows"], counts["exact"], counts["near"],
+                    counts["cross_label"])
+    return report
+
+
+def _rewrite(path, dropped, stats=None):
+    tmp_path = path + ".dedup"
+    with open(path, newline="") as src, open(tmp_path, "w", newline="") as dst:
+        writer = csv.writer(dst)
+        for index, row in enumerate(csv.reader(src)):
+            if index not in dropped:
+                writer.writerow(row)
+                if stats is not None:
+                    stats.add(row[1])
+    os.replace(tmp_path, path)
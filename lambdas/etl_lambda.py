@@ -3,15 +3,34 @@
 
 import os
 import csv
-import sqlite3
 import zipfile
 import bz2
-import glob
+import time
 import botocore
 import boto3
 import json
+import contextlib
+import errno
+import itertools
+import collections
 import urllib.parse
 import logging
+import etl_checkpoint
+import etl_corpus
+import etl_dedup
+import etl_manifest
+import etl_marker
+import etl_output
+import etl_query
+import etl_sampling
+import etl_scratch
+import etl_stats
+import etl_training_data
+import metrics
+import text_normalization
+from s3_range_file import S3RangeFile
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 
 logger = logging.getLogger()
@@ -19,149 +38,1168 @@ logger.setLevel(logging.INFO)
 
 s3 = boto3.resource("s3")
 sns = boto3.resource("sns")
+lambda_client = boto3.client("lambda")
 
+# Memory the ETL may use in MB, e.g. 512 to run in a function of that size.
+# With a budget the buffer, cache and worker settings below default to
+# bounded values that fit in it, sampled classes are selected by position
+# instead of holding their sample, and the duplicate index is kept on the
+# scratch space. Runs that peak above the budget are logged. 0 keeps the
+# defaults sized for a 3 GB function.
+MEMORY_BUDGET_MB = int(os.environ.get("ETL_MEMORY_BUDGET_MB", 0))
 
-def _upload_file(bucket, class_name, local_file):
-    # Upload the file to S3 from EFS
-    try:
-        key = "prepped_data/" + class_name.lower() + ".csv"
-        s3.Bucket(bucket).upload_file(local_file, key)
-    except botocore.exceptions.ClientError as e:
-        logger.error("Exception (%s)", e)
-        logger.error(
-            "Error uploading object %s from bucket %s to EFS. Make sure they exist and your bucket is in the same region as this function.", key, bucket)
-        raise e
+# Interpreter, boto3 and the bz2, SQLite and upload buffers of one worker of
+# each pool, in MB, under a memory budget
+_BASE_MB = 128
+_WORKER_MB = 64
+
+
+def _bounded(default, bounded):
+    # default of a setting, or its bounded value under a memory budget
+    return bounded if MEMORY_BUDGET_MB else default
+
+
+# Size of the blocks read from the zip archive and written to the destination
+# file. Decompression never holds more than a couple of these blocks in memory.
+CHUNK_SIZE = _bounded(1024 * 1024, 256 * 1024)
+
+# Worker pool sizes of the ETL pipeline. bz2 decompression and SQLite queries
+# release the GIL, so threads scale with the vCPUs allotted to the function
+# (multiprocessing is not available in the Lambda execution environment).
+# Uploads are I/O bound and get their own pool.
+_BUDGET_WORKERS = max(1, min(os.cpu_count() or 1, (MEMORY_BUDGET_MB - _BASE_MB) // _WORKER_MB))
+DECOMPRESS_WORKERS = int(os.environ.get("ETL_DECOMPRESS_WORKERS", _bounded(os.cpu_count() or 1, _BUDGET_WORKERS)))
+EXTRACT_WORKERS = int(os.environ.get("ETL_EXTRACT_WORKERS", _bounded(os.cpu_count() or 1, _BUDGET_WORKERS)))
+UPLOAD_WORKERS = int(os.environ.get("ETL_UPLOAD_WORKERS", _bounded(8, 2)))
+
+# Multipart settings of the CSV uploads. boto3 holds up to max_concurrency
+# parts of every upload in memory.
+UPLOAD_CONFIG = _bounded(None, TransferConfig(multipart_chunksize=etl_output.MIN_PART_SIZE, max_concurrency=2))
+
+# Declarative spec of the training rows, see etl_query.DEFAULT_SPEC. The
+# primary data set goes to prepped_data/, derived data sets are extracted in
+# the same pass to derived_data/<name>/ (per_class output only).
+QUERY_SPEC = etl_query.load_spec(os.environ.get("ETL_QUERY_SPEC"))
+QUERY = etl_query.CompiledQuery(QUERY_SPEC)
+PRIMARY_QUERY = etl_query.CompiledQuery(QUERY_SPEC[:1])
+
+# The databases are opened read-only and immutable, and read through a
+# memory map of up to ETL_SQLITE_MMAP_SIZE bytes. Mapped pages count towards
+# the memory of the function, under a memory budget pages go through a page
+# cache of ETL_SQLITE_CACHE_KB instead (0 is the SQLite default of 2 MB).
+# Rows are fetched from the cursor in batches of ETL_FETCH_SIZE.
+SQLITE_MMAP_SIZE = int(os.environ.get("ETL_SQLITE_MMAP_SIZE", _bounded(256 * 1024 * 1024, 0)))
+SQLITE_CACHE_KB = int(os.environ.get("ETL_SQLITE_CACHE_KB", _bounded(0, 2048)))
+FETCH_SIZE = int(os.environ.get("ETL_FETCH_SIZE", _bounded(1000, 100)))
+
+# Optional duplicate removal before the training data is uploaded: "off",
+# "exact" (identical text after whitespace and case folding) or "near"
+# (exact plus MinHash/LSH near duplicates), see etl_dedup
+DEDUP_MODE = os.environ.get("ETL_DEDUP", "off").lower()
+DEDUP_THRESHOLD = float(os.environ.get("ETL_DEDUP_THRESHOLD", etl_dedup.NEAR_DUPLICATE_THRESHOLD))
+
+# Optional class balancing. Classes with more rows than their cap are
+# reservoir sampled down to it (ETL_SAMPLE_CLASS_CAPS overrides the cap per
+# class, e.g. {"HADOOP": 5000}), classes left with fewer rows than the floor
+# are not part of the training data. 0 disables a limit.
+SAMPLE_CAP = int(os.environ.get("ETL_SAMPLE_CAP", 0))
+SAMPLE_CLASS_CAPS = etl_sampling.parse_class_caps(os.environ.get("ETL_SAMPLE_CLASS_CAPS"))
+SAMPLE_FLOOR = int(os.environ.get("ETL_SAMPLE_FLOOR", 0))
+SAMPLE_SEED = int(os.environ.get("ETL_SAMPLE_SEED", 0))
+
+# Layout of the training data in prepped_data/: "per_class" writes one CSV
+# per project, "corpus" a single CSV and "shards" CSVs of about
+# ETL_SHARD_BYTES each. corpus and shards interleave the classes randomly and
+# stream the rows from SQLite into multipart uploads of ETL_PART_SIZE parts.
+OUTPUT_MODE = os.environ.get("ETL_OUTPUT", "per_class").lower()
+SHARD_BYTES = int(os.environ.get("ETL_SHARD_BYTES", 64 * 1024 * 1024))
+PART_SIZE = int(os.environ.get("ETL_PART_SIZE", _bounded(etl_output.DEFAULT_PART_SIZE, etl_output.MIN_PART_SIZE)))
+
+# Intermediate files (decompressed databases, CSVs) go to the first scratch
+# tier in ETL_SCRATCH_TIERS with room for them: "tmp" is the ephemeral storage
+# of the function, "efs" the shared EFS mount. bz2 does not record the
+# decompressed size, it is estimated as ETL_SQLITE_EXPANSION times the
+# compressed size. ETL_TMP_RESERVE_BYTES of /tmp are kept free.
+SCRATCH_ROOTS = {"tmp": (os.environ.get("ETL_TMP_DIR", "/tmp"), False),
+                 "efs": (os.environ.get("ETL_EFS_DIR", "/mnt/data"), True)}
+SCRATCH_TIERS = [(name.strip(),) + SCRATCH_ROOTS[name.strip()]
+                 for name in os.environ.get("ETL_SCRATCH_TIERS", "tmp,efs").split(",")]
+SQLITE_EXPANSION = float(os.environ.get("ETL_SQLITE_EXPANSION", 10))
+TMP_RESERVE_BYTES = int(os.environ.get("ETL_TMP_RESERVE_BYTES", 64 * 1024 * 1024))
+
+# A run that does not fit in one invocation stops starting new work
+# ETL_STOP_MARGIN_MS before the function times out, and continues in a new
+# asynchronous invocation with the same event, from the checkpoint saved at
+# most every ETL_CHECKPOINT_INTERVAL seconds. A run that is not done after
+# ETL_MAX_INVOCATIONS invocations fails.
+STOP_MARGIN_MS = int(os.environ.get("ETL_STOP_MARGIN_MS", 60000))
+CHECKPOINT_INTERVAL = float(os.environ.get("ETL_CHECKPOINT_INTERVAL", 5))
+MAX_INVOCATIONS = int(os.environ.get("ETL_MAX_INVOCATIONS", 20))
+# The sharded output checks the deadline whenever a shard is finished and
+# every STREAM_DEADLINE_ROWS rows written to the shards
+STREAM_DEADLINE_ROWS = 1000
+
+# Runs are keyed by bucket, key, ETag and sequencer of the uploaded archive.
+# A lock and a completion marker per run in ETL_MARKER_DIR, on the EFS mount
+# shared by all containers, make duplicate deliveries of an event return
+# right away. Markers are kept for ETL_MARKER_TTL_DAYS.
+MARKER_DIR = os.environ.get("ETL_MARKER_DIR", os.path.join(SCRATCH_ROOTS["efs"][0], "etl-markers"))
+MARKER_TTL_SECONDS = float(os.environ.get("ETL_MARKER_TTL_DAYS", 7)) * 24 * 3600
+# Runs of different archives of a bucket wait for each other on a lock of
+# the bucket in the same directory, polled every ETL_BUCKET_LOCK_POLL seconds;
+# a run still waiting at the deadline continues in a new invocation, which
+# counts against ETL_MAX_INVOCATIONS like any other.
+BUCKET_LOCK_POLL = float(os.environ.get("ETL_BUCKET_LOCK_POLL", 5))
+
+# With ETL_CORPUS_CACHE=on the issue table of every project is also written
+# to corpus_cache/ in a columnar format, keyed by the fingerprint of its zip
+# member, in row groups of ETL_CORPUS_ROW_GROUP rows. The derive function
+# builds training sets from it without the archive.
+CORPUS_CACHE = os.environ.get("ETL_CORPUS_CACHE", "off").lower() == "on"
+CORPUS_ROW_GROUP = int(os.environ.get("ETL_CORPUS_ROW_GROUP", _bounded(etl_corpus.DEFAULT_ROW_GROUP_ROWS, 2048)))
 
-    logger.info("Uploaded file: %s of size %d bytes to %s", local_file,
-                os.path.getsize(local_file), "s3://" + bucket + "/" + key)
+# Minimum size of the ranged GETs used to read the archive from S3
+RANGE_BLOCK_SIZE = int(os.environ.get("ETL_RANGE_BLOCK_SIZE", _bounded(8, 1) * 1024 * 1024))
 
 
-def _download_file(bucket, key, local_dir, local_zip_file):
-    # Download the zip file to EFS file system
+def _upload_file(bucket, key, local_file):
+    etl_training_data.upload_file(s3, bucket, key, local_file, UPLOAD_CONFIG)
+
+
+def _delete_file(bucket, key):
+    etl_training_data.delete_file(s3.meta.client, bucket, key)
+
+
+def _upload_and_release(scratch, bucket, key, local_file):
+    # Upload a scratch file and delete it right away to keep the footprint small
+    _upload_file(bucket, key, local_file)
+    scratch.release(local_file)
+
+
+def _open_archive(bucket, key, size=None):
+    # Open the zip file in place on S3, only the ranges zipfile reads are fetched
     try:
-        s3.Bucket(bucket).download_file(key, local_dir + "/" + local_zip_file)
+        raw = S3RangeFile(s3.meta.client, bucket, key, size=size, block_size=RANGE_BLOCK_SIZE)
+        return raw, zipfile.ZipFile(raw, 'r')
     except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
             logger.error("The object does not exist.")
         else:
             logger.error("Exception (%s)", e)
             logger.error(
-                "Error downloading object %s from bucket %s to EFS. Make sure they exist and your bucket is in the same region as this function.", key, bucket)
+                "Error reading object %s from bucket %s. Make sure they exist and your bucket is in the same region as this function.", key, bucket)
+        raise e
+
+
+def _bz2_chunks(src):
+    # Decompress a (possibly multi-stream) bz2 payload from src, yielding at
+    # most CHUNK_SIZE bytes at a time
+    decompressor = bz2.BZ2Decompressor()
+    pending = b""
+    while True:
+        if decompressor.eof:
+            # pbzip2 style archives concatenate several bz2 streams
+            pending = decompressor.unused_data + pending
+            if not pending:
+                pending = src.read(CHUNK_SIZE)
+            if not pending:
+                return
+            decompressor = bz2.BZ2Decompressor()
+        if decompressor.needs_input and not pending:
+            pending = src.read(CHUNK_SIZE)
+            if not pending:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        chunk = decompressor.decompress(pending, CHUNK_SIZE)
+        pending = b""
+        if chunk:
+            yield chunk
+
+
+def _stream_member(zip_ref, member, destination):
+    # Decompress a single .bz2 zip member straight into destination
+    start = time.perf_counter()
+    written = 0
+    with zip_ref.open(member) as src, open(destination, "wb") as dst:
+        for chunk in _bz2_chunks(src):
+            dst.write(chunk)
+            written += len(chunk)
+    elapsed = time.perf_counter() - start
+
+    stats = {
+        "member": member.filename,
+        "compressed_bytes": member.file_size,
+        "decompressed_bytes": written,
+        "seconds": elapsed,
+        "bytes_per_second": written / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": metrics.peak_rss_mb(),
+    }
+    logger.info("Decompressed %s: %d -> %d bytes in %.2fs (%.1f MB/s), peak RSS %.1f MB",
+                member.filename, member.file_size, written, elapsed,
+                stats["bytes_per_second"] / (1024 * 1024), stats["peak_rss_mb"])
+    return stats
+
+
+def _is_project_member(member):
+    # the zip file contains one top level <project>.sqlite3.bz2 file per project
+    return member.filename.endswith(".sqlite3.bz2") and "/" not in member.filename
+
+
+def _list_projects(bucket, key):
+
+    # read the central directory and return the archive size and, for every
+    # project member, the offset where its data ends (the next local header
+    # or the start of the central directory), its content fingerprint and the
+    # size of its bz2 payload
+    with metrics.timer("list"):
+        raw, zip_ref = _open_archive(bucket, key)
+        with zip_ref:
+            infolist = zip_ref.infolist()
+            boundaries = sorted(set(m.header_offset for m in infolist)) + [zip_ref.start_dir]
+            members = {}
+            for member in infolist:
+                if _is_project_member(member):
+                    index = boundaries.index(member.header_offset)
+                    members[member.filename] = (boundaries[index + 1],
+                                                etl_manifest.member_fingerprint(member),
+                                                member.file_size)
+    metrics.put("BytesRead", raw.bytes_fetched, "Bytes", "list")
+    metrics.put("Projects", len(members), "Count", "list")
+
+    logger.info("Read central directory of s3://%s/%s: %d project members, %d bytes fetched",
+                bucket, key, len(members), raw.bytes_fetched)
+    return raw.size, members, raw.bytes_fetched
+
+
+def _decompress_project(bucket, key, size, member_name, member_end, scratch, estimated_bytes):
+
+    # each worker opens its own handle on the archive so members are fetched
+    # in parallel, read-ahead stops at the end of the member. When a tier runs
+    # out of space the member is decompressed again on the next one.
+    full_tiers = []
+    while True:
+        db_path = scratch.allocate(member_name[:-4], estimated_bytes, skip=full_tiers)  # the member name ends with .bz2
+        try:
+            raw, zip_ref = _open_archive(bucket, key, size)
+            with zip_ref:
+                raw.limit = member_end
+                opened = raw.fetch_seconds
+                stats = _stream_member(zip_ref, zip_ref.getinfo(member_name), db_path)
+                stats["fetched_bytes"] = raw.bytes_fetched
+                stats["fetch_seconds"] = raw.fetch_seconds
+                # the ranged GETs happen while the member is decompressed
+                stats["decompress_seconds"] = stats["seconds"] - (raw.fetch_seconds - opened)
+            break
+
+        except OSError as e:
+            tier = scratch.tier_of(db_path)
+            scratch.release(db_path)
+            if e.errno != errno.ENOSPC:
+                logger.error("Exception (%s)", e)
+                logger.error("Error extracting %s from zip file s3://%s/%s", member_name, bucket, key)
+                raise e
+            logger.warning("Scratch tier %s is full, retrying %s on the next tier", tier, member_name)
+            full_tiers.append(tier)
+
+        except Exception as e:
+            scratch.release(db_path)
+            logger.error("Exception (%s)", e)
+            logger.error("Error extracting %s from zip file s3://%s/%s",
+                         member_name, bucket, key)
             raise e
-    logger.info("Downloaded zip file: %s ", local_dir + "/" + local_zip_file)
 
+    scratch.commit(db_path)
+    stats["scratch_tier"] = scratch.tier_of(db_path)
+    class_name = _class_name(member_name)
+    metrics.put("BytesRead", stats["fetched_bytes"], "Bytes", "download", class_name)
+    metrics.put("Duration", stats["fetch_seconds"] * 1000, "Milliseconds", "download", class_name)
+    metrics.put("BytesWritten", stats["decompressed_bytes"], "Bytes", "decompress", class_name)
+    metrics.put("Duration", stats["decompress_seconds"] * 1000, "Milliseconds", "decompress", class_name)
+    metrics.put("PeakMemory", stats["peak_rss_mb"], "Megabytes", "decompress")
+    return db_path, stats
 
-def _unzip_file(local_dir, local_zip_file):
 
-    # unzip the file
+def _extract_bug_summary(db_path,
+                         class_name,
+                         local_file_name,
+                         derived_files=None,
+                         stats=None):
+
+    # execute the SQLite query of the spec on the downloaded data set. Rows are
+    # streamed from the cursor, or reservoir sampled from it when the class has
+    # a cap. Rows of derived data sets are written to their own files as they
+    # stream by. The texts of the training rows are added to stats as they are
+    # written.
+    cap = etl_sampling.class_cap(class_name, SAMPLE_CAP, SAMPLE_CLASS_CAPS)
+    if derived_files is None:
+        derived_files = {dataset["name"]: local_file_name[:-len(".csv")] + "." + dataset["name"] + ".csv"
+                         for dataset in QUERY_SPEC[1:]}
+    derived = {dataset["name"]: {"local_file": derived_files[dataset["name"]], "rows": 0}
+               for dataset in QUERY_SPEC[1:]}
     try:
-        with zipfile.ZipFile(local_dir + "/" + local_zip_file, 'r') as zip_ref:
-            zip_ref.extractall(local_dir)
+        conn = etl_query.open_readonly(db_path, SQLITE_MMAP_SIZE, SQLITE_CACHE_KB)
+        with contextlib.ExitStack() as stack:
+            stack.callback(conn.close)
+            csvWriter = csv.writer(stack.enter_context(open(local_file_name, "w")))
+            derived_writers = [(csv.writer(stack.enter_context(open(d["local_file"], "w"))), d)
+                               for d in derived.values()]
+
+            def primary_rows():
+                for index, label, text in etl_query.iter_rows(conn, QUERY, class_name, FETCH_SIZE,
+                                                              text_normalization.normalize_many):
+                    if index == 0:
+                        yield label, text
+                    else:
+                        writer, d = derived_writers[index - 1]
+                        writer.writerow((label, text))
+                        d["rows"] += 1
 
-        # the zip file contains multiple .bz2 files, for each .bz2 file
-        for filepath in glob.glob(local_dir + "/*.bz2"):
-            zfile = bz2.BZ2File(filepath)  # open the file
-            data = zfile.read()  # get the decompressed data
-            newfilepath = filepath[:-4]  # the filepath ends with .bz2
-            with open(newfilepath, 'wb') as f:
-                f.write(data)  # write a uncompressed file
+            def written(rows):
+                for row in rows:
+                    if stats is not None:
+                        stats.add(row[1])
+                    yield row
+
+            if cap and MEMORY_BUDGET_MB:
+                # pick the positions of the sample up front and stream the rows
+                count_sql, count_params = PRIMARY_QUERY.count_sql(project=class_name)
+                source_rows = conn.execute(count_sql, count_params).fetchone()[0]
+                positions = etl_sampling.reservoir_positions(
+                    source_rows, cap, etl_sampling.class_rng(SAMPLE_SEED, class_name))
+                count = len(positions)
+                csvWriter.writerows(written(etl_sampling.select_positions(primary_rows(), positions)))
+            elif cap:
+                rows, source_rows = etl_sampling.reservoir_sample(
+                    primary_rows(), cap, etl_sampling.class_rng(SAMPLE_SEED, class_name))
+                count = len(rows)
+                csvWriter.writerows(written(rows))
+            else:
+                source_rows = 0
+                for row in written(primary_rows()):
+                    csvWriter.writerow(row)
+                    source_rows += 1
+                count = source_rows
+            logger.info("Fetched %d rows for %s, kept %d", source_rows, class_name, count)
 
     except Exception as e:
         logger.error("Exception (%s)", e)
-        logger.error("Error extracting zip file %s",
-                     local_dir + "/" + local_zip_file)
+        logger.error(
+            "Error extracting data from sqlite3 data file %s", db_path)
         raise e
 
-    logger.info("Unzipped file: %s", local_dir + "/" + local_zip_file)
+    return count, source_rows, derived
 
 
-def _extract_bug_summary(db_path,
-                         class_name,
-                         local_file_name,
-                         bucket):
+def _class_name(file_name):
+    # hadoop.sqlite3.bz2 and hadoop.sqlite3 both belong to class HADOOP
+    return file_name.split(".")[0].upper()
+
 
-    # execute SQLLite Query on the downloaded data set
+def _object_exists(bucket, key):
     try:
-        with sqlite3.connect(db_path) as conn:
-            with open(local_file_name, "w") as f:
-                csvWriter = csv.writer(f)
-                c = conn.cursor()
-                c.execute("SELECT (?) AS type, summary || ' ' || description FROM issue WHERE type = 'Bug' AND summary IS NOT NULL AND description IS NOT NULL",
-                          (class_name,))
-                rows = c.fetchall()
-                count = len(rows)
-                logger.info("Fetched %d rows for %s", count, class_name)
-                csvWriter.writerows(rows)
+        s3.meta.client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            return False
+        raise e
+    return True
+
+
+def _cache_corpus(scratch, bucket, db_path, corpus_key):
+
+    # write the issue table of a project to the corpus cache. The key changes
+    # with the content of the project, a cached corpus is never written again.
+    if _object_exists(bucket, corpus_key):
+        return corpus_key
+    local_file = scratch.allocate(os.path.basename(db_path) + ".col", os.path.getsize(db_path))
+    try:
+        conn = etl_query.open_readonly(db_path, SQLITE_MMAP_SIZE, SQLITE_CACHE_KB)
+        try:
+            with metrics.timer("corpus"), open(local_file, "wb") as f:
+                rows, size = etl_corpus.write_corpus(conn, f, CORPUS_ROW_GROUP, fetch_size=FETCH_SIZE,
+                                                     metadata={"class_name": _class_name(db_path.split("/")[-1])})
+        finally:
+            conn.close()
+        scratch.commit(local_file)
+        logger.info("Cached %d issues of %s in %d bytes", rows, db_path, size)
+        _upload_file(bucket, corpus_key, local_file)
+    except Exception as e:
+        logger.error("Exception (%s)", e)
+        logger.error("Error caching the corpus of sqlite3 data file %s", db_path)
+        raise e
+    finally:
+        scratch.release(local_file)
+    metrics.put("Rows", rows, "Count", "corpus")
+    return corpus_key
+
+
+def _save_corpus_index(bucket, key, members):
+    # the cached projects of the latest archive, read by the derive function
+    index = {
+        "version": etl_corpus.CORPUS_VERSION,
+        "source": "s3://" + bucket + "/" + key,
+        "members": {member_name: {"class_name": entry["class_name"], "fingerprint": entry["fingerprint"],
+                                  "key": entry["corpus"]}
+                    for member_name, entry in members.items() if entry.get("corpus")},
+    }
+    s3.meta.client.put_object(Bucket=bucket, Key=etl_corpus.CORPUS_INDEX_KEY,
+                              Body=json.dumps(index, indent=2, sort_keys=True).encode("utf-8"),
+                              ContentType="application/json")
+    logger.info("Saved the corpus index of %d projects", len(index["members"]))
+
+
+def _extract_csv(scratch, db_path, bucket=None, corpus_key=None):
+
+    # db_path  will be /tmp/etl-run-<id>/hadoop.sqlite3
+    # file_name will be hadoop.sqlite3
+    # class_name will be HADOOP
+    # output_file_name will be /tmp/etl-run-<id>/hadoop.sqlite3.csv
+    # the database is deleted once the CSV files are written and, with a
+    # corpus_key, its issue table is cached
+
+    file_name = db_path.split("/")[-1]
+    class_name = _class_name(file_name)
+    db_size = os.path.getsize(db_path)
+    output_file_name = scratch.allocate(file_name + ".csv", db_size)
+    derived_files = {dataset["name"]: scratch.allocate(file_name + "." + dataset["name"] + ".csv", 0)
+                     for dataset in QUERY_SPEC[1:]}
+
+    logger.info("Extracting training data for %s", class_name)
+    stats = etl_stats.TextStats(track_duplicates=not MEMORY_BUDGET_MB)
+    with metrics.timer("extract", class_name):
+        count, source_rows, derived = _extract_bug_summary(db_path, class_name, output_file_name, derived_files,
+                                                           stats)
+    corpus = _cache_corpus(scratch, bucket, db_path, corpus_key) if corpus_key else None
+    scratch.release(db_path)
+    metrics.put("BytesWritten", scratch.commit(output_file_name), "Bytes", "extract", class_name)
+    metrics.put("Rows", count, "Count", "extract", class_name)
+    metrics.put("SourceRows", source_rows, "Count", "extract", class_name)
+    for d in derived.values():
+        scratch.commit(d["local_file"])
+        d["sha256"] = etl_manifest.file_sha256(d["local_file"])
+    return {
+        "class_name": class_name,
+        "local_file": output_file_name,
+        "rows": count,
+        "source_rows": source_rows,
+        "sha256": etl_manifest.file_sha256(output_file_name),
+        "derived": derived,
+        "corpus": corpus,
+        "stats": stats.to_dict(),
+    }
+
 
-        _upload_file(bucket, class_name, local_file_name)
+def _etl_config():
+    return etl_training_data.config(QUERY_SPEC, DEDUP_MODE, OUTPUT_MODE, DEDUP_THRESHOLD, SAMPLE_CAP,
+                                    SAMPLE_CLASS_CAPS, SAMPLE_FLOOR, SAMPLE_SEED, SHARD_BYTES)
+
+
+def _delete_stale_outputs(bucket, manifest, previous, outputs, executor):
+    stale = etl_training_data.stale_outputs(manifest, previous, outputs)
+    for future in [executor.submit(_delete_file, bucket, key) for key in stale]:
+        future.result()
+    return stale
+
+
+def _unchanged_archive(manifest, members):
+    # the results of a run whose archive and configuration are those of the
+    # previous run according to the manifest, which leaves its training data
+    # as it is; None when there is anything to do
+    previous = manifest["members"]
+    if not manifest["outputs"] or set(previous) != set(members) or \
+            any(entry["fingerprint"] != members[member_name][1] for member_name, entry in previous.items()) or \
+            (CORPUS_CACHE and not all(entry.get("corpus") for entry in previous.values())) or \
+            not all(entry.get("stats") for entry in previous.values() if not entry["excluded"]):
+        return None
+    logger.info("Archive unchanged, keeping %d training data files", len(manifest["outputs"]))
+    return {
+        "suspended": False,
+        "classes": {entry["class_name"]: entry["rows"] for entry in previous.values() if not entry["excluded"]},
+        "distribution": manifest.get("distribution"),
+        "changed": [],
+        "unchanged": sorted(entry["class_name"] for entry in previous.values()),
+        "removed": [],
+        "dedup": manifest.get("dedup"),
+        "stats": etl_stats.summary(etl_stats.dataset_stats(manifest["source"], previous)),
+    }
+
+
+def _drain(pending, on_result):
+
+    # wait for the pending futures, on_result may submit follow up work to pending
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, name = pending.pop(future)
+                on_result(stage, name, future.result())
+
+    except Exception:
+        # stop queued work, the running tasks are awaited by the pool shutdown
+        for future in pending:
+            future.cancel()
+        raise
+
+
+def _project_files(project):
+    # scratch files of an extracted project and their sizes, for the checkpoint
+    paths = [project["local_file"]] + [d["local_file"] for d in project["derived"].values()]
+    return {path: os.path.getsize(path) for path in paths}
+
+
+def _run_pipeline(bucket, key, scratch, checkpoint=None, deadline=None):
+
+    # Pipelined per project ETL: decompression of project N+1 overlaps the
+    # SQLite extraction of project N and the S3 upload of project N-1.
+    # Every project is independent, so the CSVs are the same as the ones a
+    # single worker per stage produces.
+    #
+    # An unchanged archive (according to the manifest) rewrites nothing.
+    # Otherwise projects whose zip member is unchanged since the previous run
+    # are skipped, and CSVs whose content did not change are not uploaded
+    # again. Duplicate removal looks across all classes, so with ETL_DEDUP
+    # enabled every project of a changed archive is extracted and the uploads
+    # wait until the deduplication of all CSVs is done.
+    #
+    # Finished projects and the scratch files of unfinished ones are recorded
+    # in the checkpoint. Once the deadline expires no new work is started, the
+    # run is suspended when the running work is done and a later invocation
+    # picks it up from the checkpoint.
+    checkpoint = checkpoint or etl_checkpoint.Checkpoint(etl_checkpoint.new_checkpoint(None, None))
+    deadline = deadline or etl_checkpoint.Deadline()
+    size, members, fetched_bytes = _list_projects(bucket, key)
+    manifest = etl_manifest.load_manifest(s3.meta.client, bucket,
+                                          etl_manifest.config_fingerprint(_etl_config()))
+    previous = manifest["members"]
+    results = _unchanged_archive(manifest, members)
+    if results is not None:
+        return results
+    current = checkpoint.members
+    changed, unchanged = checkpoint.state["changed"], checkpoint.state["unchanged"]
+    dedup_report = checkpoint.state["dedup"]
+    extracted = {}
+    waiting = {}
+
+    if DEDUP_MODE == "off":
+        for member_name, (_, fingerprint, _) in members.items():
+            entry = previous.get(member_name)
+            if member_name not in current and entry is not None and entry["fingerprint"] == fingerprint \
+                    and (entry.get("corpus") or not CORPUS_CACHE) and entry.get("stats"):
+                checkpoint.done(member_name, entry)
+                unchanged.append(entry["class_name"])
+    removed = [entry["class_name"] for member_name, entry in previous.items()
+               if member_name not in members and not entry["excluded"]]
+
+    # intermediate results of an earlier invocation of this run
+    resumed = {}
+    for member_name in members:
+        if member_name not in current:
+            progress = checkpoint.resume(member_name)
+            if progress is not None:
+                for path in progress["files"]:
+                    scratch.adopt(path)
+                resumed[member_name] = progress
+    if dedup_report is not None and any(resumed.get(member_name, {}).get("stage") != etl_checkpoint.DEDUPLICATED
+                                        for member_name in members if member_name not in current):
+        # some deduplicated CSVs are gone, the rest of the run is deduplicated again
+        logger.warning("Deduplicated files of an earlier invocation are missing, deduplicating again")
+        dedup_report = checkpoint.state["dedup"] = None
+        for member_name, progress in resumed.items():
+            if progress["stage"] == etl_checkpoint.DEDUPLICATED:
+                progress["stage"] = etl_checkpoint.EXTRACTED
+                checkpoint.stage(member_name, etl_checkpoint.EXTRACTED, project=progress["project"],
+                                 files=progress["files"])
+    todo = collections.deque(member_name for member_name in members
+                             if member_name not in current and member_name not in resumed)
+
+    with ThreadPoolExecutor(DECOMPRESS_WORKERS, thread_name_prefix="decompress") as decompress_pool, \
+            ThreadPoolExecutor(EXTRACT_WORKERS, thread_name_prefix="extract") as extract_pool, \
+            ThreadPoolExecutor(UPLOAD_WORKERS, thread_name_prefix="upload") as upload_pool:
+
+        pending = {}
+        uploads = collections.Counter()
+        decompressing = 0
+
+        def upload_if_changed(member_name, project):
+            entry = waiting[member_name] = etl_training_data.manifest_entry(members[member_name][1], project,
+                                                                            SAMPLE_FLOOR)
+            if entry["excluded"]:
+                logger.info("Excluding %s from the training data, %d rows is below the floor of %d",
+                            project["class_name"], project["rows"], SAMPLE_FLOOR)
+            is_changed, changed_files, unused = etl_training_data.changes(previous.get(member_name), entry, project)
+            (changed if is_changed else unchanged).append(project["class_name"])
+            for local_file in unused:
+                scratch.release(local_file)
+            for key, local_file in changed_files:
+                future = upload_pool.submit(_upload_and_release, scratch, bucket, key, local_file)
+                pending[future] = ("upload", member_name)
+                uploads[member_name] += 1
+            if not uploads[member_name]:
+                checkpoint.done(member_name, waiting.pop(member_name))
+
+        def submit_decompress():
+            # keep the decompression workers busy without running ahead of the deadline
+            nonlocal decompressing
+            while todo and decompressing < DECOMPRESS_WORKERS and not deadline.expired():
+                member_name = todo.popleft()
+                member_end, _, compressed_bytes = members[member_name]
+                future = decompress_pool.submit(_decompress_project, bucket, key, size, member_name, member_end,
+                                                scratch, int(compressed_bytes * SQLITE_EXPANSION))
+                pending[future] = ("decompress", member_name)
+                decompressing += 1
+
+        def submit_extract(member_name, db_path):
+            if not deadline.expired():
+                corpus_key = etl_corpus.corpus_key(members[member_name][1]) if CORPUS_CACHE else None
+                future = extract_pool.submit(_extract_csv, scratch, db_path, bucket, corpus_key)
+                pending[future] = ("extract", member_name)
+
+        def on_extracted(member_name, project):
+            if DEDUP_MODE == "off":
+                upload_if_changed(member_name, project)
+            else:
+                extracted[member_name] = project
+
+        def on_result(stage, member_name, result):
+            nonlocal fetched_bytes, decompressing
+            if stage == "decompress":
+                db_path, stats = result
+                fetched_bytes += stats["fetched_bytes"]
+                decompressing -= 1
+                checkpoint.stage(member_name, etl_checkpoint.DECOMPRESSED, db_path=db_path,
+                                 files={db_path: stats["decompressed_bytes"]})
+                submit_extract(member_name, db_path)
+                submit_decompress()
+            elif stage == "extract":
+                checkpoint.stage(member_name, etl_checkpoint.EXTRACTED, project=result,
+                                 files=_project_files(result))
+                on_extracted(member_name, result)
+            elif stage == "upload":
+                uploads[member_name] -= 1
+                if not uploads[member_name]:
+                    checkpoint.done(member_name, waiting.pop(member_name))
+
+        for member_name, progress in resumed.items():
+            if progress["stage"] == etl_checkpoint.DECOMPRESSED:
+                submit_extract(member_name, progress["db_path"])
+            elif progress["stage"] == etl_checkpoint.EXTRACTED:
+                on_extracted(member_name, progress["project"])
+            else:
+                upload_if_changed(member_name, progress["project"])
+        submit_decompress()
+        _drain(pending, on_result)
+
+        if DEDUP_MODE != "off" and extracted and not deadline.expired() and \
+                all(member_name in current or member_name in extracted for member_name in members):
+            index_path = None
+            if MEMORY_BUDGET_MB:
+                index_path = scratch.allocate("dedup-index.sqlite3",
+                                              sum(os.path.getsize(p["local_file"]) for p in extracted.values()))
+            # the statistics of the rewritten CSVs are taken again
+            kept_stats = {}
+            try:
+                with metrics.timer("dedup"):
+                    dedup_report = etl_dedup.deduplicate(
+                        {project["class_name"]: project["local_file"] for project in extracted.values()},
+                        near=DEDUP_MODE == "near", threshold=DEDUP_THRESHOLD, index_path=index_path,
+                        kept_stats=lambda class_name: kept_stats.setdefault(
+                            class_name, etl_stats.TextStats(track_duplicates=not MEMORY_BUDGET_MB)))
+            finally:
+                if index_path is not None:
+                    scratch.release(index_path)
+            metrics.put("RowsRemoved", sum(c["removed"] for c in dedup_report.values()), "Count", "dedup")
+            checkpoint.state["dedup"] = dedup_report
+            for member_name, project in extracted.items():
+                project["rows"] = dedup_report[project["class_name"]]["kept"]
+                project["sha256"] = etl_manifest.file_sha256(project["local_file"])
+                if project["class_name"] in kept_stats:
+                    project["stats"] = kept_stats[project["class_name"]].to_dict()
+                checkpoint.stage(member_name, etl_checkpoint.DEDUPLICATED, project=project,
+                                 files=_project_files(project))
+            checkpoint.save(force=True)
+            for member_name, project in extracted.items():
+                upload_if_changed(member_name, project)
+            _drain(pending, on_result)
+
+        remaining = [member_name for member_name in members if member_name not in current]
+        if remaining:
+            checkpoint.save(force=True)
+            logger.warning("Suspending the ETL run before the function times out, %d of %d projects left",
+                           len(remaining), len(members))
+            return {"suspended": True, "remaining": len(remaining),
+                    "changed": sorted(set(changed)), "removed": sorted(removed)}
+
+        outputs = etl_training_data.outputs(current)
+        _delete_stale_outputs(bucket, manifest, previous, outputs, upload_pool)
+
+    manifest["source"] = "s3://" + bucket + "/" + key
+    manifest["members"] = dict(current)
+    manifest["outputs"] = outputs
+    if dedup_report is not None:
+        manifest["dedup"] = dedup_report
+    manifest["distribution"] = etl_manifest.class_distribution(current)
+    etl_manifest.save_manifest(s3.meta.client, bucket, manifest)
+    stats = etl_stats.dataset_stats(manifest["source"], current)
+    etl_stats.save_stats(s3.meta.client, bucket, stats)
+    if CORPUS_CACHE:
+        _save_corpus_index(bucket, key, current)
+    for class_name, c in sorted(manifest["distribution"]["classes"].items()):
+        logger.info("Class %s: %d of %d source rows (%.1f%%)%s", class_name, c["rows"], c["source_rows"],
+                    100 * c["share"], ", excluded" if c["excluded"] else "")
+
+    logger.info("Fetched %d of %d bytes of s3://%s/%s", fetched_bytes, size, bucket, key)
+    logger.info("Changed classes: %s, unchanged: %d, removed: %s",
+                ", ".join(sorted(set(changed))) or "none", len(set(unchanged)), ", ".join(sorted(removed)) or "none")
+    return {
+        "suspended": False,
+        "classes": {entry["class_name"]: entry["rows"] for entry in current.values() if not entry["excluded"]},
+        "distribution": manifest["distribution"],
+        "changed": sorted(set(changed)),
+        "unchanged": sorted(set(unchanged)),
+        "removed": sorted(removed),
+        "dedup": dedup_report,
+        "stats": etl_stats.summary(stats),
+    }
+
+
+def _project_rows(db_path, class_name, cache_kb=0):
+
+    # open a cursor over the training rows of a project, reservoir sampled
+    # when the class has a cap. Returns the connection, the number of rows in
+    # the project and the rows.
+    conn = etl_query.open_readonly(db_path, SQLITE_MMAP_SIZE, cache_kb)
+    try:
+        count_sql, count_params = PRIMARY_QUERY.count_sql(project=class_name)
+        count = conn.execute(count_sql, count_params).fetchone()[0]
+        rows = ((label, text) for _, label, text in etl_query.iter_rows(conn, PRIMARY_QUERY, class_name, FETCH_SIZE,
+                                                                        text_normalization.normalize_many))
+        cap = etl_sampling.class_cap(class_name, SAMPLE_CAP, SAMPLE_CLASS_CAPS)
+        if cap and count > cap and MEMORY_BUDGET_MB:
+            positions = etl_sampling.reservoir_positions(count, cap, etl_sampling.class_rng(SAMPLE_SEED, class_name))
+            rows = etl_sampling.select_positions(rows, positions)
+        elif cap and count > cap:
+            rows, _ = etl_sampling.reservoir_sample(rows, cap, etl_sampling.class_rng(SAMPLE_SEED, class_name))
+        return conn, count, rows
 
     except Exception as e:
+        conn.close()
         logger.error("Exception (%s)", e)
         logger.error(
             "Error extracting data from sqlite3 data file %s", db_path)
         raise e
 
-    logger.info("Training data has been created in S3 bucket for %s", class_name)
 
+def _run_sharded(bucket, key, scratch, checkpoint=None, deadline=None):
 
-def _extract_csv(bucket,
-                 local_dir):
+    # Corpus and shard output: all projects are decompressed in parallel, then
+    # their rows are randomly interleaved straight from the SQLite cursors into
+    # multipart uploads whose parts are uploaded in parallel. No CSV is written
+    # to local storage. Any change in the archive rewrites every shard, an
+    # unchanged archive (according to the manifest) rewrites nothing.
+    #
+    # Duplicates are removed in a single streaming pass: the first occurrence
+    # of a text has already been uploaded when a duplicate with another label
+    # shows up, so only the later, cross-labelled copy is dropped.
+    #
+    # Decompressed databases are recorded in the checkpoint, and so are the
+    # finished shards with the number of streamed rows they hold. When the
+    # deadline expires the run is suspended; the next invocation streams the
+    # rows of the finished shards again without writing them, which restores
+    # the duplicate index and the statistics, and continues with the next
+    # shard. The single corpus object is streamed again from the start.
+    checkpoint = checkpoint or etl_checkpoint.Checkpoint(etl_checkpoint.new_checkpoint(None, None))
+    deadline = deadline or etl_checkpoint.Deadline()
+    size, members, fetched_bytes = _list_projects(bucket, key)
+    manifest = etl_manifest.load_manifest(s3.meta.client, bucket,
+                                          etl_manifest.config_fingerprint(_etl_config()))
+    previous = manifest["members"]
+    changed = sorted(_class_name(member_name) for member_name, (_, fingerprint, _) in members.items()
+                     if previous.get(member_name, {}).get("fingerprint") != fingerprint)
+    removed = sorted(entry["class_name"] for member_name, entry in previous.items()
+                     if member_name not in members and not entry["excluded"])
 
-    # for all sqlite3 files
-    for db_path in glob.glob(local_dir + "/*.sqlite3"):
+    results = _unchanged_archive(manifest, members)
+    if results is not None:
+        return results
 
-        # db_path  will be /mnt/data/hadoop.sqlite3
-        # file_name will be hadoop.sqlite3
-        # class_name will be HADOOP
-        # output_file_name will be /mnt/data/hadoop.csv
+    if len(QUERY_SPEC) > 1:
+        logger.warning("Derived data sets are only extracted with the per_class output, skipping %s",
+                       ", ".join(dataset["name"] for dataset in QUERY_SPEC[1:]))
 
-        file_name = db_path.split("/")[-1]
-        class_name = file_name.split(".")[0].upper()
-        output_file_name = local_dir + "/" + file_name + ".csv"
+    current = {}
+    db_paths = {}
+    corpus_keys = {}
+    connections = []
+    dedup_report = None
+    with ThreadPoolExecutor(DECOMPRESS_WORKERS, thread_name_prefix="decompress") as decompress_pool, \
+            ThreadPoolExecutor(UPLOAD_WORKERS, thread_name_prefix="upload") as upload_pool:
 
-        logger.info("Extracting training data for %s", class_name)
-        _extract_bug_summary(db_path,
-                             class_name,
-                             output_file_name,
-                             bucket)
+        def submit_decompress():
+            while todo and len(pending) < DECOMPRESS_WORKERS and not deadline.expired():
+                member_name = todo.popleft()
+                member_end, _, compressed_bytes = members[member_name]
+                future = decompress_pool.submit(_decompress_project, bucket, key, size, member_name, member_end,
+                                                scratch, int(compressed_bytes * SQLITE_EXPANSION))
+                pending[future] = ("decompress", member_name)
 
+        def submit_corpus(member_name):
+            if CORPUS_CACHE:
+                future = decompress_pool.submit(_cache_corpus, scratch, bucket, db_paths[member_name],
+                                                etl_corpus.corpus_key(members[member_name][1]))
+                pending[future] = ("corpus", member_name)
 
-def _notify_etl_completed(topic_arn):
+        def on_result(stage, member_name, result):
+            nonlocal fetched_bytes
+            if stage == "corpus":
+                corpus_keys[member_name] = result
+                submit_decompress()
+                return
+            db_paths[member_name], stats = result
+            fetched_bytes += stats["fetched_bytes"]
+            checkpoint.stage(member_name, etl_checkpoint.DECOMPRESSED, db_path=db_paths[member_name],
+                             files={db_paths[member_name]: stats["decompressed_bytes"]})
+            submit_corpus(member_name)
+            submit_decompress()
 
-    sns.Topic(arn=topic_arn).publish(
-        Message='ETL completed and prepped data uploaded to S3',
-        MessageAttributes = {
+        pending = {}
+        todo = collections.deque()
+        for member_name in members:
+            progress = checkpoint.resume(member_name)
+            if progress is not None and scratch.adopt(progress["db_path"]):
+                db_paths[member_name] = progress["db_path"]
+                submit_corpus(member_name)
+            else:
+                todo.append(member_name)
+        submit_decompress()
+        _drain(pending, on_result)
+
+        if todo:
+            checkpoint.save(force=True)
+            logger.warning("Suspending the ETL run before the function times out, %d of %d projects left",
+                           len(todo), len(members))
+            return {"suspended": True, "remaining": len(todo), "changed": changed, "removed": removed}
+
+        # the shards are named after the archive content and configuration they
+        # are made of, a failed run deletes its own and never touches those of
+        # the previous run, which stay the training data until it succeeds
+        dataset = etl_manifest.config_fingerprint({"config": manifest["config"], "members": {
+            member_name: fingerprint for member_name, (_, fingerprint, _) in members.items()}})[:12]
+        stream = checkpoint.state.get("stream") or {"rows": 0, "shards": []}
+        writer = etl_output.ShardedCsvWriter(s3.meta.client, bucket, "prepped_data/", upload_pool,
+                                             SHARD_BYTES if OUTPUT_MODE == "shards" else 0, dataset,
+                                             shards=stream["shards"], part_size=PART_SIZE,
+                                             max_in_flight=UPLOAD_WORKERS)
+        if stream["rows"]:
+            logger.info("Resuming the stream after %d shards of %d rows", len(stream["shards"]), stream["rows"])
+        # every project is read at the same time, they share the page cache budget
+        cache_kb = SQLITE_CACHE_KB and max(64, SQLITE_CACHE_KB // max(1, len(db_paths)))
+        index_path = None
+        deduplicator = None
+        suspended = False
+        try:
+            sources = []
+            for member_name in sorted(db_paths):
+                class_name = _class_name(member_name)
+                conn, count, rows = _project_rows(db_paths[member_name], class_name, cache_kb)
+                connections.append(conn)
+                cap = etl_sampling.class_cap(class_name, SAMPLE_CAP, SAMPLE_CLASS_CAPS)
+                kept = min(count, cap) if cap else count
+                excluded = kept < SAMPLE_FLOOR
+                current[member_name] = {
+                    "fingerprint": members[member_name][1],
+                    "class_name": class_name,
+                    "rows": 0,
+                    "source_rows": count,
+                    "excluded": excluded,
+                    "csv_sha256": None,
+                    "corpus": corpus_keys.get(member_name),
+                    "stats": None,
+                }
+                if not excluded:
+                    sources.append((kept, zip(itertools.repeat(member_name), rows)))
+
+            if DEDUP_MODE != "off":
+                if MEMORY_BUDGET_MB:
+                    index_path = scratch.allocate("dedup-index.sqlite3", sum(map(os.path.getsize, db_paths.values())))
+                deduplicator = etl_dedup.Deduplicator(near=DEDUP_MODE == "near", threshold=DEDUP_THRESHOLD,
+                                                      index_path=index_path)
+                dedup_report = {current[m]["class_name"]: {"rows": 0, "exact": 0, "near": 0, "cross_label": 0}
+                                for m in current if not current[m]["excluded"]}
+
+            class_stats = {member_name: etl_stats.TextStats(track_duplicates=not MEMORY_BUDGET_MB)
+                           for member_name, entry in current.items() if not entry["excluded"]}
+            with metrics.timer("stream"):
+                streamed = 0
+                for member_name, row in etl_output.interleave(sources, etl_sampling.class_rng(SAMPLE_SEED, "*")):
+                    streamed += 1
+                    entry = current[member_name]
+                    if deduplicator is not None:
+                        counts = dedup_report[entry["class_name"]]
+                        counts["rows"] += 1
+                        reason = deduplicator.add((member_name, counts["rows"]), row[0], row[1])
+                        if reason is not None:
+                            counts[reason] += 1
+                            continue
+                    class_stats[member_name].add(row[1])
+                    entry["rows"] += 1
+                    if streamed <= stream["rows"]:
+                        # in a shard of an earlier invocation
+                        continue
+                    finished = len(writer.shards)
+                    writer.writerow(row)
+                    if len(writer.shards) > finished:
+                        checkpoint.streamed(streamed, list(writer.shards))
+                    if (len(writer.shards) > finished or not streamed % STREAM_DEADLINE_ROWS) and \
+                            deadline.expired():
+                        suspended = True
+                        break
+                if suspended:
+                    # the rows of the unfinished shard are streamed again
+                    writer.suspend()
+                    checkpoint.save(force=True)
+                    logger.warning("Suspending the ETL run before the function times out, %d shards written",
+                                   len(writer.shards))
+                    return {"suspended": True, "remaining": len(db_paths), "changed": changed, "removed": removed}
+                shards = writer.close()
+            for member_name, entry in current.items():
+                metrics.put("Rows", entry["rows"], "Count", "stream", entry["class_name"])
+                if member_name in class_stats:
+                    entry["stats"] = class_stats[member_name].to_dict()
+            metrics.put("BytesWritten", sum(shard["bytes"] for shard in shards), "Bytes", "upload")
+            metrics.put("Files", len(shards), "Count", "upload")
+
+        except Exception:
+            # a rerun of the same data set rewrote the shards of the previous
+            # run with the same rows, they stay
+            writer.abort(keep=set(manifest["outputs"]))
+            checkpoint.streamed(0, [])
+            checkpoint.save(force=True)
+            raise
+
+        finally:
+            for conn in connections:
+                conn.close()
+            if not suspended:
+                for db_path in db_paths.values():
+                    scratch.release(db_path)
+            if deduplicator is not None:
+                deduplicator.close()
+            if index_path is not None:
+                scratch.release(index_path)
+
+        if dedup_report is not None:
+            for entry in current.values():
+                if not entry["excluded"]:
+                    counts = dedup_report[entry["class_name"]]
+                    counts["kept"] = entry["rows"]
+                    counts["removed"] = counts["rows"] - counts["kept"]
+        outputs = sorted(shard["key"] for shard in shards)
+        _delete_stale_outputs(bucket, manifest, previous, outputs, upload_pool)
+
+    manifest["source"] = "s3://" + bucket + "/" + key
+    manifest["members"] = current
+    manifest["outputs"] = outputs
+    manifest["shards"] = shards
+    if dedup_report is not None:
+        manifest["dedup"] = dedup_report
+    manifest["distribution"] = etl_manifest.class_distribution(current)
+    etl_manifest.save_manifest(s3.meta.client, bucket, manifest)
+    stats = etl_stats.dataset_stats(manifest["source"], current)
+    etl_stats.save_stats(s3.meta.client, bucket, stats)
+    if CORPUS_CACHE:
+        _save_corpus_index(bucket, key, current)
+
+    logger.info("Fetched %d of %d bytes of s3://%s/%s", fetched_bytes, size, bucket, key)
+    logger.info("Wrote %d rows in %d training data files, changed classes: %s, removed: %s",
+                manifest["distribution"]["total_rows"], len(shards),
+                ", ".join(changed) or "none", ", ".join(removed) or "none")
+    return {
+        "suspended": False,
+        "classes": {entry["class_name"]: entry["rows"] for entry in current.values() if not entry["excluded"]},
+        "distribution": manifest["distribution"],
+        "changed": changed,
+        "unchanged": sorted(entry["class_name"] for entry in current.values()
+                            if entry["class_name"] not in changed),
+        "removed": removed,
+        "dedup": dedup_report,
+        "stats": etl_stats.summary(stats),
+    }
+
+
+def _notify_etl_completed(topic_arn, changed, removed, stats=None):
+
+    # stats, the summary of the training data statistics, goes along in the
+    # dataset_stats attribute for the training function to check
+    if not changed and not removed:
+        # without the event_type attribute the message does not start a training
+        sns.Topic(arn=topic_arn).publish(
+            Message='ETL completed, prepped data in S3 is unchanged'
+        )
+        logger.info("Notification complete, training data unchanged")
+        return
+
+    message_attributes = {
         'event_type': {
             'DataType': 'String',
             'StringValue': 'ETL completed and prepped data uploaded to S3'
             }
-        
         }
+    message = 'ETL completed and prepped data uploaded to S3. Changed classes: ' + \
+              (", ".join(changed) or "none") + '. Removed classes: ' + (", ".join(removed) or "none")
+    if stats is not None:
+        message_attributes['dataset_stats'] = {
+            'DataType': 'String',
+            'StringValue': json.dumps(stats, sort_keys=True)
+        }
+        message += '. Training data: %d documents in %d classes, %d issues' % (
+            stats["total"]["rows"], len(stats["classes"]), len(stats["issues"]))
+    sns.Topic(arn=topic_arn).publish(
+        Message=message,
+        MessageAttributes=message_attributes
     )
     logger.info("Notification complete")
 
 
+def _continue_run(records, context):
+    # invoke the function again with the records that are not done yet, the
+    # runs resume from their checkpoints
+    try:
+        lambda_client.invoke(FunctionName=context.invoked_function_arn, InvocationType="Event",
+                             Payload=json.dumps({"Records": records}).encode("utf-8"))
+    except botocore.exceptions.ClientError as e:
+        logger.error("Exception (%s)", e)
+        logger.error("Error invoking %s to continue the ETL run", context.invoked_function_arn)
+        raise e
+    logger.info("Continuing %d ETL runs in a new invocation of %s", len(records), context.invoked_function_arn)
+
+
+def _sequencer(record):
+    # sequencers of the same key compare as strings right padded with zeros
+    return record['s3']['object'].get('sequencer', "").ljust(32, "0")
+
+
+def _latest_records(event):
+
+    # one record per object: S3 may deliver an event more than once, and a
+    # newer upload of the same key supersedes an older one in the same event
+    latest = {}
+    for record in event.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+        if (bucket, key) not in latest or _sequencer(record) > _sequencer(latest[(bucket, key)]):
+            latest[(bucket, key)] = record
+    return latest
+
+
+def _run_record(bucket, key, record, context, topic_arn):
+
+    # ETL run of one uploaded archive, at most one container works on it at a time
+    obj = record['s3']['object']
+    marker = etl_marker.RunMarker(MARKER_DIR, "s3://%s/%s#%s#%s" % (bucket, key, obj.get('eTag', ""),
+                                                                    obj.get('sequencer', "")))
+    result = {"bucket": bucket, "key": key}
+    done = marker.done()
+    if done is not None:
+        logger.info("s3://%s/%s was already processed, ignoring the duplicate event", bucket, key)
+        metrics.put("Duplicates", 1, "Count", "handler")
+        return dict(result, status="DUPLICATE", changed_classes=done["changed_classes"])
+    if not marker.acquire():
+        logger.info("s3://%s/%s is being processed by another invocation, ignoring the event", bucket, key)
+        metrics.put("Duplicates", 1, "Count", "handler")
+        return dict(result, status="DUPLICATE")
+
+    with marker:
+        done = marker.done()
+        if done is not None:
+            return dict(result, status="DUPLICATE", changed_classes=done["changed_classes"])
+
+        # the checkpoint belongs to the run, it is counted also by the
+        # invocations that only wait for the bucket
+        checkpoint = etl_checkpoint.Checkpoint.load(s3.meta.client, bucket,
+                                                    etl_checkpoint.run_key(bucket, key, obj.get('eTag')),
+                                                    etl_manifest.config_fingerprint(_etl_config()),
+                                                    interval=CHECKPOINT_INTERVAL)
+        if checkpoint.state["invocations"] > MAX_INVOCATIONS:
+            raise RuntimeError("ETL run of s3://%s/%s did not finish in %d invocations" %
+                               (bucket, key, MAX_INVOCATIONS))
+        checkpoint.save(force=True)
+
+        # runs of other archives of the bucket share its manifest and training
+        # data, one of them works on it at a time
+        deadline = etl_checkpoint.Deadline(context, STOP_MARGIN_MS)
+        bucket_lock = etl_marker.bucket_lock(MARKER_DIR, bucket)
+        if not etl_marker.wait_for(bucket_lock, deadline.expired, BUCKET_LOCK_POLL):
+            logger.info("Another run holds s3://%s, continuing in a new invocation", bucket)
+            metrics.put("BucketLocked", 1, "Count", "handler")
+            return dict(result, status="IN_PROGRESS", remaining_projects=None)
+
+        with bucket_lock:
+            with etl_scratch.ScratchSpace(SCRATCH_TIERS, run_id=checkpoint.state["run_id"],
+                                          reserve_bytes=TMP_RESERVE_BYTES) as scratch:
+                if OUTPUT_MODE == "per_class":
+                    results = _run_pipeline(bucket, key, scratch, checkpoint, deadline)
+                else:
+                    results = _run_sharded(bucket, key, scratch, checkpoint, deadline)
+                if results["suspended"]:
+                    scratch.keep()
+            result["scratch"] = scratch.report()
+
+            if results["suspended"]:
+                metrics.put("Suspended", 1, "Count", "handler")
+                return dict(result, status="IN_PROGRESS", remaining_projects=results["remaining"])
+
+            metrics.put("ChangedClasses", len(results["changed"]), "Count", "handler")
+            metrics.put("RemovedClasses", len(results["removed"]), "Count", "handler")
+            _notify_etl_completed(topic_arn, results["changed"], results["removed"], results["stats"])
+            checkpoint.delete()
+            result.update(status="SUCCEEDED", changed_classes=results["changed"],
+                          removed_classes=results["removed"], dedup=results["dedup"])
+            marker.mark_done(result)
+    return result
+
+
+def _run_bucket(runs, context, topic_arn):
+    # the runs of a bucket share its manifest and training data, one after
+    # the other; after a suspended run the rest waits for the continuation
+    results = []
+    for bucket, key, record in runs:
+        if results and results[-1]["status"] == "IN_PROGRESS":
+            results.append({"bucket": bucket, "key": key, "status": "IN_PROGRESS", "record": record})
+            continue
+        results.append(dict(_run_record(bucket, key, record, context, topic_arn), record=record))
+    return results
+
+
+@metrics.handler
 def lambda_handler(event, context):
 
     logger.info("Received event: " + json.dumps(event))
 
-    # find the bucket and key from the event object
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = urllib.parse.unquote_plus(
-        event['Records'][0]['s3']['object']['key'], encoding='utf-8')
     topic_arn = os.environ.get("TOPIC_ARN")
+    by_bucket = {}
+    for (bucket, key), record in sorted(_latest_records(event).items()):
+        by_bucket.setdefault(bucket, []).append((bucket, key, record))
+
+    # buckets are independent and processed concurrently
+    with ThreadPoolExecutor(max(1, len(by_bucket)), thread_name_prefix="bucket") as pool:
+        futures = [pool.submit(_run_bucket, runs, context, topic_arn) for runs in by_bucket.values()]
+        results = [result for future in futures for result in future.result()]
+    etl_marker.prune(MARKER_DIR, MARKER_TTL_SECONDS)
 
-    local_dir = "/mnt/data"
-    local_zip_file = "raw_data.zip"
+    peak_rss_mb = metrics.peak_rss_mb()
+    if MEMORY_BUDGET_MB and peak_rss_mb > MEMORY_BUDGET_MB:
+        logger.warning("Peak RSS of %.1f MB exceeded the memory budget of %d MB", peak_rss_mb, MEMORY_BUDGET_MB)
+        metrics.put("MemoryBudgetExceeded", 1, "Count", "handler")
 
-    _download_file(bucket, key, local_dir, local_zip_file)
-    _unzip_file(local_dir, local_zip_file)
-    _extract_csv(bucket, local_dir)
-    _notify_etl_completed(topic_arn)
+    unfinished = [result.pop("record") for result in results if result["status"] == "IN_PROGRESS"]
+    for result in results:
+        result.pop("record", None)
+    if unfinished and context is not None:
+        _continue_run(unfinished, context)
 
     logger.info("Completed the event trigger.")
 
     return {
         "event": event,
-        "status": "SUCCEEDED",
+        "status": "IN_PROGRESS" if unfinished else "SUCCEEDED",
+        "runs": results,
     }
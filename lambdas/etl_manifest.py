@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import hashlib
+import botocore
+import logging
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# The manifest lives outside of raw_data/ (which triggers the ETL) and
+# prepped_data/ (which Comprehend reads as training data)
+MANIFEST_KEY = "etl_state/manifest.json"
+MANIFEST_VERSION = 2
+
+
+def member_fingerprint(member):
+    # zip keeps a CRC-32 and the sizes of every member in the central
+    # directory, which identifies its content without fetching it
+    return "%08x:%d:%d" % (member.CRC, member.file_size, member.compress_size)
+
+
+def config_fingerprint(config):
+    # hash of the settings that shape the generated CSVs, a change of any of
+    # them invalidates every project in the manifest
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def class_distribution(members):
+    # summary of the training data, per class and in total
+    classes = {}
+    for entry in members.values():
+        classes[entry["class_name"]] = {
+            "source_rows": entry["source_rows"],
+            "rows": 0 if entry["excluded"] else entry["rows"],
+            "excluded": entry["excluded"],
+        }
+    total = sum(c["rows"] for c in classes.values())
+    for c in classes.values():
+        c["share"] = round(c["rows"] / total, 6) if total else 0.0
+    return {"total_rows": total, "classes": classes}
+
+
+def empty_manifest(config_hash, outputs=None):
+    return {"version": MANIFEST_VERSION, "config": config_hash, "members": {}, "outputs": outputs or []}
+
+
+def read_manifest(client, bucket, key=MANIFEST_KEY):
+    # returns the stored manifest as it is, None when there is none yet
+    try:
+        body = client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            logger.info("No ETL manifest found at s3://%s/%s", bucket, key)
+            return None
+        raise e
+    return json.loads(body)
+
+
+def load_manifest(client, bucket, config_hash, key=MANIFEST_KEY):
+    # returns the stored manifest, or an empty one when there is none yet or
+    # it was written for a different configuration. The objects written by
+    # the previous run are always kept in outputs, so that they can be
+    # cleaned up when the new run does not produce them again.
+    manifest = read_manifest(client, bucket, key)
+    if manifest is None:
+        return empty_manifest(config_hash)
+    if manifest.get("version") != MANIFEST_VERSION or manifest.get("config") != config_hash:
+        logger.info("ETL configuration changed, ignoring manifest s3://%s/%s", bucket, key)
+        return empty_manifest(config_hash, manifest.get("outputs"))
+    manifest.setdefault("outputs", [])
+    return manifest
+
+
+def save_manifest(client, bucket, manifest, key=MANIFEST_KEY):
+    client.put_object(Bucket=bucket, Key=key,
+                      Body=json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"),
+                      ContentType="application/json")
+    logger.info("Saved ETL manifest to s3://%s/%s", bucket, key)
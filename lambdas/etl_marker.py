@@ -0,0 +1,113 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import time
+import errno
+import fcntl
+import hashlib
+import logging
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+class RunMarker:
+    """Lock and completion marker of an ETL run on a shared file system.
+
+    The directory is on the EFS mount that every container of the function
+    shares. acquire() takes a POSIX lock on <run>.lock without waiting; EFS
+    releases it when the holder goes away, also when its container is frozen
+    or killed at the timeout. A finished run leaves <run>.done behind, so that
+    duplicate deliveries of its event are recognized without any other work.
+    """
+
+    def __init__(self, directory, run):
+        self.directory = directory
+        self.run = run
+        name = hashlib.sha256(run.encode("utf-8")).hexdigest()[:32]
+        self.lock_path = os.path.join(directory, name + ".lock")
+        self.done_path = os.path.join(directory, name + ".done")
+        self._fd = None
+
+    def done(self):
+        # the result of the finished run, or None
+        try:
+            with open(self.done_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def acquire(self):
+        # True when this invocation holds the run, False when another one does
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            os.close(fd)
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                return False
+            raise e
+        self._fd = fd
+        return True
+
+    def mark_done(self, result):
+        tmp_path = self.done_path + ".%d" % os.getpid()
+        with open(tmp_path, "w") as f:
+            json.dump(dict(result, run=self.run, finished=time.time()), f)
+        os.replace(tmp_path, self.done_path)
+
+    def release(self):
+        if self._fd is None:
+            return
+        if os.path.exists(self.done_path):
+            # later deliveries stop at the done marker
+            try:
+                os.remove(self.lock_path)
+            except FileNotFoundError:
+                pass
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def bucket_lock(directory, bucket):
+    # the lock of the training data of a bucket, its manifest, prepped_data/
+    # and derived_data/; every function that writes them holds it
+    return RunMarker(directory, "s3://%s" % bucket)
+
+
+def wait_for(lock, expired, poll):
+    # acquire the lock, polling every poll seconds until expired() is true
+    while not lock.acquire():
+        if expired():
+            return False
+        time.sleep(poll)
+    return True
+
+
+def prune(directory, max_age_seconds):
+    # remove the done markers of runs that finished long ago
+    now = time.time()
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    for entry in entries:
+        if entry.name.endswith(".done") and now - entry.stat().st_mtime > max_age_seconds:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
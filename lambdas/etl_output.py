@@ -0,0 +1,189 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import csv
+import hashlib
+import logging
+import threading
+from concurrent.futures import wait
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# S3 multipart uploads need parts of at least 5 MiB, except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class MultipartWriter:
+    """Streams bytes to an S3 object with a multipart upload.
+
+    Parts are uploaded on executor as soon as part_size bytes are buffered,
+    at most max_in_flight of them at a time; write() blocks while that many
+    are in flight, which bounds the memory to (max_in_flight + 1) parts.
+    Objects smaller than one part are written with a single put_object.
+    """
+
+    def __init__(self, client, bucket, key, executor, part_size=DEFAULT_PART_SIZE, max_in_flight=4):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.executor = executor
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._sha256 = hashlib.sha256()
+        self._upload_id = None
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+
+    def write(self, data):
+        self._buffer += data
+        self._sha256.update(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _submit_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self._futures) + 1
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(self._upload_part, part_number, body)
+        except Exception:
+            self._slots.release()
+            raise
+        self._futures.append(future)
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                               PartNumber=part_number, Body=body)
+            return {"PartNumber": part_number, "ETag": response['ETag']}
+        finally:
+            self._slots.release()
+
+    def close(self):
+        # complete the upload, returns a description of the written object
+        try:
+            if self._upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                parts = [future.result() for future in self._futures]
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                                      MultipartUpload={"Parts": parts})
+        except Exception:
+            self.abort()
+            raise
+        self._buffer = bytearray()
+        logger.info("Uploaded s3://%s/%s, %d bytes in %d parts", self.bucket, self.key,
+                    self.bytes_written, max(1, len(self._futures)))
+        return {"key": self.key, "bytes": self.bytes_written, "sha256": self._sha256.hexdigest()}
+
+    def abort(self):
+        if self._upload_id is not None:
+            for future in self._futures:
+                future.cancel()
+            # parts that are already uploading would be stored after the abort
+            wait(self._futures)
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            self._upload_id = None
+
+
+class ShardedCsvWriter:
+    """Writes CSV rows to numbered S3 objects of about shard_bytes each.
+
+    A new shard is started once the current one reaches shard_bytes, 0 puts
+    every row in a single object. name, if given, goes into the keys so that
+    the shards of different data sets never overwrite each other. close()
+    returns the written shards, abort() deletes them. suspend() drops the
+    unfinished shard only; a writer given the finished ones as shards
+    continues with the next.
+    """
+
+    def __init__(self, client, bucket, prefix, executor, shard_bytes=0, name=None, shards=(), **writer_options):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.executor = executor
+        self.shard_bytes = shard_bytes
+        self.name = name
+        self.writer_options = writer_options
+        self.shards = list(shards)
+        self._current = None
+        self._line = io.StringIO()
+        self._csv = csv.writer(self._line)
+
+    def _shard_key(self, index):
+        tag = "-" + self.name if self.name else ""
+        if not self.shard_bytes:
+            return self.prefix + "corpus%s.csv" % tag
+        return self.prefix + "part%s-%05d.csv" % (tag, index)
+
+    def writerow(self, row):
+        if self._current is None:
+            self._current = MultipartWriter(self.client, self.bucket, self._shard_key(len(self.shards)),
+                                            self.executor, **self.writer_options)
+        self._line.seek(0)
+        self._line.truncate()
+        self._csv.writerow(row)
+        self._current.write(self._line.getvalue().encode("utf-8"))
+        if self.shard_bytes and self._current.bytes_written >= self.shard_bytes:
+            self.shards.append(self._current.close())
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self.shards.append(self._current.close())
+            self._current = None
+        return self.shards
+
+    def suspend(self):
+        # the finished shards stay for a later writer
+        if self._current is not None:
+            self._current.abort()
+            self._current = None
+        return self.shards
+
+    def abort(self, keep=()):
+        # deletes the shards written so far, but those in keep
+        if self._current is not None:
+            self._current.abort()
+            self._current = None
+        for shard in self.shards:
+            if shard["key"] not in keep:
+                self.client.delete_object(Bucket=self.bucket, Key=shard["key"])
+        self.shards = []
+
+
+def interleave(sources, rng):
+    """Randomly merge row iterators, keeping the order within each source.
+
+    sources is a list of (count, rows) pairs. Each step draws the next row
+    from a source with probability proportional to the rows it has left,
+    which yields a uniformly random interleaving of the sources.
+    """
+    iterators = [iter(rows) for _, rows in sources]
+    remaining = [count for count, _ in sources]
+    total = sum(remaining)
+    while total:
+        pick = rng.randrange(total)
+        for i, left in enumerate(remaining):
+            if pick < left:
+                break
+            pick -= left
+        row = next(iterators[i], None)
+        if row is None:
+            # the source ended early, forget about its remaining rows
+            total -= remaining[i]
+            remaining[i] = 0
+            continue
+        remaining[i] -= 1
+        total -= 1
+        yield row
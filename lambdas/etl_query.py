@@ -0,0 +1,200 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import re
+import json
+import sqlite3
+import urllib.parse
+
+
+# The spec of the training data set. The default reproduces the original
+# query: Bug reports labelled with their project, summary and description
+# joined with a space. "derived" lists further data sets that are extracted
+# in the same pass over the issue table, for example
+#   {"name": "improvement", "issue_types": ["Improvement"]}
+# A data set has these fields, all but name optional:
+#   issue_types   values of issue.type to extract
+#   columns       text columns, joined with a space
+#   require_all   skip rows where one of the columns is NULL (default true)
+#   filters       [{"column": ..., "op": ..., "value": ...}], all must match
+#   label         "project", "issue_type" or {"column": <name>}
+#   label_map     renames labels, a label mapped to null drops the row
+DEFAULT_SPEC = {
+    "name": "bug",
+    "issue_types": ["Bug"],
+    "columns": ["summary", "description"],
+    "require_all": True,
+    "filters": [],
+    "label": "project",
+    "label_map": {},
+    "derived": [],
+}
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_COMPARISONS = {"=": "=", "!=": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">=", "like": "LIKE"}
+
+
+class QuerySpecError(ValueError):
+    pass
+
+
+def _column(name):
+    if not isinstance(name, str) or not _IDENTIFIER.match(name):
+        raise QuerySpecError("Invalid column name %r" % (name,))
+    return '"%s"' % name
+
+
+def load_spec(value=None):
+    """Parse a JSON query spec, returns the data sets with the primary one first."""
+    spec = dict(DEFAULT_SPEC, **(json.loads(value) if value else {}))
+    datasets = [spec] + [dict(DEFAULT_SPEC, **derived) for derived in spec.get("derived", [])]
+    names = set()
+    for dataset in datasets:
+        dataset.pop("derived", None)
+        if not dataset.get("name") or not _IDENTIFIER.match(dataset["name"]) or dataset["name"] in names:
+            raise QuerySpecError("Every data set needs a unique name, got %r" % (dataset.get("name"),))
+        names.add(dataset["name"])
+        if not dataset["columns"]:
+            raise QuerySpecError("Data set %s has no columns" % dataset["name"])
+        # compile once to validate the spec early
+        _predicate(dataset)
+        _label(dataset)
+    return datasets
+
+
+def _predicate(dataset):
+    # SQL condition selecting the rows of a data set, and its parameters
+    clauses, params = [], []
+    if dataset["issue_types"]:
+        clauses.append('"type" IN (%s)' % ", ".join("?" * len(dataset["issue_types"])))
+        params += dataset["issue_types"]
+    if dataset["require_all"]:
+        clauses += ["%s IS NOT NULL" % _column(c) for c in dataset["columns"]]
+    for f in dataset["filters"]:
+        column, op = _column(f.get("column")), f.get("op", "=")
+        if op in _COMPARISONS:
+            clauses.append("%s %s ?" % (column, _COMPARISONS[op]))
+            params.append(f["value"])
+        elif op in ("in", "not_in"):
+            clauses.append("%s %s (%s)" % (column, "IN" if op == "in" else "NOT IN", ", ".join("?" * len(f["value"]))))
+            params += f["value"]
+        elif op in ("is_null", "not_null"):
+            clauses.append("%s IS %sNULL" % (column, "" if op == "is_null" else "NOT "))
+        else:
+            raise QuerySpecError("Unsupported filter operator %r" % (op,))
+    return " AND ".join(clauses) or "1", params
+
+
+def _label(dataset):
+    label = dataset["label"]
+    if label == "project":
+        return "?", True
+    if label == "issue_type":
+        return '"type"', False
+    if isinstance(label, dict) and "column" in label:
+        return _column(label["column"]), False
+    raise QuerySpecError("Unsupported label %r" % (label,))
+
+
+def _text(dataset):
+    columns = [_column(c) for c in dataset["columns"]]
+    if dataset["require_all"]:
+        return " || ' ' || ".join(columns)
+    return "TRIM(%s)" % " || ' ' || ".join("COALESCE(%s, '')" % c for c in columns)
+
+
+class CompiledQuery:
+    """A single SELECT producing the rows of several data sets in one scan.
+
+    Every data set contributes its predicate, label and text expression as
+    result columns, so each row can be routed to the data sets it belongs to.
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
+        selects, wheres = [], []
+        self._select_params = []
+        self._where_params = []
+        self._project_label = []
+        for dataset in datasets:
+            predicate, params = _predicate(dataset)
+            label, is_project = _label(dataset)
+            selects += ["(%s)" % predicate, label, _text(dataset)]
+            self._select_params.append(params)
+            self._project_label.append(is_project)
+            wheres.append("(%s)" % predicate)
+            self._where_params += params
+        self.sql = "SELECT %s FROM issue WHERE %s" % (", ".join(selects), " OR ".join(wheres))
+
+    def params(self, project):
+        params = []
+        for dataset_params, is_project in zip(self._select_params, self._project_label):
+            params += dataset_params
+            if is_project:
+                params.append(project)
+        return params + self._where_params
+
+    def count_sql(self, index=0, project=None):
+        # counts the rows of one data set that iter_rows produces: rows
+        # without a label or with a label mapped to null are not counted
+        dataset = self.datasets[index]
+        predicate, params = _predicate(dataset)
+        label, is_project = _label(dataset)
+        label_params = [project] if is_project else []
+        dropped = sorted(name for name, mapped in dataset["label_map"].items() if mapped is None)
+        predicate = "(%s) AND %s IS NOT NULL" % (predicate, label)
+        params = params + label_params
+        if dropped:
+            predicate += " AND %s NOT IN (%s)" % (label, ", ".join("?" * len(dropped)))
+            params += label_params + dropped
+        return "SELECT COUNT(*) FROM issue WHERE %s" % predicate, params
+
+
+def open_readonly(db_path, mmap_size=0, cache_kb=0):
+    """Open a SQLite database read-only.
+
+    immutable=1 tells SQLite the file cannot change, so it skips locking and
+    change detection. With mmap_size the pages are read through a memory map
+    instead of being copied into the page cache, cache_kb limits the page
+    cache to that many KB.
+    """
+    uri = "file:%s?mode=ro&immutable=1" % urllib.parse.quote(db_path)
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    if mmap_size:
+        conn.execute("PRAGMA mmap_size = %d" % int(mmap_size))
+    if cache_kb:
+        conn.execute("PRAGMA cache_size = -%d" % int(cache_kb))
+    return conn
+
+
+def iter_rows(conn, query, project, fetch_size=1000, normalize=None):
+    """Stream (data set index, label, text) tuples with fetchmany.
+
+    A row belonging to several data sets is produced once for each of them.
+    Labels go through the label_map of their data set. normalize, e.g.
+    text_normalization.normalize_many, maps the texts of a fetch at once.
+    """
+    cursor = conn.execute(query.sql, query.params(project))
+    label_maps = [dataset["label_map"] for dataset in query.datasets]
+    width = len(query.datasets)
+    while True:
+        batch = cursor.fetchmany(fetch_size)
+        if not batch:
+            break
+        routed = []
+        for row in batch:
+            for index in range(width):
+                if not row[3 * index]:
+                    continue
+                label = row[3 * index + 1]
+                if label_maps[index]:
+                    label = label_maps[index].get(label, label)
+                if label is None:
+                    continue
+                routed.append((index, label, row[3 * index + 2]))
+        if normalize is None:
+            yield from routed
+        else:
+            texts = normalize([text for _, _, text in routed])
+            for (index, label, _), text in zip(routed, texts):
+                yield index, label, text
@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import random
+import hashlib
+
+
+def class_rng(seed, class_name):
+    # a separate, reproducible random stream per class, so the sample of a
+    # class does not depend on the order the projects are processed in
+    digest = hashlib.sha256(("%s:%s" % (seed, class_name)).encode("utf-8")).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+def parse_class_caps(value):
+    # ETL_SAMPLE_CLASS_CAPS holds a JSON object of class name to cap
+    caps = json.loads(value) if value else {}
+    return {class_name.upper(): int(cap) for class_name, cap in caps.items()}
+
+
+def class_cap(class_name, default_cap, class_caps):
+    # per class cap, 0 means no cap
+    return class_caps.get(class_name, default_cap)
+
+
+def reservoir_sample(rows, k, rng):
+    """Uniform sample of k rows from an iterable of unknown length.
+
+    Single pass reservoir sampling (algorithm R), only k rows are held in
+    memory. The sample is returned in the order the rows were read. Returns
+    the sample and the number of rows seen.
+    """
+    reservoir = []
+    seen = 0
+    for seen, row in enumerate(rows, 1):
+        if len(reservoir) < k:
+            reservoir.append((seen, row))
+        else:
+            j = rng.randrange(seen)
+            if j < k:
+                reservoir[j] = (seen, row)
+    reservoir.sort(key=lambda item: item[0])
+    return [row for _, row in reservoir], seen
+
+
+def reservoir_positions(n, k, rng):
+    """Positions (1-based, ascending) of the rows reservoir_sample keeps.
+
+    Draws from rng exactly like reservoir_sample does over n rows, so
+    selecting the rows at these positions gives the same sample while only
+    k positions are held in memory instead of k rows. n must be known up
+    front, e.g. from a COUNT query.
+    """
+    reservoir = list(range(1, min(n, k) + 1))
+    for seen in range(k + 1, n + 1):
+        j = rng.randrange(seen)
+        if j < k:
+            reservoir[j] = seen
+    reservoir.sort()
+    return reservoir
+
+
+def select_positions(rows, positions):
+    # yield the rows at the given ascending 1-based positions. The rows are
+    # read to the end, iterators with side effects see every row.
+    positions = iter(positions)
+    wanted = next(positions, None)
+    for seen, row in enumerate(rows, 1):
+        if seen == wanted:
+            yield row
+            wanted = next(positions, None)
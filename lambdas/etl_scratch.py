@@ -0,0 +1,155 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import time
+import uuid
+import errno
+import shutil
+import logging
+import threading
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Every run works in its own directory on each tier, leftovers of earlier
+# runs are recognized by this prefix
+RUN_DIR_PREFIX = "etl-run-"
+
+# Run directories currently open in this process. Several runs can share the
+# execution environment; a directory kept for a later invocation of its run
+# is not in use, and goes with the leftovers when another run opens first.
+_in_use = set()
+_in_use_lock = threading.Lock()
+
+
+class ScratchSpace:
+    """Per-run scratch files spread over storage tiers.
+
+    tiers is a list of (name, root, shared) tuples in order of preference,
+    e.g. the ephemeral /tmp of the function before the EFS mount. A file is
+    placed on the first tier with room for its estimated size (plus
+    reserve_bytes of head room). Leftover run directories are removed when the
+    scratch space is opened: on tiers private to the execution environment
+    all that this process does not use, and on shared tiers only those older
+    than stale_seconds, because other containers may still be using theirs.
+    The run directories are removed again on close(), unless the run
+    continues in a later invocation (see keep()). A kept directory survives
+    until the next run of another run_id opens on a private tier, or for
+    stale_seconds on a shared one.
+    """
+
+    def __init__(self, tiers, run_id=None, reserve_bytes=0, stale_seconds=3600):
+        self.run_id = run_id or uuid.uuid4().hex
+        self.reserve_bytes = reserve_bytes
+        self.stale_seconds = stale_seconds
+        self.tiers = [{"name": name, "root": root, "shared": shared,
+                       "dir": os.path.join(root, RUN_DIR_PREFIX + self.run_id),
+                       "reserved": 0, "bytes_written": 0, "files": 0}
+                      for name, root, shared in tiers]
+        self._allocations = {}
+        self._lock = threading.Lock()
+        self._keep = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        with _in_use_lock:
+            _in_use.update(tier["dir"] for tier in self.tiers)
+            for tier in self.tiers:
+                os.makedirs(tier["root"], exist_ok=True)
+                self._remove_leftovers(tier)
+                os.makedirs(tier["dir"], exist_ok=True)
+
+    def _remove_leftovers(self, tier):
+        now = time.time()
+        for entry in os.scandir(tier["root"]):
+            if not entry.name.startswith(RUN_DIR_PREFIX) or entry.path in _in_use:
+                continue
+            if tier["shared"] and now - entry.stat().st_mtime < self.stale_seconds:
+                continue
+            logger.info("Removing leftover scratch directory %s", entry.path)
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _free_bytes(self, tier):
+        return shutil.disk_usage(tier["root"]).free - tier["reserved"]
+
+    def allocate(self, name, estimated_bytes, skip=()):
+        """Return a path for a new file of about estimated_bytes.
+
+        Tiers named in skip are not considered, callers use it to retry on the
+        next tier after running out of space.
+        """
+        with self._lock:
+            candidates = [tier for tier in self.tiers if tier["name"] not in skip]
+            if not candidates:
+                raise OSError(errno.ENOSPC, "No scratch tier left for %s" % name)
+            for tier in candidates:
+                if self._free_bytes(tier) >= estimated_bytes + self.reserve_bytes:
+                    break
+            else:
+                tier = candidates[-1]
+            path = os.path.join(tier["dir"], name)
+            tier["reserved"] += estimated_bytes
+            self._allocations[path] = (tier, estimated_bytes)
+        return path
+
+    def adopt(self, path):
+        """Take over a file an earlier invocation of the same run left in
+        the run directory. Returns False when it is not there."""
+        with self._lock:
+            for tier in self.tiers:
+                if os.path.dirname(path) == tier["dir"] and os.path.exists(path):
+                    self._allocations[path] = (tier, 0)
+                    return True
+        return False
+
+    def tier_of(self, path):
+        return self._allocations[path][0]["name"]
+
+    def commit(self, path):
+        # account for a completed file, it now shows up in the free space of
+        # its tier so the reservation for it is dropped
+        size = os.path.getsize(path)
+        with self._lock:
+            tier, reserved = self._allocations[path]
+            tier["reserved"] -= reserved
+            tier["bytes_written"] += size
+            tier["files"] += 1
+            self._allocations[path] = (tier, 0)
+        return size
+
+    def release(self, path):
+        # delete a file that is no longer needed
+        with self._lock:
+            tier, reserved = self._allocations.pop(path)
+            tier["reserved"] -= reserved
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def keep(self):
+        # leave the run directories in place on close(), for a run that
+        # continues in a later invocation
+        self._keep = True
+
+    def report(self):
+        return {tier["name"]: {"bytes_written": tier["bytes_written"], "files": tier["files"]}
+                for tier in self.tiers}
+
+    def close(self):
+        for tier in self.tiers:
+            if not self._keep:
+                shutil.rmtree(tier["dir"], ignore_errors=True)
+            with _in_use_lock:
+                _in_use.discard(tier["dir"])
+        for tier_name, counters in self.report().items():
+            logger.info("Scratch tier %s: %d files, %d bytes written",
+                        tier_name, counters["files"], counters["bytes_written"])
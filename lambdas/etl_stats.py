@@ -0,0 +1,190 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import json
+import logging
+import text_normalization
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Statistics of the training data of the last run. They stay out of
+# prepped_data/, Comprehend reads every object there as training data.
+STATS_KEY = "etl_state/dataset_stats.json"
+STATS_VERSION = 1
+
+# Amazon Comprehend trains a multi-class classifier on at least 2 classes
+# with at least 10 documents each; smaller data sets fail the training
+MIN_CLASSES = 2
+MIN_CLASS_ROWS = 10
+# shares of a class above which its documents are reported as suspicious
+EMPTY_WARN_SHARE = float(os.environ.get("STATS_EMPTY_WARN_SHARE", 0.05))
+DUPLICATE_WARN_SHARE = float(os.environ.get("STATS_DUPLICATE_WARN_SHARE", 0.2))
+OVERSIZED_WARN_SHARE = float(os.environ.get("STATS_OVERSIZED_WARN_SHARE", 0.2))
+# ratio of the largest to the smallest class above which the classes are
+# reported as imbalanced
+IMBALANCE_WARN_RATIO = float(os.environ.get("STATS_IMBALANCE_WARN_RATIO", 100))
+
+
+def _bucket(length):
+    # lengths are counted in power of two buckets: 0, 1, 2-3, 4-7, ...
+    return 0 if length == 0 else 1 << (length.bit_length() - 1)
+
+
+class TextStats:
+    """Streaming statistics of the documents of a class.
+
+    add() is called with the text of every row written. Counts the rows,
+    empty documents, exact duplicates of non-empty ones (when
+    track_duplicates, this keeps a hash per distinct text) and documents
+    that reached the byte limit of text_normalization and were truncated,
+    and keeps histograms of the lengths in characters and UTF-8 bytes.
+    """
+
+    def __init__(self, track_duplicates=True, max_bytes=None):
+        self.max_bytes = text_normalization.MAX_BYTES if max_bytes is None else max_bytes
+        self.rows = 0
+        self.empty = 0
+        self.oversized = 0
+        self.chars = 0
+        self.bytes = 0
+        self.max_chars = 0
+        self.chars_histogram = {}
+        self.bytes_histogram = {}
+        self._seen = set() if track_duplicates else None
+        self.duplicates = 0 if track_duplicates else None
+
+    def add(self, text):
+        text = text or ""
+        chars = len(text)
+        size = chars if text.isascii() else len(text.encode("utf-8"))
+        self.rows += 1
+        self.chars += chars
+        self.bytes += size
+        if chars > self.max_chars:
+            self.max_chars = chars
+        if not chars:
+            self.empty += 1
+        # the last character of a truncated text may not have fitted
+        if size > self.max_bytes - 4:
+            self.oversized += 1
+        bucket = _bucket(chars)
+        self.chars_histogram[bucket] = self.chars_histogram.get(bucket, 0) + 1
+        bucket = _bucket(size)
+        self.bytes_histogram[bucket] = self.bytes_histogram.get(bucket, 0) + 1
+        if self._seen is not None and chars:
+            key = hash(text)
+            if key in self._seen:
+                self.duplicates += 1
+            else:
+                self._seen.add(key)
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "empty": self.empty,
+            "duplicates": self.duplicates,
+            "oversized": self.oversized,
+            "chars": self.chars,
+            "bytes": self.bytes,
+            "max_chars": self.max_chars,
+            "mean_chars": round(self.chars / self.rows, 1) if self.rows else 0.0,
+            "chars_histogram": {str(k): v for k, v in sorted(self.chars_histogram.items())},
+            "bytes_histogram": {str(k): v for k, v in sorted(self.bytes_histogram.items())},
+        }
+
+
+def combine(stats):
+    # the statistics of several classes together. Duplicates are counted
+    # within a class, a text in two classes is not a duplicate here.
+    stats = list(stats)
+    total = {"rows": 0, "empty": 0, "duplicates": 0, "oversized": 0, "chars": 0, "bytes": 0, "max_chars": 0}
+    chars_histogram, bytes_histogram = {}, {}
+    for s in stats:
+        for name in ("rows", "empty", "oversized", "chars", "bytes"):
+            total[name] += s[name]
+        if total["duplicates"] is not None:
+            total["duplicates"] = None if s["duplicates"] is None else total["duplicates"] + s["duplicates"]
+        total["max_chars"] = max(total["max_chars"], s["max_chars"])
+        for histogram, combined in ((s["chars_histogram"], chars_histogram), (s["bytes_histogram"], bytes_histogram)):
+            for k, v in histogram.items():
+                combined[int(k)] = combined.get(int(k), 0) + v
+    total["mean_chars"] = round(total["chars"] / total["rows"], 1) if total["rows"] else 0.0
+    total["chars_histogram"] = {str(k): v for k, v in sorted(chars_histogram.items())}
+    total["bytes_histogram"] = {str(k): v for k, v in sorted(bytes_histogram.items())}
+    return total
+
+
+def check(classes):
+    """Problems of a training set that would make a training fail or the
+    model poor. classes maps the class names to their statistics (at least
+    rows, empty, duplicates and oversized). Returns a list of issues with a
+    level of "error" or "warning", the class they concern and a message.
+    """
+    issues = []
+
+    def issue(level, class_name, message):
+        issues.append({"level": level, "class": class_name, "message": message})
+
+    if len(classes) < MIN_CLASSES:
+        issue("error", None, "%d classes, a multi-class classifier needs at least %d" % (len(classes), MIN_CLASSES))
+    for class_name, s in sorted(classes.items()):
+        rows = s["rows"]
+        if rows < MIN_CLASS_ROWS:
+            issue("error", class_name, "%d documents, a class needs at least %d" % (rows, MIN_CLASS_ROWS))
+            continue
+        if s["empty"] == rows:
+            issue("error", class_name, "all %d documents are empty" % rows)
+            continue
+        for name, share in (("empty", EMPTY_WARN_SHARE), ("duplicates", DUPLICATE_WARN_SHARE),
+                            ("oversized", OVERSIZED_WARN_SHARE)):
+            if s.get(name) is not None and s[name] > share * rows:
+                issue("warning", class_name, "%d of %d documents are %s" % (s[name], rows, name))
+    sizes = [s["rows"] for s in classes.values() if s["rows"]]
+    if sizes and max(sizes) > IMBALANCE_WARN_RATIO * min(sizes):
+        issue("warning", None, "the largest class has %d documents, the smallest %d" % (max(sizes), min(sizes)))
+    return issues
+
+
+def dataset_stats(source, members):
+    # the statistics manifest of the training data of a run; members are the
+    # manifest entries of the projects. Classes without statistics are listed
+    # under unknown.
+    classes = {entry["class_name"]: entry["stats"] for entry in members.values()
+               if not entry["excluded"] and entry.get("stats")}
+    return {
+        "version": STATS_VERSION,
+        "source": source,
+        "max_bytes": text_normalization.MAX_BYTES,
+        "classes": classes,
+        "total": combine(classes.values()),
+        "excluded": sorted(entry["class_name"] for entry in members.values() if entry["excluded"]),
+        "unknown": sorted(entry["class_name"] for entry in members.values()
+                          if not entry["excluded"] and not entry.get("stats")),
+        "issues": check(classes),
+    }
+
+
+def summary(stats):
+    # the per class counts of a statistics manifest, small enough for an SNS
+    # message attribute
+    counts = ("rows", "empty", "duplicates", "oversized", "mean_chars")
+    return {
+        "key": STATS_KEY,
+        "classes": {class_name: {name: s[name] for name in counts} for class_name, s in stats["classes"].items()},
+        "total": {name: stats["total"][name] for name in counts},
+        "unknown": stats["unknown"],
+        "issues": stats["issues"],
+    }
+
+
+def save_stats(client, bucket, stats, key=STATS_KEY):
+    client.put_object(Bucket=bucket, Key=key,
+                      Body=json.dumps(stats, indent=2, sort_keys=True).encode("utf-8"),
+                      ContentType="application/json")
+    for issue in stats["issues"]:
+        logger.warning("Training data %s%s: %s", issue["level"],
+                       " in " + issue["class"] if issue["class"] else "", issue["message"])
+    logger.info("Saved training data statistics to s3://%s/%s", bucket, key)
@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The training data in the bucket as the ETL and the derive function write
+# it: the keys of the CSVs, the configuration recorded in the manifest, the
+# manifest entry of a project and which of its CSVs changed. Both functions
+# hold the lock of the bucket (see etl_marker.bucket_lock) while they write.
+
+import os
+import botocore
+import logging
+import metrics
+import text_normalization
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+
+def prepped_data_key(class_name):
+    return "prepped_data/" + class_name.lower() + ".csv"
+
+
+def derived_data_key(dataset_name, class_name):
+    return "derived_data/" + dataset_name + "/" + class_name.lower() + ".csv"
+
+
+def config(query, dedup, output, dedup_threshold, cap, class_caps, floor, seed, shard_bytes=None):
+    # settings that shape the generated CSVs, see etl_manifest.config_fingerprint
+    result = {"query": query, "dedup": dedup, "output": output, "text": text_normalization.config()}
+    if output == "shards":
+        result["shard_bytes"] = shard_bytes
+    if dedup == "near":
+        result["dedup_threshold"] = dedup_threshold
+    if cap or class_caps or floor:
+        result["sampling"] = {"cap": cap, "class_caps": class_caps, "floor": floor, "seed": seed}
+    return result
+
+
+def upload_file(s3, bucket, key, local_file, transfer_config=None):
+    # Upload the file to S3 from the scratch space
+    size = os.path.getsize(local_file)
+    try:
+        with metrics.timer("upload"):
+            s3.Bucket(bucket).upload_file(local_file, key, Config=transfer_config)
+    except botocore.exceptions.ClientError as e:
+        logger.error("Exception (%s)", e)
+        logger.error(
+            "Error uploading object %s from bucket %s to EFS. Make sure they exist and your bucket is in the same region as this function.", key, bucket)
+        raise e
+
+    metrics.put("BytesWritten", size, "Bytes", "upload")
+    metrics.put("Files", 1, "Count", "upload")
+    logger.info("Uploaded file: %s of size %d bytes to %s", local_file,
+                size, "s3://" + bucket + "/" + key)
+
+
+def delete_file(client, bucket, key):
+    # Remove training data that is no longer part of the data set
+    try:
+        client.delete_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        logger.error("Exception (%s)", e)
+        logger.error("Error deleting object %s from bucket %s.", key, bucket)
+        raise e
+
+    logger.info("Deleted file: %s", "s3://" + bucket + "/" + key)
+
+
+def manifest_entry(fingerprint, project, floor):
+    # the manifest entry of an extracted or derived project
+    return {
+        "fingerprint": fingerprint,
+        "class_name": project["class_name"],
+        "rows": project["rows"],
+        "source_rows": project["source_rows"],
+        "excluded": project["rows"] < floor,
+        "csv_sha256": project["sha256"],
+        "derived": {name: d["sha256"] for name, d in project["derived"].items()},
+        "corpus": project.get("corpus"),
+        "stats": project.get("stats"),
+    }
+
+
+def changes(previous_entry, entry, project):
+    """Whether the training data of a project changed since previous_entry,
+    the (key, local file) uploads that brings and the local files that are
+    not uploaded.
+
+    Derived data sets are not part of the training data, they are neither
+    deduplicated, sampled nor subject to the floor. An excluded class keeps
+    no CSV, a previously uploaded one is removed with the stale outputs.
+    """
+    class_name = project["class_name"]
+    uploads, unused = [], []
+    for name, d in project["derived"].items():
+        if previous_entry is None or previous_entry.get("derived", {}).get(name) != d["sha256"]:
+            uploads.append((derived_data_key(name, class_name), d["local_file"]))
+        else:
+            unused.append(d["local_file"])
+    was_included = previous_entry is not None and not previous_entry["excluded"]
+    if entry["excluded"]:
+        changed = was_included
+        unused.append(project["local_file"])
+    elif was_included and previous_entry["csv_sha256"] == entry["csv_sha256"]:
+        changed = False
+        unused.append(project["local_file"])
+    else:
+        changed = True
+        uploads.append((prepped_data_key(class_name), project["local_file"]))
+    return changed, uploads, unused
+
+
+def outputs(members):
+    # the objects the training data of the manifest members consists of
+    return sorted([prepped_data_key(entry["class_name"]) for entry in members.values() if not entry["excluded"]] +
+                  [derived_data_key(name, entry["class_name"]) for entry in members.values()
+                   for name in entry.get("derived", {})])
+
+
+def stale_outputs(manifest, previous, current_outputs):
+    # the objects of the previous run that this run did not write again, e.g.
+    # classes that left the archive or fell below the floor, or the files of
+    # another output mode
+    previous_outputs = manifest["outputs"] or [prepped_data_key(entry["class_name"])
+                                               for entry in previous.values() if not entry["excluded"]]
+    return sorted(set(previous_outputs) - set(current_outputs))
@@ -6,6 +6,7 @@ import boto3
 import time
 import os
 import logging
+import metrics
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -13,6 +14,7 @@ logger.setLevel(logging.INFO)
 comprehend = boto3.client("comprehend")
 sns = boto3.resource("sns")
 
+@metrics.handler
 def lambda_handler(event, context):
     bucketname =  event['Records'][0]['s3']['bucket']['name']
     classifierobject =  event['Records'][0]['s3']['object']['key']
@@ -3,8 +3,18 @@
 
 import json
 import boto3
+import botocore
 import os
+import time
 import logging
+import local_model
+import metrics
+import rate_limiter
+import result_cache
+import text_chunks
+import text_normalization
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -12,36 +22,464 @@ import logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-comprehend = boto3.client("comprehend")
+# A batch request ({"Texts": [...]}) is classified with up to
+# CLASSIFY_CONCURRENCY concurrent ClassifyDocument calls, match it to the
+# throughput of the inference units of the endpoint. Batches are limited to
+# MAX_BATCH_SIZE texts.
+CLASSIFY_CONCURRENCY = int(os.environ.get("CLASSIFY_CONCURRENCY", 8))
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 500))
 
+# Client side rate limit of the ClassifyDocument calls of a container in
+# characters per second: RATE_LIMIT_CHARS_PER_UNIT for every current
+# inference unit of the endpoint, with bursts of up to
+# RATE_LIMIT_BURST_SECONDS worth of characters, by default one text of
+# TEXT_MAX_BYTES at one inference unit. Calls queue for up to
+# RATE_LIMIT_MAX_WAIT seconds, within the 29 seconds API Gateway waits for
+# the function. Throttled calls lower the rate and are retried up to
+# THROTTLE_RETRIES times with jittered exponential backoff; the rate
+# recovers with the calls that succeed. RATE_LIMIT=off turns the limit off.
+RATE_LIMIT = os.environ.get("RATE_LIMIT", "on").lower() != "off"
+RATE_LIMIT_CHARS_PER_UNIT = float(os.environ.get("RATE_LIMIT_CHARS_PER_UNIT", 100))
+RATE_LIMIT_BURST_SECONDS = float(os.environ.get("RATE_LIMIT_BURST_SECONDS", 100))
+RATE_LIMIT_MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", 20))
+THROTTLE_RETRIES = int(os.environ.get("THROTTLE_RETRIES", 3))
+THROTTLE_CODES = ("ThrottlingException", "TooManyRequestsException")
+
+# the HTTP connection pool of the client serves every concurrent call.
+# Throttling is retried by the function, the client does not retry.
+comprehend = boto3.client("comprehend", config=Config(
+    max_pool_connections=max(10, CLASSIFY_CONCURRENCY),
+    retries={"mode": "standard", "total_max_attempts": 1}))
+_executor = ThreadPoolExecutor(CLASSIFY_CONCURRENCY, thread_name_prefix="classify")
+s3 = boto3.resource("s3")
+
+# The endpoint status is checked once per ENDPOINT_STATUS_TTL seconds in a
+# warm container, and right away when a classification fails, instead of
+# before every request
+ENDPOINT_STATUS_TTL = float(os.environ.get("ENDPOINT_STATUS_TTL", 300))
+NOT_READY_STATUSES = ('CREATING', 'UPDATING', 'DELETING', 'FAILED')
+
+# Results are cached per normalized text and model, in a local LRU cache of
+# RESULT_CACHE_MAX_BYTES bytes for RESULT_CACHE_TTL seconds (0 bytes turns
+# it off) and in the optional shared tier RESULT_CACHE_BACKEND, see
+# result_cache.load_backend
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("RESULT_CACHE_MAX_BYTES", 16 * 1024 * 1024))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 3600))
+RESULT_CACHE_BACKEND = os.environ.get("RESULT_CACHE_BACKEND", "")
+
+# A single text longer than TEXT_MAX_BYTES is classified by its Policy:
+# "first_bytes" sends the first FirstBytes bytes (at most TEXT_MAX_BYTES) of
+# the normalized text in one call, "all_chunks" splits the first
+# LONG_TEXT_MAX_BYTES bytes of it into sentence-aware chunks, classifies them
+# concurrently and combines their scores by the Aggregation of the request,
+# see text_chunks.aggregate. The characters of all chunks are reserved from
+# the rate limit before the first call, so LONG_TEXT_MAX_BYTES is further
+# bounded by what the limit serves within RATE_LIMIT_MAX_WAIT at the current
+# inference units, 12000 bytes at one.
+POLICIES = ("first_bytes", "all_chunks")
+LONG_TEXT_POLICY = os.environ.get("LONG_TEXT_POLICY", "first_bytes")
+LONG_TEXT_AGGREGATION = os.environ.get("LONG_TEXT_AGGREGATION", "weighted")
+LONG_TEXT_MAX_BYTES = int(os.environ.get("LONG_TEXT_MAX_BYTES", 100000))
+
+# While the endpoint is not in service, e.g. during a training or an update,
+# requests are answered by the local model (see local_model) trained from
+# the same training data. It is loaded from s3://BUCKET_NAME/LOCAL_MODEL_KEY
+# on first use and checked for a newer version every LOCAL_MODEL_TTL
+# seconds. LOCAL_MODEL=off returns the not ready message instead.
+LOCAL_MODEL = os.environ.get("LOCAL_MODEL", "on").lower() != "off"
+LOCAL_MODEL_KEY = os.environ.get("LOCAL_MODEL_KEY", local_model.MODEL_KEY)
+LOCAL_MODEL_TTL = float(os.environ.get("LOCAL_MODEL_TTL", 300))
+
+# Cascade: with CASCADE=on, or "Cascade": true in a request, the local model
+# scores a text first and answers when its top class reaches the threshold
+# calibrated for that class on held-out training data (see
+# cascade_calibration); other texts are escalated to the endpoint. Responses
+# name the tier that answered.
+CASCADE = os.environ.get("CASCADE", "off").lower() == "on"
+
+# (LocalModel or None, ETag, time.monotonic() of the check)
+_local = None
+
+# endpoint ARN -> (status, model ARN, time.monotonic() of the check)
+_endpoint_status = {}
+# endpoint ARN -> rate_limiter.TokenBucket in characters per second
+_limiters = {}
+
+_results = None
+if RESULT_CACHE_MAX_BYTES or RESULT_CACHE_BACKEND:
+    _results = result_cache.ResultCache(result_cache.LruTtlCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL),
+                                        result_cache.load_backend(RESULT_CACHE_BACKEND))
+# the endpoint and model of the cached results
+_results_model = None
+
+
+def _endpoint_ready(endpoint_arn, refresh=False):
+
+    # False while the endpoint is not in service. Lambda freezes a container
+    # between invocations, so an expired status is checked again inline
+    # rather than by a background thread.
+    cached = _endpoint_status.get(endpoint_arn)
+    now = time.monotonic()
+    if refresh or cached is None or now - cached[2] >= ENDPOINT_STATUS_TTL:
+        properties = comprehend.describe_endpoint(EndpointArn=endpoint_arn)['EndpointProperties']
+        cached = _endpoint_status[endpoint_arn] = (properties['Status'], properties.get('ModelArn'), now)
+        metrics.put("StatusChecks", 1, "Count", "classify")
+        _update_limiter(endpoint_arn, properties.get('CurrentInferenceUnits') or 1)
+        logger.info("Endpoint %s is %s", endpoint_arn, cached[0])
+    return cached[0] not in NOT_READY_STATUSES
+
+
+def _update_limiter(endpoint_arn, inference_units):
+    if not RATE_LIMIT:
+        return
+    rate = inference_units * RATE_LIMIT_CHARS_PER_UNIT
+    limiter = _limiters.get(endpoint_arn)
+    if limiter is None:
+        _limiters[endpoint_arn] = rate_limiter.TokenBucket(rate, RATE_LIMIT_BURST_SECONDS)
+    elif limiter.max_rate != rate:
+        logger.info("Endpoint %s has %s inference units, limiting to %.0f characters per second",
+                    endpoint_arn, inference_units, rate)
+        limiter.set_max_rate(rate)
+
+
+def _throttled(e):
+    return isinstance(e, botocore.exceptions.ClientError) and e.response['Error']['Code'] in THROTTLE_CODES
+
+
+def _reserve(endpoint_arn, characters):
+    # waits for the characters in the rate limit of the endpoint
+    limiter = _limiters.get(endpoint_arn)
+    if limiter is None or not characters:
+        return
+    try:
+        waited = limiter.acquire(characters, RATE_LIMIT_MAX_WAIT)
+    except rate_limiter.RateLimitExceeded:
+        metrics.put("RateLimited", 1, "Count", "rate_limit")
+        raise
+    if waited:
+        metrics.put("QueueWait", waited * 1000, "Milliseconds", "rate_limit")
+
+
+def _classify_document(endpoint_arn, text, reserved=False):
+
+    # ClassifyDocument within the rate limit of the endpoint, throttled calls
+    # are retried after a jittered backoff. A reserved text was counted by
+    # the caller, its retries are not.
+    limiter = _limiters.get(endpoint_arn)
+    attempt = 0
+    while True:
+        if attempt or not reserved:
+            _reserve(endpoint_arn, len(text))
+        try:
+            with metrics.timer("classify"):
+                response = comprehend.classify_document(EndpointArn=endpoint_arn, Text=text)
+        except botocore.exceptions.ClientError as e:
+            if not _throttled(e):
+                raise
+            metrics.put("Throttles", 1, "Count", "rate_limit")
+            if limiter is not None:
+                limiter.throttled()
+            attempt += 1
+            if attempt > THROTTLE_RETRIES:
+                raise
+            metrics.put("Retries", 1, "Count", "rate_limit")
+            time.sleep(rate_limiter.backoff(attempt))
+            continue
+        if limiter is not None:
+            limiter.succeeded()
+        return response
+
+
+def _too_many_requests(e):
+    return {'statusCode': 429, 'body': json.dumps('Too many requests for the Amazon Comprehend endpoint, retry later (%s)' % e)}
+
+
+def _cached_result(endpoint_arn, text):
+
+    # the cached classes of text and the cache key, the cache is emptied when
+    # the function classifies with another endpoint or model
+    global _results_model
+    if _results is None:
+        return None, None
+    model = (endpoint_arn, _endpoint_status[endpoint_arn][1])
+    if model != _results_model:
+        if _results_model is not None:
+            logger.info("Endpoint or model changed to %s, clearing the result cache", model)
+        _results.clear()
+        _results_model = model
+    key = result_cache.cache_key(endpoint_arn, model[1], text)
+    classes, tier = _results.get(key)
+    if tier == "local":
+        metrics.put("CacheHits", 1, "Count", "cache")
+    elif tier == "shared":
+        metrics.put("SharedCacheHits", 1, "Count", "cache")
+    else:
+        metrics.put("CacheMisses", 1, "Count", "cache")
+    return classes, key
+
+
+def _classify(endpoint_arn, text, removed=0):
+
+    # the classes of a normalized text, from the result cache or the endpoint
+    classes, key = _cached_result(endpoint_arn, text)
+    if classes is None:
+        classes = _classify_uncached(endpoint_arn, text, key, removed)
+    return classes
+
+
+def _classify_uncached(endpoint_arn, text, key, removed=0, reserved=False):
+    response_Entity = _classify_document(endpoint_arn, text, reserved)
+    metrics.put("Characters", len(text), "Count", "classify")
+    metrics.put("CharactersRemoved", removed, "Count", "classify")
+    classes = response_Entity['Classes']
+    if key is not None:
+        _results.put(key, classes)
+    return classes
+
+
+def _long_text_max_bytes(endpoint_arn):
+    # the bytes of a long text the rate limit of the endpoint can serve
+    limiter = _limiters.get(endpoint_arn)
+    if limiter is None:
+        return LONG_TEXT_MAX_BYTES
+    return min(LONG_TEXT_MAX_BYTES, int(limiter.max_rate * (RATE_LIMIT_BURST_SECONDS + RATE_LIMIT_MAX_WAIT)))
+
+
+def _classify_long(endpoint_arn, raw_text, aggregation):
+
+    # the aggregated classes of the chunks of a long text, classified
+    # concurrently; a text that fits in one chunk takes a single call. The
+    # chunks that are not cached are reserved from the rate limit at once,
+    # a request that would wait too long fails before any call is made.
+    text = text_normalization.normalize(raw_text, _long_text_max_bytes(endpoint_arn))
+    removed = len(raw_text) - len(text)
+    chunks = text_chunks.split(text)
+    if len(chunks) <= 1:
+        return _classify(endpoint_arn, text, removed)
+    cached = [_cached_result(endpoint_arn, chunk) for chunk in chunks]
+    _reserve(endpoint_arn, sum(len(chunk) for chunk, (classes, _) in zip(chunks, cached) if classes is None))
+
+    def classify(i):
+        classes, key = cached[i]
+        if classes is None:
+            classes = _classify_uncached(endpoint_arn, chunks[i], key, removed if i == 0 else 0, reserved=True)
+        return classes
+
+    results = list(_executor.map(classify, range(len(chunks))))
+    metrics.put("Chunks", len(chunks), "Count", "long")
+    return text_chunks.aggregate(results, [len(chunk) for chunk in chunks], aggregation)
+
+
+def _request_options(event):
+    # the policy, aggregation, first bytes and cascade of a request, or the error
+    policy = event.get('Policy', LONG_TEXT_POLICY)
+    aggregation = event.get('Aggregation', LONG_TEXT_AGGREGATION)
+    first_bytes = event.get('FirstBytes', text_normalization.MAX_BYTES)
+    cascade = event.get('Cascade', CASCADE)
+    if policy not in POLICIES:
+        return None, 'Policy must be one of ' + ", ".join(POLICIES)
+    if aggregation not in text_chunks.AGGREGATIONS:
+        return None, 'Aggregation must be one of ' + ", ".join(text_chunks.AGGREGATIONS)
+    if not isinstance(first_bytes, int) or isinstance(first_bytes, bool) or first_bytes <= 0:
+        return None, 'FirstBytes must be a positive integer'
+    if not isinstance(cascade, bool):
+        return None, 'Cascade must be true or false'
+    return (policy, aggregation, min(first_bytes, text_normalization.MAX_BYTES), cascade), None
+
+
+def _classify_item(endpoint_arn, text, removed):
+    # a batch item fails on its own
+    try:
+        return {'Classes': _classify(endpoint_arn, text, removed)}
+    except botocore.exceptions.ClientError as e:
+        logger.error("Exception (%s)", e)
+        return {'Error': {'Code': e.response['Error']['Code'], 'Message': e.response['Error']['Message']}}
+    except Exception as e:
+        logger.error("Exception (%s)", e)
+        return {'Error': {'Code': type(e).__name__, 'Message': str(e)}}
+
+
+def _classify_batch(endpoint_arn, raw_texts, cascade=False):
+
+    # classify the distinct normalized texts of the batch concurrently and
+    # return the results in the order of the texts; in a cascade the texts
+    # the local model is confident about are not sent to the endpoint
+    texts = text_normalization.normalize_many(raw_texts)
+    removed = {}
+    for raw, text in zip(raw_texts, texts):
+        removed.setdefault(text, len(raw) - len(text))
+    distinct = list(removed)
+    local = {}
+    if cascade:
+        for text in distinct:
+            classes = _confident_local(text)
+            if classes is not None:
+                local[text] = {'Classes': classes, 'Tier': 'local'}
+        _count_cascade(len(local), len(distinct) - len(local))
+    escalated = [text for text in distinct if text not in local]
+    results = dict(zip(escalated, _executor.map(
+        lambda text: _classify_item(endpoint_arn, text, removed[text]), escalated)))
+    for result in results.values():
+        if 'Classes' in result:
+            result['Tier'] = 'endpoint'
+    results.update(local)
+    metrics.put("BatchSize", len(raw_texts), "Count", "batch")
+    metrics.put("DistinctTexts", len(distinct), "Count", "batch")
+    errors = sum(1 for result in results.values() if 'Error' in result)
+    if errors:
+        metrics.put("Errors", errors, "Count", "batch")
+    return [results[text] for text in texts], errors
+
+
+def _local_model():
+
+    # the local model or None when there is none, loaded lazily and again
+    # when a newer one was trained
+    global _local
+    bucket = os.environ.get("BUCKET_NAME")
+    if not LOCAL_MODEL or not bucket:
+        return None
+    now = time.monotonic()
+    if _local is not None and now - _local[2] < LOCAL_MODEL_TTL:
+        return _local[0]
+    model, etag = None if _local is None else _local[0], None
+    try:
+        etag = s3.meta.client.head_object(Bucket=bucket, Key=LOCAL_MODEL_KEY).get('ETag')
+        if model is None or etag != _local[1]:
+            with metrics.timer("local_load"):
+                body = s3.meta.client.get_object(Bucket=bucket, Key=LOCAL_MODEL_KEY)['Body'].read()
+                model = local_model.LocalModel.from_bytes(body)
+            logger.info("Loaded the local model s3://%s/%s with %d classes", bucket, LOCAL_MODEL_KEY,
+                        len(model.classes))
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ("404", "NoSuchKey"):
+            logger.error("Exception (%s)", e)
+    _local = (model, etag, now)
+    return model
+
+
+def _classify_local(raw_texts):
+
+    # the classes of the texts from the local model, None without a model
+    model = _local_model()
+    if model is None:
+        return None
+    texts = text_normalization.normalize_many(raw_texts)
+    with metrics.timer("local"):
+        results = [model.classify(text) for text in texts]
+    metrics.put("LocalClassifications", len(texts), "Count", "local")
+    return results
+
+
+def _not_ready_or_local(texts, batch=False):
+    # the answer of the local model while the endpoint is not in service
+    results = _classify_local(texts)
+    if results is None:
+        return _not_ready()
+    if batch:
+        return {'statusCode': 200, 'body': [{'Classes': classes, 'Tier': 'local'} for classes in results]}
+    return {
+          'statusCode': 200,
+          'body': results[0],
+          'tier': 'local'
+          }
+
+
+def _confident_local(text):
+
+    # the classes of the local model for a normalized text when its top
+    # class reaches the calibrated threshold of the class, None to escalate
+    model = _local_model()
+    if model is None:
+        return None
+    classes = model.classify(text)
+    threshold = (model.metadata.get("thresholds") or {}).get(classes[0]['Name'])
+    if threshold is None or classes[0]['Score'] < threshold:
+        return None
+    return classes
+
+
+def _count_cascade(local, escalated):
+    metrics.put("LocalAnswers", local, "Count", "cascade")
+    metrics.put("Escalations", escalated, "Count", "cascade")
+
+
+def _not_ready():
+    responseBody = 'Amazon Comprehend endpoint not created or Model training in progress'
+    return {
+            'statusCode': 200,
+            'body': json.dumps(responseBody)
+        }
+
+
+@metrics.handler
 def lambda_handler(event, context):
     
     endpointArn = os.environ.get("ENDPOINT_ARN")
-    response = comprehend.describe_endpoint(EndpointArn=endpointArn)
-    status = response['EndpointProperties']['Status']
-    if status in ['CREATING', 'UPDATING', 'DELETING' ,'FAILED']:
-        responseBody = 'Amazon Comprehend endpoint not created or Model training in progress'
-        return {
-                'statusCode': 200,
-                'body': json.dumps(responseBody)
-            }
+    if 'Texts' in event:
+        return _batch_handler(endpointArn, event['Texts'], event.get('Cascade'))
+    options, error = _request_options(event)
+    if error is not None:
+        return {'statusCode': 400, 'body': json.dumps(error)}
+    policy, aggregation, first_bytes, cascade = options
+    if not _endpoint_ready(endpointArn):
+        return _not_ready_or_local([event['Text']])
     else:
+        if cascade:
+            with metrics.timer("cascade"):
+                responseBody = _confident_local(text_normalization.normalize(event['Text']))
+            _count_cascade(int(responseBody is not None), int(responseBody is None))
+            if responseBody is not None:
+                return {'statusCode': 200, 'body': responseBody, 'tier': 'local'}
         try:
         # calling Custom Comprehend Named entity recognition API in real time
         # to fetch product and its version details from the email message body
-            response_Entity = comprehend.classify_document (
-            EndpointArn=endpointArn, Text=event['Text']
-        )
-            responseBody = response_Entity['Classes']
+        # the request text is normalized like the training data was
+            if policy == "all_chunks":
+                responseBody = _classify_long(endpointArn, event['Text'], aggregation)
+            else:
+                text = text_normalization.normalize(event['Text'], first_bytes)
+                responseBody = _classify(endpointArn, text, len(event['Text']) - len(text))
             
         except Exception as e:
          # Send some context about this error to Lambda Logs
             logger.error("Exception (%s)", e)
+            if isinstance(e, rate_limiter.RateLimitExceeded) or _throttled(e):
+                return _too_many_requests(e)
+            # the endpoint may have left service since its status was checked
+            if not _endpoint_ready(endpointArn, refresh=True):
+                return _not_ready_or_local([event['Text']])
             raise e
             
             
+    return {
+          'statusCode': 200,
+          'body': responseBody,
+          'tier': 'endpoint'
+          }
+
+
+def _batch_handler(endpointArn, texts, cascade=None):
+
+    # {"Texts": [...]}: the body is a list with {"Classes": [...], "Tier": ...}
+    # or {"Error": {"Code": ..., "Message": ...}} for every text, in order
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return {'statusCode': 400, 'body': json.dumps('Texts must be a list of strings')}
+    if len(texts) > MAX_BATCH_SIZE:
+        return {'statusCode': 400,
+                'body': json.dumps('A batch holds at most %d texts, got %d' % (MAX_BATCH_SIZE, len(texts)))}
+    cascade = CASCADE if cascade is None else cascade
+    if not isinstance(cascade, bool):
+        return {'statusCode': 400, 'body': json.dumps('Cascade must be true or false')}
+    if not _endpoint_ready(endpointArn):
+        return _not_ready_or_local(texts, batch=True)
+    responseBody, errors = _classify_batch(endpointArn, texts, cascade)
+    if errors:
+        logger.warning("%d of %d texts of the batch failed", errors, len(texts))
+        # the endpoint may have left service since its status was checked,
+        # later requests see the new status
+        _endpoint_ready(endpointArn, refresh=True)
     return {
           'statusCode': 200,
           'body': responseBody
-          
-          }
\ No newline at end of file
+          }
@@ -0,0 +1,200 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import re
+import sys
+import json
+import gzip
+import math
+import time
+import zlib
+import array
+import heapq
+import operator
+import collections
+import logging
+import text_normalization
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# The local model is a linear classifier over hashed TF-IDF features of the
+# words and word pairs of a text: a multinomial naive Bayes model, which is
+# trained in two passes over the training data instead of many epochs. It
+# answers while the Amazon Comprehend endpoint is not in service.
+MODEL_KEY = "local_model/model.bin"
+MODEL_VERSION = 1
+
+# size of the hashed feature space, and of the vocabulary kept in the model:
+# the features of at least MIN_DF documents, the most frequent first
+HASH_BITS = 18
+MAX_FEATURES = 20000
+MIN_DF = 2
+# additive smoothing of the feature weights of a class
+ALPHA = 0.1
+
+_WORD = re.compile(r"\w+")
+
+
+def features(text):
+    # hashed ids of the words and word pairs of a normalized text with their
+    # counts; the CRC of a pair continues the CRC of its first word
+    words = [word.encode("utf-8") for word in _WORD.findall(text.lower())]
+    mask = (1 << HASH_BITS) - 1
+    crc32 = zlib.crc32
+    crcs = list(map(crc32, words))
+    counts = collections.Counter([crc & mask for crc in crcs])
+    counts.update([crc32(b" " + word, crc) & mask for crc, word in zip(crcs, words[1:])])
+    return counts
+
+
+def _tfidf(counts, idf):
+    # sublinear term frequencies weighted by idf and L2 normalized, features
+    # outside the vocabulary are dropped
+    vector = {}
+    for key, count in counts.items():
+        weight = idf.get(key)
+        if weight is not None:
+            vector[key] = (1.0 + math.log(count)) * weight
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm:
+        for key in vector:
+            vector[key] /= norm
+    return vector
+
+
+class LocalModel:
+    """A trained local model: the vocabulary with its idf, one weight per
+    feature and class, and the bias of every class.
+
+    classify() returns the classes of a normalized text in the shape of the
+    Amazon Comprehend ClassifyDocument response, the highest score first.
+    """
+
+    def __init__(self, classes, vocabulary, idf, weights, bias, metadata=None):
+        self.classes = list(classes)
+        self.vocabulary = array.array("I", vocabulary)
+        self.idf = array.array("f", idf)
+        self.weights = array.array("f", weights)
+        self.bias = array.array("f", bias)
+        self.metadata = metadata or {}
+        k = len(self.classes)
+        # scoring gathers the weights of the features of a text from a column
+        # per class, at the 1-based position of the feature in the vocabulary.
+        # The weights are multiplied by the idf of the feature, so that the
+        # features that occur once in a text, most of them, are a plain sum.
+        self._position = {key: i + 1 for i, key in enumerate(self.vocabulary)}
+        self._idf_column = array.array("d", [0.0]) + array.array("d", self.idf)
+        self._columns = [array.array("f", [0.0] + [w * idf for w, idf in zip(self.weights[c::k], self.idf)])
+                         for c in range(k)]
+
+    def scores(self, text):
+        # the probability of every class, in the order of classes: the bias
+        # plus the dot product of the class weights with the TF-IDF vector of
+        # _tfidf, two padding positions keep the gathers tuples
+        once, more, tf = [0, 0], [0, 0], [0.0, 0.0]
+        position = self._position
+        log = math.log
+        for key, count in features(text).items():
+            p = position.get(key)
+            if p:
+                if count == 1:
+                    once.append(p)
+                else:
+                    more.append(p)
+                    tf.append(1.0 + log(count))
+        gather_once, gather_more = operator.itemgetter(*once), operator.itemgetter(*more)
+        idf_once = gather_once(self._idf_column)
+        weighted = list(map(operator.mul, tf, gather_more(self._idf_column)))
+        norm = math.sqrt(sum(map(operator.mul, idf_once, idf_once)) + sum(map(operator.mul, weighted, weighted)))
+        scores = list(self.bias)
+        if norm:
+            for c, column in enumerate(self._columns):
+                scores[c] += (sum(gather_once(column)) + sum(map(operator.mul, tf, gather_more(column)))) / norm
+        top = max(scores)
+        exp = [math.exp(s - top) for s in scores]
+        total = sum(exp)
+        return [e / total for e in exp]
+
+    def classify(self, text, top=None):
+        ranked = sorted(zip(self.classes, self.scores(text)), key=lambda item: -item[1])
+        return [{'Name': name, 'Score': score} for name, score in ranked[:top]]
+
+    def to_bytes(self):
+        header = dict(self.metadata, version=MODEL_VERSION, classes=self.classes, hash_bits=HASH_BITS,
+                      features=len(self.vocabulary), byteorder=sys.byteorder)
+        body = json.dumps(header, sort_keys=True).encode("utf-8") + b"\n"
+        for values in (self.vocabulary, self.idf, self.weights, self.bias):
+            body += values.tobytes()
+        return gzip.compress(body)
+
+    @classmethod
+    def from_bytes(cls, data):
+        body = gzip.decompress(data)
+        end = body.index(b"\n")
+        header = json.loads(body[:end])
+        if header["version"] != MODEL_VERSION or header["hash_bits"] != HASH_BITS:
+            raise ValueError("Unsupported local model version %s" % header["version"])
+        k, n = len(header["classes"]), header["features"]
+        offset = end + 1
+        parts = []
+        for typecode, count in (("I", n), ("f", n), ("f", n * k), ("f", k)):
+            values = array.array(typecode)
+            values.frombytes(body[offset:offset + count * values.itemsize])
+            if header["byteorder"] != sys.byteorder:
+                values.byteswap()
+            offset += count * values.itemsize
+            parts.append(values)
+        metadata = {name: value for name, value in header.items()
+                    if name not in ("version", "classes", "hash_bits", "features", "byteorder")}
+        return cls(header["classes"], *parts, metadata=metadata)
+
+
+def train(rows, max_features=MAX_FEATURES, min_df=MIN_DF, alpha=ALPHA):
+    """Train a LocalModel on (label, text) rows of normalized text.
+
+    rows is called once per pass and returns a new iterator over the same
+    rows each time, e.g. a reader of the training data CSVs, so that the
+    training data never has to fit in memory.
+    """
+    started = time.time()
+    # first pass: document frequencies and class sizes
+    df, class_rows, documents = {}, {}, 0
+    for label, text in rows():
+        documents += 1
+        class_rows[label] = class_rows.get(label, 0) + 1
+        for key in features(text):
+            df[key] = df.get(key, 0) + 1
+    if len(class_rows) < 2:
+        raise ValueError("The local model needs at least 2 classes, got %d" % len(class_rows))
+    frequent = [(count, key) for key, count in df.items() if count >= min_df]
+    vocabulary = sorted(key for _, key in heapq.nlargest(max_features, frequent))
+    idf = {key: math.log((1 + documents) / (1 + df[key])) + 1.0 for key in vocabulary}
+    del df, frequent
+
+    # second pass: the TF-IDF mass of every feature per class
+    classes = sorted(class_rows)
+    column = {name: i for i, name in enumerate(classes)}
+    position = {key: i for i, key in enumerate(vocabulary)}
+    k = len(classes)
+    mass = array.array("d", bytes(8 * len(vocabulary) * k))
+    for label, text in rows():
+        c = column[label]
+        for key, value in _tfidf(features(text), idf).items():
+            mass[position[key] * k + c] += value
+
+    # log of the smoothed share of each feature in the mass of the class
+    totals = [sum(mass[i * k + c] for i in range(len(vocabulary))) for c in range(k)]
+    weights = array.array("f", bytes(4 * len(vocabulary) * k))
+    for c in range(k):
+        denominator = math.log(totals[c] + alpha * len(vocabulary))
+        for i in range(len(vocabulary)):
+            weights[i * k + c] = math.log(mass[i * k + c] + alpha) - denominator
+    bias = [math.log(class_rows[name] / documents) for name in classes]
+    metadata = {"rows": documents, "class_rows": {name: class_rows[name] for name in classes},
+                "text": text_normalization.config(), "trained": started,
+                "seconds": round(time.time() - started, 1)}
+    logger.info("Trained a local model on %d documents of %d classes with %d features in %.1f seconds",
+                documents, k, len(vocabulary), metadata["seconds"])
+    return LocalModel(classes, vocabulary, [idf[key] for key in vocabulary], weights, bias, metadata)
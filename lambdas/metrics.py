@@ -0,0 +1,123 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+import json
+import time
+import resource
+import functools
+import contextlib
+import threading
+
+
+# CloudWatch namespace of the metrics, METRICS_ENABLED=false turns emission off
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ComprehendCustomClassifier")
+ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() != "false"
+
+# metric values are summed within an invocation, except for these units
+# where the largest value is kept
+_MAX_UNITS = ("Megabytes",)
+
+
+def peak_rss_mb():
+    # ru_maxrss is the high-water mark of the process, reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MetricsLogger:
+    """Stage timers and counters written as CloudWatch Embedded Metric Format.
+
+    Values are aggregated in memory per (stage, class) and written by flush()
+    as one JSON log line per combination, which CloudWatch turns into metrics
+    with the dimensions Function, Stage and, when given, Class. Metrics with a
+    class are also rolled up to Function and Stage. Recording a value is a
+    dictionary update under a lock, safe to call from worker threads.
+    """
+
+    def __init__(self, function_name=None, namespace=NAMESPACE, stream=None, enabled=ENABLED):
+        self.function_name = function_name or os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+        self.namespace = namespace
+        self.stream = stream
+        self.enabled = enabled
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def put(self, name, value, unit="Count", stage=None, class_name=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            metrics = self._values.setdefault((stage, class_name), {})
+            previous = metrics.get(name)
+            if previous is not None:
+                value = max(previous[0], value) if unit in _MAX_UNITS else previous[0] + value
+            metrics[name] = (value, unit)
+
+    @contextlib.contextmanager
+    def timer(self, stage, class_name=None):
+        # Duration of the stage in milliseconds and the peak RSS at its end
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put("Duration", (time.perf_counter() - start) * 1000, "Milliseconds", stage, class_name)
+            self.put("PeakMemory", peak_rss_mb(), "Megabytes", stage)
+
+    def records(self):
+        # EMF documents of the values recorded since the last flush
+        with self._lock:
+            values, self._values = self._values, {}
+        timestamp = int(time.time() * 1000)
+        records = []
+        for (stage, class_name), metrics in sorted(values.items(), key=lambda item: str(item[0])):
+            record = {"Function": self.function_name}
+            dimensions = [["Function"]]
+            if stage is not None:
+                record["Stage"] = stage
+                dimensions = [["Function", "Stage"]]
+            if class_name is not None:
+                record["Class"] = class_name
+                dimensions.insert(0, dimensions[0] + ["Class"])
+            record["_aws"] = {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": dimensions,
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in sorted(metrics.items())],
+                }],
+            }
+            record.update((name, value) for name, (value, _) in metrics.items())
+            records.append(record)
+        return records
+
+    def flush(self):
+        # the Lambda runtime sends stdout to CloudWatch Logs, which extracts
+        # the metrics from the EMF documents
+        stream = self.stream or sys.stdout
+        for record in self.records():
+            stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+        stream.flush()
+
+    def handler(self, function):
+        """Decorator of a Lambda handler: times the invocation as the handler
+        stage and flushes the metrics when it returns or raises."""
+        @functools.wraps(function)
+        def wrapper(event, context):
+            try:
+                with self.timer("handler"):
+                    return function(event, context)
+            except Exception:
+                self.put("Errors", 1, stage="handler")
+                raise
+            finally:
+                self.flush()
+        return wrapper
+
+
+# Shared by the modules of a function, like the root logger
+_default = MetricsLogger()
+
+put = _default.put
+timer = _default.timer
+flush = _default.flush
+handler = _default.handler
@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import time
+import random
+import threading
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a request would wait longer than it may for capacity."""
+
+
+class TokenBucket:
+    """Thread safe token bucket with a rate that adapts to throttling.
+
+    Tokens, e.g. characters, accrue at rate per second up to burst seconds
+    worth of them. acquire(n) reserves n tokens and sleeps until all of them
+    have accrued, also when n is more than the bucket holds, so a request
+    never borrows from the requests after it. Reservations are taken in
+    order, a burst queues up instead of failing.
+
+    throttled() cuts the rate by decrease, down to min_share of max_rate,
+    and succeeded() raises it again by increase of max_rate, additive
+    increase and multiplicative decrease like TCP congestion control.
+    """
+
+    def __init__(self, max_rate, burst=1.0, decrease=0.5, increase=0.05, min_share=0.1,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.burst = burst
+        self.decrease = decrease
+        self.increase = increase
+        self.min_share = min_share
+        self.clock = clock
+        self.sleep = sleep
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    @property
+    def capacity(self):
+        return self.rate * self.burst
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens, max_wait=None):
+        # returns the seconds waited, raises RateLimitExceeded instead of
+        # waiting longer than max_wait
+        with self._lock:
+            self._refill()
+            wait = 0.0 if self.tokens >= tokens else (tokens - self.tokens) / self.rate
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitExceeded("%d tokens would wait %.1f seconds at %.0f per second, more than %.1f" %
+                                        (tokens, wait, self.rate, max_wait))
+            self.tokens -= tokens
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def set_max_rate(self, max_rate):
+        # a new capacity, e.g. after a change of the inference units
+        with self._lock:
+            if max_rate == self.max_rate:
+                return
+            self._refill()
+            self.max_rate = self.rate = max_rate
+            self.tokens = min(self.tokens, self.capacity)
+
+    def throttled(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.max_rate * self.min_share, self.rate * self.decrease)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate * self.increase)
+
+
+def backoff(attempt, base=0.1, cap=5.0, random=random.random):
+    # seconds to wait before retry attempt (1, 2, ...), exponential with full
+    # jitter so that throttled callers do not retry in lockstep
+    return random() * min(cap, base * 2 ** (attempt - 1))
@@ -0,0 +1,163 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import time
+import hashlib
+import importlib
+import threading
+import collections
+import logging
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# bytes an entry takes besides its key and value: the OrderedDict node, the
+# tuple and the float
+ENTRY_OVERHEAD = 200
+
+
+def cache_key(endpoint_arn, model_arn, text):
+    # results of another endpoint or model never match
+    digest = hashlib.sha256()
+    for part in (endpoint_arn or "", model_arn or "", text):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class LruTtlCache:
+    """Thread safe in-memory cache with least recently used eviction.
+
+    Entries expire ttl seconds after they were put. The estimated size of
+    the keys and JSON encoded values is kept below max_bytes, 0 disables the
+    cache.
+    """
+
+    def __init__(self, max_bytes, ttl, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.bytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires, size = entry
+            if self.clock() >= expires:
+                del self._entries[key]
+                self.bytes -= size
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = len(key) + len(json.dumps(value)) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (value, self.clock() + self.ttl, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+
+class LocalBackend:
+    """Stand-in for a shared cache tier, e.g. ElastiCache or DynamoDB, that
+    lives in the process. A shared backend has the same two methods: get()
+    returns the value or None, put() stores a JSON serializable value for
+    ttl seconds."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self.clock() >= entry[1]:
+                self._entries.pop(key, None)
+                return None
+            return json.loads(entry[0])
+
+    def put(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (json.dumps(value), self.clock() + ttl)
+
+
+def load_backend(spec):
+    # "" for no shared tier, "local" for LocalBackend, or "module:factory"
+    # for a backend shipped with the function
+    if not spec:
+        return None
+    if spec == "local":
+        return LocalBackend()
+    module_name, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(module_name), factory or "Backend")()
+
+
+class ResultCache:
+    """Two tier cache of classification results.
+
+    get() looks in the local LRU cache first and then in the shared backend,
+    whose hits are copied to the local cache; it returns the value and the
+    tier it came from ("local", "shared" or None for a miss). Failures of the
+    backend are logged and count as misses, the classification goes ahead
+    without it. The hit and miss counts are kept in stats.
+    """
+
+    def __init__(self, local, backend=None):
+        self.local = local
+        self.backend = backend
+        self.stats = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, tier):
+        with self._lock:
+            self.stats[tier or "miss"] += 1
+        return tier
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value, self._count("local")
+        if self.backend is not None:
+            try:
+                value = self.backend.get(key)
+            except Exception as e:
+                logger.error("Exception (%s)", e)
+                value = None
+            if value is not None:
+                self.local.put(key, value)
+                return value, self._count("shared")
+        return None, self._count(None)
+
+    def put(self, key, value):
+        self.local.put(key, value)
+        if self.backend is not None:
+            try:
+                self.backend.put(key, value, self.local.ttl)
+            except Exception as e:
+                logger.error("Exception (%s)", e)
+
+    def clear(self):
+        # the local tier only, keys of the shared tier include the model
+        self.local.clear()
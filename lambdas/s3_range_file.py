@@ -0,0 +1,88 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import time
+
+# Minimum size of a ranged GET. Small reads (zip headers, the end of central
+# directory record) are served from the block fetched around them.
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+class S3RangeFile(io.RawIOBase):
+    """Read-only, seekable file object over an S3 object.
+
+    Reads are served with ranged GETs of at least block_size bytes, so the
+    object can be opened in place by zipfile without downloading it. Read-ahead
+    never goes past limit, which callers can lower to the end of the region
+    they are interested in. bytes_fetched, requests and fetch_seconds count the
+    traffic.
+    """
+
+    def __init__(self, client, bucket, key, size=None, block_size=DEFAULT_BLOCK_SIZE):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.block_size = block_size
+        self.bytes_fetched = 0
+        self.requests = 0
+        self.fetch_seconds = 0.0
+        if size is None:
+            size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+            self.requests += 1
+        self.size = size
+        self.limit = size
+        self._pos = 0
+        self._buffer = memoryview(b"")
+        self._buffer_start = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence (%r)" % whence)
+        if pos < 0:
+            raise ValueError("Negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        filled = 0
+        while filled < len(view) and self._pos < self.size:
+            offset = self._pos - self._buffer_start
+            if not 0 <= offset < len(self._buffer):
+                self._fetch(len(view) - filled)
+                offset = 0
+            chunk = self._buffer[offset:offset + len(view) - filled]
+            view[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+            self._pos += len(chunk)
+        return filled
+
+    def _fetch(self, wanted):
+        # fetch at least wanted bytes, reading ahead up to block_size but not past limit
+        start = self._pos
+        end = min(self.size, max(start + wanted, min(start + self.block_size, self.limit)))
+        started = time.perf_counter()
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                          Range="bytes=%d-%d" % (start, end - 1))
+        self._buffer = memoryview(response['Body'].read())
+        self.fetch_seconds += time.perf_counter() - started
+        self._buffer_start = start
+        self.bytes_fetched += len(self._buffer)
+        self.requests += 1
@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import re
+import text_normalization
+
+
+# sentence ends: ., ! or ? followed by whitespace
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+AGGREGATIONS = ("mean", "max", "weighted")
+
+
+def _size(text):
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+
+def _pieces(sentence, max_bytes):
+    # a sentence longer than a chunk is cut at spaces, a word longer than a
+    # chunk at the byte limit
+    while _size(sentence) > max_bytes:
+        head = text_normalization.truncate_utf8(sentence, max_bytes)
+        cut = head.rfind(" ")
+        if cut > 0:
+            head = head[:cut]
+        elif not head:
+            head = sentence[0]
+        yield head
+        sentence = sentence[len(head):].lstrip()
+    if sentence:
+        yield sentence
+
+
+def split(text, max_bytes=None):
+    """Split text into chunks of at most max_bytes bytes of UTF-8 (default
+    TEXT_MAX_BYTES) at sentence ends.
+
+    Sentences are packed into a chunk as long as they fit, a sentence longer
+    than a chunk is split at spaces. Returns a list of non-empty chunks.
+    """
+    max_bytes = text_normalization.MAX_BYTES if max_bytes is None else max_bytes
+    if _size(text) <= max_bytes:
+        return [text] if text.strip() else []
+    chunks = []
+    current, current_bytes = [], 0
+    for sentence in _SENTENCE_END.split(text):
+        for piece in _pieces(sentence.strip(), max_bytes):
+            size = _size(piece)
+            # the space that joins it to the chunk counts
+            if current and current_bytes + 1 + size > max_bytes:
+                chunks.append(" ".join(current))
+                current, current_bytes = [], 0
+            current_bytes += size + (1 if current else 0)
+            current.append(piece)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def aggregate(results, sizes, method="mean"):
+    """Combine the classes of the chunks of a text into one list of classes.
+
+    results are the Classes lists of the chunks and sizes their lengths.
+    The score of a class is its mean over the chunks ("mean"), its highest
+    score ("max") or its mean weighted by the length of the chunks
+    ("weighted"); a chunk that does not list a class scores 0 for it. The
+    classes are sorted by descending score.
+    """
+    if method not in AGGREGATIONS:
+        raise ValueError("Unknown aggregation %r, expected one of %s" % (method, ", ".join(AGGREGATIONS)))
+    scores = {}
+    for classes, size in zip(results, sizes):
+        weight = size if method == "weighted" else 1
+        for entry in classes:
+            if method == "max":
+                scores[entry['Name']] = max(scores.get(entry['Name'], 0.0), entry['Score'])
+            else:
+                scores[entry['Name']] = scores.get(entry['Name'], 0.0) + weight * entry['Score']
+    if method != "max":
+        total = sum(sizes) if method == "weighted" else len(results)
+        scores = {name: score / total for name, score in scores.items()} if total else {}
+    return [{'Name': name, 'Score': score}
+            for name, score in sorted(scores.items(), key=lambda item: (-item[1], item[0]))]
@@ -0,0 +1,105 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import re
+
+
+# Training and inference normalize text with the same rules, so the model
+# sees at inference what it was trained on. TEXT_NORMALIZATION=off passes
+# text through (truncation still applies). VERSION is part of the ETL
+# configuration, bump it when the rules change so the training data is
+# regenerated.
+ENABLED = os.environ.get("TEXT_NORMALIZATION", "on").lower() != "off"
+VERSION = 1
+
+# Documents are truncated to TEXT_MAX_BYTES bytes of UTF-8, the per document
+# limit of the synchronous Amazon Comprehend APIs. Comprehend charges by the
+# character, noise that is not sent is not paid for.
+MAX_BYTES = int(os.environ.get("TEXT_MAX_BYTES", 10000))
+
+# Java stack frames ("at org.apache.Foo.bar(Foo.java:12)"): a run of frames is
+# compressed to the method of its first frame, which names the component
+_FRAMES = re.compile(r"(?:^[ \t]*at [\w$.<>/]+\([^)\n]*\)[ \t]*(?:\n|$))+", re.MULTILINE)
+_FRAME_METHOD = re.compile(r"at ([\w$.<>/]+)\(")
+_MORE_FRAMES = re.compile(r"^[ \t]*\.\.\. \d+ more[ \t]*$", re.MULTILINE)
+# URLs are reduced to their host
+_URL = re.compile(r"\b[a-zA-Z][a-zA-Z0-9+.-]*://([^/\s:?#]+)[^\s]*")
+# timestamps of log lines, hexadecimal ids and hashes, UUIDs
+_TIMESTAMP = re.compile(r"\b\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:[,.]\d+)?(?:Z|[+-]\d{2}:?\d{2})?")
+_IDS = re.compile(r"\b(?:0x[0-9a-fA-F]+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"
+                  r"|(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{16,})\b")
+# Jira and Markdown markup of code blocks and quotes, the content is kept
+_MARKUP = re.compile(r"\{(?:code|noformat|quote|panel)(?::[^}\n]*)?\}|```[\w-]*")
+# separator lines and other runs of punctuation
+_RULES = re.compile(r"([-=*_#~+.])\1{2,}")
+_WHITESPACE = re.compile(r"\s+")
+
+# text without any of these takes the fast path of whitespace folding only
+_NOISE = re.compile(r"\bat [\w$.<>/]+\(|\.\.\. \d+ more|://|\d{4}-\d{2}-\d{2}[ T]\d|0x|[0-9a-fA-F]{16}|"
+                    r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-|\{(?:code|noformat|quote|panel)|```|([-=*_#~+.])\1\1")
+
+
+def _first_frame(match):
+    return " " + _FRAME_METHOD.search(match.group(0)).group(1) + "\n"
+
+
+def truncate_utf8(text, max_bytes=None):
+    """Cut text to at most max_bytes bytes of UTF-8 without splitting a character."""
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    if len(text) * 4 <= max_bytes:
+        return text
+    encoded = text.encode("utf-8")
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode("utf-8", errors="ignore").rstrip()
+
+
+def normalize(text, max_bytes=None):
+    """Normalize the text of an issue or a request for the classifier.
+
+    Stack traces are compressed to their first frame, URLs to their host, and
+    markup, separator lines, timestamps and ids are dropped. Whitespace is
+    folded to single spaces and the result truncated to max_bytes bytes of
+    UTF-8 (default TEXT_MAX_BYTES).
+    """
+    if text is None:
+        return None
+    if ENABLED:
+        if _NOISE.search(text) is not None:
+            text = _FRAMES.sub(_first_frame, text)
+            text = _MORE_FRAMES.sub(" ", text)
+            text = _URL.sub(r"\1", text)
+            text = _TIMESTAMP.sub(" ", text)
+            text = _IDS.sub(" ", text)
+            text = _MARKUP.sub(" ", text)
+            text = _RULES.sub(" ", text)
+        text = _WHITESPACE.sub(" ", text).strip()
+    return truncate_utf8(text, max_bytes)
+
+
+def normalize_many(texts, max_bytes=None):
+    """normalize() over a batch of texts, e.g. the rows of a fetch.
+
+    Bound methods are looked up once per batch and texts without noise take
+    the fast path, the result is the same as normalize() on every text.
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    if not ENABLED:
+        return [None if text is None else truncate_utf8(text, max_bytes) for text in texts]
+    search, fold, full = _NOISE.search, _WHITESPACE.sub, normalize
+    normalized = []
+    for text in texts:
+        if text is None:
+            normalized.append(None)
+        elif search(text) is None:
+            text = fold(" ", text).strip()
+            normalized.append(text if len(text) * 4 <= max_bytes else truncate_utf8(text, max_bytes))
+        else:
+            normalized.append(full(text, max_bytes))
+    return normalized
+
+
+def config():
+    # the settings that shape normalized text, part of the ETL configuration
+    return {"normalization": VERSION if ENABLED else None, "max_bytes": MAX_BYTES}
@@ -9,6 +9,8 @@ import boto3
 import json
 import urllib.parse
 import logging
+import metrics
+import etl_stats
 
 
 logger = logging.getLogger()
@@ -18,6 +20,11 @@ s3 = boto3.resource("s3")
 comprehend = boto3.client("comprehend")
 sns = boto3.resource("sns")
 
+# What to do with a training set that etl_stats.check finds degenerate:
+# "refuse" does not start a training on errors, "warn" only logs them and
+# "off" skips the check
+TRAINING_DATA_CHECK = os.environ.get("TRAINING_DATA_CHECK", "refuse").lower()
+
 
 def _start_comprehend_job(bucket_name, comprehend_role_arn):
 
@@ -46,6 +53,33 @@ def _start_comprehend_job(bucket_name, comprehend_role_arn):
     
 
 
+def _dataset_stats(event):
+    # the training data statistics the ETL sends along, None without them
+    for record in event.get("Records", []):
+        attribute = record.get("Sns", {}).get("MessageAttributes", {}).get("dataset_stats")
+        if attribute is not None:
+            return json.loads(attribute["Value"])
+    return None
+
+
+def _check_training_data(stats):
+    # the errors that keep the training from starting
+    if TRAINING_DATA_CHECK == "off":
+        return []
+    if stats is None:
+        logger.warning("No training data statistics in the event, starting the training unchecked")
+        return []
+    issues = etl_stats.check(stats["classes"])
+    for issue in issues:
+        logger.warning("Training data %s%s: %s", issue["level"],
+                       " in " + issue["class"] if issue["class"] else "", issue["message"])
+    metrics.put("TrainingDataIssues", len(issues), "Count", "check")
+    if TRAINING_DATA_CHECK != "refuse":
+        return []
+    return [issue for issue in issues if issue["level"] == "error"]
+
+
+@metrics.handler
 def lambda_handler(event, context):
 
     logger.info("Received event notification from SNS Topic: " +
@@ -56,6 +90,21 @@ def lambda_handler(event, context):
     comprehend_role_arn = os.environ.get("COMPREHEND_DATA_ACCESS_ROLE_ARN")
     topic_arn = os.environ.get("TOPIC_ARN")
 
+    errors = _check_training_data(_dataset_stats(event))
+    if errors:
+        logger.error("Not starting the classifier training, the training data has %d errors", len(errors))
+        # without the event_type attribute the message starts nothing
+        sns.Topic(arn=topic_arn).publish(
+            Message='Amazon Comprehend classifier training not started, the training data has errors: ' +
+                    "; ".join((issue["class"] + ": " if issue["class"] else "") + issue["message"]
+                              for issue in errors)
+        )
+        return {
+            "event": event,
+            "status": "REFUSED",
+            "issues": errors,
+        }
+
     job = _start_comprehend_job(bucket_name, comprehend_role_arn)
     logger.info("Started Amazon Comprehend classifier training %s", job)
     sns.Topic(arn=topic_arn).publish(
@@ -0,0 +1,105 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import csv
+import codecs
+import json
+import boto3
+import logging
+import cascade_calibration
+import etl_manifest
+import local_model
+import metrics
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+s3 = boto3.resource("s3")
+
+# Rows of a class the local model is trained on, 0 for all. Bounds the
+# training time of very large classes.
+MAX_ROWS_PER_CLASS = int(os.environ.get("LOCAL_MODEL_MAX_ROWS_PER_CLASS", 10000))
+
+csv.field_size_limit(1024 * 1024)
+
+
+def _training_keys(bucket):
+    # the training data objects the ETL wrote last to prepped_data/, from its
+    # manifest; the derived datasets are not classes of the endpoint
+    manifest = etl_manifest.read_manifest(s3.meta.client, bucket) or {}
+    return sorted(key for key in manifest.get("outputs", [])
+                  if key.startswith("prepped_data/") and key.endswith(".csv"))
+
+
+def _rows(bucket, keys):
+
+    # streams the (label, text) rows of the training data CSVs, at most
+    # MAX_ROWS_PER_CLASS of every class
+    def rows():
+        class_rows = {}
+        for key in keys:
+            body = s3.meta.client.get_object(Bucket=bucket, Key=key)['Body']
+            for row in csv.reader(codecs.getreader("utf-8")(body)):
+                if len(row) < 2:
+                    continue
+                label, text = row[0], row[1]
+                if MAX_ROWS_PER_CLASS and class_rows.get(label, 0) >= MAX_ROWS_PER_CLASS:
+                    continue
+                class_rows[label] = class_rows.get(label, 0) + 1
+                yield label, text
+    return rows
+
+
+@metrics.handler
+def lambda_handler(event, context):
+
+    logger.info("Received event notification from SNS Topic: " + json.dumps(event))
+
+    bucket_name = os.environ.get("BUCKET_NAME")
+    keys = _training_keys(bucket_name)
+    if not keys:
+        logger.warning("No training data in s3://%s/prepped_data/, not training a local model", bucket_name)
+        return {"status": "SKIPPED"}
+
+    # the model is trained without the held-out split, which calibrates the
+    # confidence thresholds of the cascade
+    rows = _rows(bucket_name, keys)
+    try:
+        with metrics.timer("train"):
+            model = local_model.train(lambda: ((label, text) for label, text in rows()
+                                               if not cascade_calibration.held_out(text)))
+        with metrics.timer("calibrate"):
+            predictions = cascade_calibration.evaluate(
+                model, ((label, text) for label, text in rows() if cascade_calibration.held_out(text)))
+            thresholds = cascade_calibration.thresholds(predictions)
+            report = dict(cascade_calibration.tradeoff(predictions, thresholds),
+                          target_precision=cascade_calibration.TARGET_PRECISION, calibrated_thresholds=thresholds)
+        model.metadata["thresholds"] = thresholds
+        body = model.to_bytes()
+        s3.meta.client.put_object(Bucket=bucket_name, Key=local_model.MODEL_KEY, Body=body)
+        s3.meta.client.put_object(Bucket=bucket_name, Key=cascade_calibration.CALIBRATION_KEY,
+                                  Body=json.dumps(report, indent=2, sort_keys=True).encode("utf-8"),
+                                  ContentType="application/json")
+    except Exception as e:
+        logger.error("Exception (%s)", e)
+        raise e
+
+    metrics.put("LocalShare", report["calibrated"]["local_share"] * 100, "Percent", "calibrate")
+    logger.info("Cascade thresholds %s answer %.1f%% of the held-out rows locally with an accuracy of %s",
+                thresholds, report["calibrated"]["local_share"] * 100, report["calibrated"]["local_accuracy"])
+
+    metrics.put("Documents", model.metadata["rows"], "Count", "train")
+    metrics.put("ModelBytes", len(body), "Bytes", "train")
+    logger.info("Saved the local model to s3://%s/%s, %d bytes", bucket_name, local_model.MODEL_KEY, len(body))
+    return {
+        "status": "SUCCEEDED",
+        "key": local_model.MODEL_KEY,
+        "classes": model.classes,
+        "rows": model.metadata["rows"],
+        "bytes": len(body),
+        "held_out": report["held_out"],
+        "thresholds": thresholds,
+        "calibration": report["calibrated"],
+    }
@@ -6,6 +6,7 @@ import boto3
 import time
 import os
 import logging
+import metrics
 
 
 logger = logging.getLogger()
@@ -13,6 +14,7 @@ logger.setLevel(logging.INFO)
 
 comprehend = boto3.client("comprehend")
 
+@metrics.handler
 def is_complete(event, context):
 
     endpointarn = event["PhysicalResourceId"]
@@ -0,0 +1,324 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Benchmark of etl_lambda on synthetic SEOSS-shaped archives. Every scenario
+# runs the handler twice (a cold run on an empty bucket and a warm run on the
+# same archive) against the in-memory S3 and SNS stand-ins, in its own
+# process so that peak RSS is measured per scenario. The results are written
+# as JSON and can be compared with an earlier result file:
+#
+#   python -m tests.benchmark_etl --suite default --output etl_benchmark.json
+#   python -m tests.benchmark_etl --baseline etl_benchmark.json --tolerance 0.2
+#
+# Scenarios with ETL_MEMORY_BUDGET_MB keep the S3 objects on disk, so that
+# peak RSS is the memory of the ETL alone, and fail when it exceeds the
+# budget (the memory suite).
+
+import argparse
+import contextlib
+import datetime
+import hashlib
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from tests import synthetic_seoss
+from tests.stubs import DiskS3Client, FakeS3, FakeSNS
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas")
+BUCKET = "benchmark"
+KEY = "raw_data/raw.zip"
+RESULT_FORMAT = 1
+
+# Scenarios are generate_archive() arguments plus a name and the ETL_*
+# environment of the run
+SUITES = {
+    "quick": [
+        {"name": "projects5", "projects": 5, "rows": 300},
+        {"name": "projects5_shards", "projects": 5, "rows": 300, "env": {"ETL_OUTPUT": "shards"}},
+    ],
+    "default": [
+        {"name": "seoss33", "projects": 33, "rows": 2000, "skew": 1.0},
+        {"name": "seoss33_long_text", "projects": 33, "rows": 1000, "description_words": 400, "skew": 1.0},
+        {"name": "seoss33_dedup", "projects": 33, "rows": 2000, "skew": 1.0, "duplicate_rate": 0.05,
+         "env": {"ETL_DEDUP": "near"}},
+        {"name": "seoss33_shards", "projects": 33, "rows": 2000, "skew": 1.0, "env": {"ETL_OUTPUT": "shards"}},
+        {"name": "projects100", "projects": 100, "rows": 1000, "skew": 1.0},
+        {"name": "projects300", "projects": 300, "rows": 500, "skew": 1.0},
+    ],
+    "memory": [
+        {"name": "seoss33_512mb", "projects": 33, "rows": 2000, "skew": 1.0,
+         "env": {"ETL_MEMORY_BUDGET_MB": "512"}},
+        {"name": "seoss33_dedup_512mb", "projects": 33, "rows": 2000, "skew": 1.0, "duplicate_rate": 0.05,
+         "env": {"ETL_MEMORY_BUDGET_MB": "512", "ETL_DEDUP": "near", "ETL_SAMPLE_CAP": "1000"}},
+        {"name": "seoss33_shards_512mb", "projects": 33, "rows": 2000, "skew": 1.0,
+         "env": {"ETL_MEMORY_BUDGET_MB": "512", "ETL_OUTPUT": "shards", "ETL_DEDUP": "near"}},
+        {"name": "projects300_512mb", "projects": 300, "rows": 500, "skew": 1.0,
+         "env": {"ETL_MEMORY_BUDGET_MB": "512", "ETL_OUTPUT": "shards"}},
+    ],
+}
+
+
+class StageRecorder:
+    """Busy time, bytes and rows per ETL stage, summed over the worker threads."""
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, bytes_in=0, bytes_out=0, rows=0):
+        with self._lock:
+            counters = self.stages.setdefault(stage, {"calls": 0, "busy_seconds": 0.0, "bytes_in": 0,
+                                                      "bytes_out": 0, "rows": 0})
+            counters["calls"] += 1
+            counters["busy_seconds"] += seconds
+            counters["bytes_in"] += bytes_in
+            counters["bytes_out"] += bytes_out
+            counters["rows"] += rows
+
+    def report(self):
+        report = {}
+        for stage, counters in self.stages.items():
+            busy = counters["busy_seconds"]
+            report[stage] = dict(counters, mb_per_second=counters["bytes_out"] / busy / 2 ** 20 if busy else None)
+        return report
+
+
+def _timed(recorder, stage, function, measure):
+    # wrap an etl_lambda function, measure(args, result) returns the byte and
+    # row counts of a call
+    def wrapper(*args):
+        start = time.perf_counter()
+        before = measure(args, None)
+        result = function(*args)
+        counts = measure(args, result)
+        counts.update({k: v for k, v in before.items() if k not in counts})
+        recorder.record(stage, time.perf_counter() - start, **counts)
+        return result
+    return wrapper
+
+
+def _extract_counts(args, result):
+    if result is None:
+        return {"bytes_in": os.path.getsize(args[1])}
+    files = [result["local_file"]] + [d["local_file"] for d in result["derived"].values()]
+    return {"bytes_out": sum(os.path.getsize(f) for f in files), "rows": result["rows"]}
+
+
+@contextlib.contextmanager
+def _instrumented(etl_lambda, s3, sns, recorder):
+    patched = {
+        "s3": s3,
+        "sns": sns,
+        "_list_projects": _timed(recorder, "list", etl_lambda._list_projects,
+                                 lambda args, result: {"bytes_in": result[2]} if result else {}),
+        "_decompress_project": _timed(recorder, "decompress", etl_lambda._decompress_project,
+                                      lambda args, result: {"bytes_in": result[1]["fetched_bytes"],
+                                                            "bytes_out": result[1]["decompressed_bytes"]}
+                                      if result else {}),
+        "_extract_csv": _timed(recorder, "extract", etl_lambda._extract_csv, _extract_counts),
+        "_upload_file": _timed(recorder, "upload", etl_lambda._upload_file,
+                               lambda args, result: {"bytes_out": os.path.getsize(args[2])} if result is None else {}),
+    }
+    original = {name: getattr(etl_lambda, name) for name in patched}
+    for name, value in patched.items():
+        setattr(etl_lambda, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(etl_lambda, name, value)
+
+
+class _Context:
+    def __init__(self, request_id):
+        self.aws_request_id = request_id
+
+
+def _peak_rss_mb():
+    # VmHWM is the high-water mark of this process image. ru_maxrss carries
+    # over the RSS of the parent at fork time through exec, which is wrong
+    # for a scenario started from a large process like pytest.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_scenario(archive_path, work_dir):
+    """Run the ETL handler on the archive, cold and then warm, in this process.
+
+    etl_lambda reads its ETL_* configuration at import time, set the
+    environment before the first call.
+    """
+    if LAMBDAS_DIR not in sys.path:
+        sys.path.insert(0, LAMBDAS_DIR)
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    import etl_lambda
+
+    budget = etl_lambda.MEMORY_BUDGET_MB
+    s3, sns = FakeS3(DiskS3Client(os.path.join(work_dir, "s3")) if budget else None), FakeSNS()
+    s3.meta.client.put_file(BUCKET, KEY, archive_path)
+    result = {"archive_bytes": os.path.getsize(archive_path), "baseline_rss_mb": _peak_rss_mb(), "runs": {},
+              "memory_budget_mb": budget or None}
+
+    tiers = [("tmp", os.path.join(work_dir, "tmp"), False), ("efs", os.path.join(work_dir, "efs"), True)]
+    for sequencer, run in enumerate(("cold", "warm")):
+        # the warm run is a new upload of the same archive
+        event = {"Records": [{"s3": {"bucket": {"name": BUCKET},
+                                     "object": {"key": KEY, "sequencer": "%016X" % sequencer}}}]}
+        recorder = StageRecorder()
+        s3.meta.client.bytes_served = s3.meta.client.bytes_received = 0
+        with _instrumented(etl_lambda, s3, sns, recorder), \
+                _patched(etl_lambda, "SCRATCH_TIERS", tiers), \
+                _patched(etl_lambda, "MARKER_DIR", os.path.join(work_dir, "markers")):
+            start = time.perf_counter()
+            response = etl_lambda.lambda_handler(event, _Context("benchmark-" + run))["runs"][0]
+            wall = time.perf_counter() - start
+        manifest = json.loads(s3.meta.client.get(BUCKET, "etl_state/manifest.json"))
+        rows = manifest["distribution"]["total_rows"]
+        stages = recorder.report()
+        # uploads through multipart writers bypass _upload_file, count what S3 received
+        stages.setdefault("upload", {"calls": 0, "busy_seconds": 0.0, "bytes_in": 0, "rows": 0,
+                                     "mb_per_second": None})["bytes_out"] = s3.meta.client.bytes_received
+        result["runs"][run] = {
+            "wall_seconds": wall,
+            "rows": rows,
+            "rows_per_second": rows / wall,
+            "archive_mb_per_second": result["archive_bytes"] / wall / 2 ** 20,
+            "s3_bytes_read": s3.meta.client.bytes_served,
+            "changed_classes": len(response["changed_classes"]),
+            "scratch": response["scratch"],
+            "stages": stages,
+        }
+    result["peak_rss_mb"] = _peak_rss_mb()
+    result["within_budget"] = not budget or result["peak_rss_mb"] <= budget
+    return result
+
+
+@contextlib.contextmanager
+def _patched(module, name, value):
+    original = getattr(module, name)
+    setattr(module, name, value)
+    try:
+        yield
+    finally:
+        setattr(module, name, original)
+
+
+def _archive(scenario, cache_dir):
+    # archives are cached by their generator arguments, generating the large
+    # ones takes longer than the benchmark
+    params = {k: v for k, v in scenario.items() if k not in ("name", "env")}
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(cache_dir, "seoss-%s.zip" % digest)
+    if not os.path.exists(path):
+        synthetic_seoss.generate_archive(path + ".partial", **params)
+        os.replace(path + ".partial", path)
+    return path, params
+
+
+def _run_in_subprocess(scenario, archive_path, work_dir):
+    env = dict(os.environ, AWS_DEFAULT_REGION="us-east-1", **scenario.get("env", {}))
+    output = subprocess.run(
+        [sys.executable, "-m", "tests.benchmark_etl", "--run-scenario", archive_path, "--work-dir", work_dir],
+        env=env, cwd=os.path.join(LAMBDAS_DIR, ".."), check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode("utf-8").splitlines()[-1])
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              cwd=os.path.join(LAMBDAS_DIR, "..")).stdout.decode("utf-8").strip() or None
+    except OSError:
+        return None
+
+
+def run_suite(scenarios, cache_dir):
+    results = []
+    for scenario in scenarios:
+        archive_path, params = _archive(scenario, cache_dir)
+        with tempfile.TemporaryDirectory() as work_dir:
+            result = _run_in_subprocess(scenario, archive_path, work_dir)
+        result.update({"name": scenario["name"], "params": params, "env": scenario.get("env", {})})
+        cold = result["runs"]["cold"]
+        print("%-20s %8d rows %8.1f s %10.0f rows/s %8.1f MB peak RSS%s" % (
+            scenario["name"], cold["rows"], cold["wall_seconds"], cold["rows_per_second"], result["peak_rss_mb"],
+            "" if result["within_budget"] else ", over the budget of %d MB" % result["memory_budget_mb"]))
+        results.append(result)
+    return {
+        "format": RESULT_FORMAT,
+        "created": datetime.datetime.utcnow().isoformat() + "Z",
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "scenarios": results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the scenarios whose cold run throughput dropped by more than
+    tolerance (a fraction) compared to the baseline results."""
+    previous = {s["name"]: s for s in baseline["scenarios"]}
+    regressions = []
+    for scenario in results["scenarios"]:
+        before = previous.get(scenario["name"])
+        if before is None or before["params"] != scenario["params"]:
+            continue
+        ratio = scenario["runs"]["cold"]["rows_per_second"] / before["runs"]["cold"]["rows_per_second"]
+        if ratio < 1 - tolerance:
+            regressions.append({"name": scenario["name"], "ratio": ratio})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ETL function on synthetic SEOSS archives")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="default")
+    parser.add_argument("--scenario", action="append", help="run only the named scenarios of the suite")
+    parser.add_argument("--output", default="etl_benchmark.json")
+    parser.add_argument("--cache-dir", default=os.path.join(tempfile.gettempdir(), "seoss-benchmark"))
+    parser.add_argument("--baseline", help="earlier result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--run-scenario", metavar="ARCHIVE", help=argparse.SUPPRESS)
+    parser.add_argument("--work-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.run_scenario:
+        # child process of run_suite, the result is the last line of stdout
+        logging.getLogger().setLevel(logging.WARNING)
+        result = run_scenario(args.run_scenario, args.work_dir)
+        print(json.dumps(result))
+        return 0
+
+    scenarios = [s for s in SUITES[args.suite] if not args.scenario or s["name"] in args.scenario]
+    os.makedirs(args.cache_dir, exist_ok=True)
+    results = run_suite(scenarios, args.cache_dir)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=1)
+    print("Wrote %s" % args.output)
+
+    failed = [s["name"] for s in results["scenarios"] if not s["within_budget"]]
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression in %s: %.0f%% of the baseline throughput" % (regression["name"],
+                                                                           100 * regression["ratio"]))
+        failed += [regression["name"] for regression in regressions]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
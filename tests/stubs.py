@@ -0,0 +1,304 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# In-memory stand-ins for the boto3 resources used by the Lambda functions.
+# They implement just the calls the functions make.
+
+import io
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+import threading
+
+import botocore.exceptions
+
+
+class FakeS3Client:
+
+    def __init__(self):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.bytes_served = 0
+        self.get_requests = 0
+        self.uploads = {}
+        self.parts_uploaded = 0
+        self.bytes_received = 0
+
+    def put(self, bucket, key, body):
+        with self.lock:
+            self.objects[(bucket, key)] = bytes(body)
+
+    def put_file(self, bucket, key, filename):
+        with open(filename, "rb") as f:
+            body = f.read()
+        self.put(bucket, key, body)
+        return len(body)
+
+    def get(self, bucket, key, operation="GetObject"):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}}, operation)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        body = Body.encode("utf-8") if isinstance(Body, str) else Body
+        self.put(Bucket, Key, body)
+        with self.lock:
+            self.bytes_received += len(body)
+        return {}
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        with self.lock:
+            upload_id = "upload-%d" % (len(self.uploads) + 1)
+            self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+            self.parts_uploaded += 1
+            self.bytes_received += len(Body)
+        return {"ETag": '"%s-%d"' % (UploadId, PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        assert numbers == sorted(parts), "parts missing or out of order"
+        self.put(Bucket, Key, b"".join(parts[n] for n in numbers))
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.get(Bucket, Key, "HeadObject"))}
+
+    def get_object(self, Bucket, Key, Range=None):
+        body = self.get(Bucket, Key)
+        if Range is not None:
+            start, end = Range[len("bytes="):].split("-")
+            body = body[int(start):int(end) + 1]
+        with self.lock:
+            self.bytes_served += len(body)
+            self.get_requests += 1
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+
+class DiskS3Client(FakeS3Client):
+    """FakeS3Client that keeps objects and uploaded parts as files under root.
+
+    Used where the memory of the process is measured, so that only the
+    buffers of the code under test count. objects maps to the file paths.
+    """
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, *names):
+        return os.path.join(self.root, hashlib.sha256(repr(names).encode("utf-8")).hexdigest())
+
+    def put(self, bucket, key, body):
+        path = self._path(bucket, key)
+        with open(path, "wb") as f:
+            f.write(body)
+        with self.lock:
+            self.objects[(bucket, key)] = path
+
+    def put_file(self, bucket, key, filename):
+        path = self._path(bucket, key)
+        shutil.copyfile(filename, path)
+        with self.lock:
+            self.objects[(bucket, key)] = path
+        return os.path.getsize(path)
+
+    def _object_path(self, bucket, key, operation):
+        try:
+            return self.objects[(bucket, key)]
+        except KeyError:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}}, operation)
+
+    def get(self, bucket, key, operation="GetObject"):
+        with open(self._object_path(bucket, key, operation), "rb") as f:
+            return f.read()
+
+    def delete_object(self, Bucket, Key):
+        with self.lock:
+            path = self.objects.pop((Bucket, Key), None)
+        if path is not None:
+            os.remove(path)
+        return {}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        path = self._path(UploadId, PartNumber)
+        with open(path, "wb") as f:
+            f.write(Body)
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = path
+            self.parts_uploaded += 1
+            self.bytes_received += len(Body)
+        return {"ETag": '"%s-%d"' % (UploadId, PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        assert numbers == sorted(parts), "parts missing or out of order"
+        path = self._path(Bucket, Key)
+        with open(path, "wb") as dst:
+            for n in numbers:
+                with open(parts[n], "rb") as src:
+                    shutil.copyfileobj(src, dst)
+                os.remove(parts[n])
+        with self.lock:
+            self.objects[(Bucket, Key)] = path
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        for path in self.uploads.pop(UploadId, {}).values():
+            os.remove(path)
+        return {}
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": os.path.getsize(self._object_path(Bucket, Key, "HeadObject"))}
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = self._object_path(Bucket, Key, "GetObject")
+        with open(path, "rb") as f:
+            if Range is None:
+                body = f.read()
+            else:
+                start, end = Range[len("bytes="):].split("-")
+                f.seek(int(start))
+                body = f.read(int(end) + 1 - int(start))
+        with self.lock:
+            self.bytes_served += len(body)
+            self.get_requests += 1
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+
+class FakeBucket:
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def upload_file(self, filename, key, Config=None):
+        size = self.client.put_file(self.name, key, filename)
+        with self.client.lock:
+            self.client.bytes_received += size
+
+    def download_file(self, key, filename):
+        with open(filename, "wb") as f:
+            f.write(self.client.get(self.name, key))
+
+
+class FakeS3Meta:
+
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeS3:
+
+    def __init__(self, client=None):
+        self.meta = FakeS3Meta(client or FakeS3Client())
+
+    def Bucket(self, name):
+        return FakeBucket(self.meta.client, name)
+
+
+class FakeTopic:
+
+    def __init__(self, sns, arn):
+        self.sns = sns
+        self.arn = arn
+
+    def publish(self, **kwargs):
+        self.sns.messages.append(dict(kwargs, TopicArn=self.arn))
+        return {"MessageId": str(len(self.sns.messages))}
+
+
+class FakeSNS:
+
+    def __init__(self):
+        self.messages = []
+
+    def Topic(self, arn):
+        return FakeTopic(self, arn)
+
+
+class FakeLambdaClient:
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, InvocationType="RequestResponse", Payload=b""):
+        self.invocations.append({"FunctionName": FunctionName, "InvocationType": InvocationType,
+                                 "Payload": json.loads(Payload)})
+        return {"StatusCode": 202 if InvocationType == "Event" else 200}
+
+
+class FakeComprehendJobs:
+    """Runs Amazon Comprehend document classification jobs on a FakeS3Client.
+
+    run() classifies the ONE_DOC_PER_LINE input of a started job with
+    classify(text), which returns the classes or raises ValueError for an
+    error line, and writes the output archive the way Comprehend does.
+    """
+
+    def __init__(self, client, classify, account="123456789012"):
+        self.client = client
+        self.classify = classify
+        self.account = account
+        self.jobs = {}
+        self.tokens = {}
+
+    def start_document_classification_job(self, **kwargs):
+        token = kwargs.get("ClientRequestToken")
+        if token in self.tokens:
+            return self.jobs[self.tokens[token]]["response"]
+        job_id = "%032x" % (len(self.jobs) + 1)
+        response = {"JobId": job_id, "JobArn": "arn:document-classification-job/" + job_id,
+                    "JobStatus": "SUBMITTED"}
+        self.jobs[job_id] = {"request": kwargs, "response": response}
+        self.tokens[token] = job_id
+        return response
+
+    def run(self, job_id):
+        # returns the key of the output archive
+        request = self.jobs[job_id]["request"]
+        bucket, _, prefix = request["InputDataConfig"]["S3Uri"][len("s3://"):].partition("/")
+        lines = []
+        for (b, key), _ in sorted(self.client.objects.items()):
+            if b != bucket or not key.startswith(prefix):
+                continue
+            name = key[len(prefix):]
+            for number, text in enumerate(self.client.get(b, key).decode("utf-8").splitlines()):
+                try:
+                    lines.append({"File": name, "Line": number, "Classes": self.classify(text)})
+                except ValueError as e:
+                    lines.append({"File": name, "Line": number, "ErrorCode": "INTERNAL_SERVER_ERROR",
+                                  "ErrorMessage": str(e)})
+        # Comprehend does not keep the input order across files
+        lines.reverse()
+        predictions = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+            info = tarfile.TarInfo("predictions.jsonl")
+            info.size = len(predictions)
+            tar.addfile(info, io.BytesIO(predictions))
+        output = request["OutputDataConfig"]["S3Uri"][len("s3://"):].partition("/")[2]
+        key = "%s%s-CLN-%s/output/output.tar.gz" % (output, self.account, job_id)
+        self.client.put(bucket, key, archive.getvalue())
+        return key
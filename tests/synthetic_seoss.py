@@ -0,0 +1,167 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Synthetic data sets with the shape of SEOSS 33: a zip archive with one bz2
+# compressed SQLite database per project (<project>.sqlite3.bz2, with an
+# issue table) interleaved with other project artifacts. Used by the tests
+# and the ETL benchmark to grow the data set well beyond the 33 real projects.
+#
+#   python -m tests.synthetic_seoss raw_data.zip --projects 300 --rows 2000
+
+import argparse
+import bz2
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import zipfile
+
+ISSUE_COLUMNS = ("issue_id", "type", "priority", "status", "resolution", "summary", "description", "created_date")
+
+# issue types and their share of the issues, as in the Jira projects of SEOSS
+ISSUE_TYPES = (("Bug", 0.5), ("Improvement", 0.2), ("Task", 0.15), ("Sub-task", 0.1), ("New Feature", 0.05))
+PRIORITIES = ("Blocker", "Critical", "Major", "Minor", "Trivial")
+STATUSES = (("Closed", "Fixed"), ("Resolved", "Fixed"), ("Resolved", "Won't Fix"), ("Open", None))
+
+# Size of the blocks compressed into the archive, projects never have to fit
+# in memory
+_BLOCK_SIZE = 1024 * 1024
+# Fixed member timestamps keep the archive reproducible for a given seed
+_DATE_TIME = (2020, 1, 1, 0, 0, 0)
+_SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "ta", "vo", "zi", "pe", "su", "dra", "qui", "ben", "tor", "fla", "gis")
+
+
+def project_name(index):
+    return "project%03d" % index
+
+
+def _vocabulary(rng, size):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+
+def _project_sizes(projects, rows, skew):
+    # rows is the mean number of issues per project; with skew > 0 the sizes
+    # follow a power law like the real projects, which range from a few
+    # hundred to tens of thousands of issues
+    weights = [(i + 1) ** -skew for i in range(projects)]
+    mean = sum(weights) / projects
+    return [max(1, int(round(rows * w / mean))) for w in weights]
+
+
+def _text(rng, words, common, topic, topic_share):
+    count = max(1, int(words * rng.uniform(0.5, 1.5)))
+    return " ".join(rng.choice(topic) if rng.random() < topic_share else rng.choice(common)
+                    for _ in range(count))
+
+
+def issue_rows(rng, project, rows, common, summary_words=8, description_words=60,
+               topic_share=0.3, null_description_rate=0.05, duplicate_rate=0.0):
+    """Yield rows of the issue table of a project, in ISSUE_COLUMNS order.
+
+    Every project draws a share of its words from its own topic vocabulary so
+    that the classes can be told apart. duplicate_rate of the issues repeat
+    the summary and description of an earlier issue of the project.
+    """
+    topic = rng.sample(common, min(len(common), 24))
+    types = [t for t, _ in ISSUE_TYPES]
+    type_weights = [w for _, w in ISSUE_TYPES]
+    earlier = []
+    for i in range(rows):
+        if earlier and rng.random() < duplicate_rate:
+            summary, description = rng.choice(earlier)
+        else:
+            summary = _text(rng, summary_words, common, topic, topic_share)
+            description = None
+            if rng.random() >= null_description_rate:
+                description = _text(rng, description_words, common, topic, topic_share)
+            if len(earlier) < 1000:
+                earlier.append((summary, description))
+        status, resolution = rng.choice(STATUSES)
+        yield ("%s-%d" % (project.upper(), i + 1), rng.choices(types, type_weights)[0], rng.choice(PRIORITIES),
+               status, resolution, summary, description,
+               "20%02d-%02d-%02d" % (rng.randint(10, 20), rng.randint(1, 12), rng.randint(1, 28)))
+
+
+def write_project_db(path, rows):
+    """Write the issue rows to a new SQLite database and return the number of
+    rows the default ETL query keeps (bugs with a summary and description)."""
+    kept = 0
+
+    def counted():
+        nonlocal kept
+        for row in rows:
+            if row[1] == "Bug" and row[5] is not None and row[6] is not None:
+                kept += 1
+            yield row
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("CREATE TABLE issue (%s)" % ", ".join(c + " TEXT" for c in ISSUE_COLUMNS))
+        conn.executemany("INSERT INTO issue VALUES (%s)" % ", ".join("?" * len(ISSUE_COLUMNS)), counted())
+        conn.commit()
+    finally:
+        conn.close()
+    return kept
+
+
+def _write_bz2_member(zip_ref, name, source_path):
+    info = zipfile.ZipInfo(name, date_time=_DATE_TIME)
+    compressor = bz2.BZ2Compressor()
+    # the member is already bz2 compressed, SEOSS stores it as is
+    with open(source_path, "rb") as src, zip_ref.open(info, "w", force_zip64=True) as dst:
+        for block in iter(lambda: src.read(_BLOCK_SIZE), b""):
+            dst.write(compressor.compress(block))
+        dst.write(compressor.flush())
+
+
+def generate_archive(path, projects=33, rows=1000, summary_words=8, description_words=60,
+                     skew=0.0, duplicate_rate=0.0, artifact_bytes=4096, seed=0):
+    """Write a SEOSS-shaped archive to path.
+
+    Returns a description of the archive: its size and, per project, the
+    number of issues and the number of rows the default ETL query keeps.
+    """
+    rng = random.Random(seed)
+    common = _vocabulary(rng, 2000)
+    report = {"path": str(path), "projects": {}}
+    with tempfile.TemporaryDirectory() as tmp_dir, zipfile.ZipFile(path, "w") as zip_ref:
+        for index, size in enumerate(_project_sizes(projects, rows, skew)):
+            name = project_name(index)
+            db_path = os.path.join(tmp_dir, name + ".sqlite3")
+            project_rng = random.Random("%d:%s" % (seed, name))
+            kept = write_project_db(db_path, issue_rows(project_rng, name, size, common, summary_words,
+                                                        description_words, duplicate_rate=duplicate_rate))
+            _write_bz2_member(zip_ref, name + ".sqlite3.bz2", db_path)
+            os.remove(db_path)
+            # other artifacts of the project sit between the databases
+            artifact = " ".join(project_rng.choice(common) for _ in range(artifact_bytes // 6))
+            zip_ref.writestr(zipfile.ZipInfo(name + "_requirements.txt", date_time=_DATE_TIME),
+                             artifact[:artifact_bytes], compress_type=zipfile.ZIP_DEFLATED)
+            report["projects"][name] = {"issues": size, "bug_rows": kept}
+    report["bytes"] = os.path.getsize(path)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic SEOSS-shaped data set")
+    parser.add_argument("path", help="zip archive to write")
+    parser.add_argument("--projects", type=int, default=33)
+    parser.add_argument("--rows", type=int, default=1000, help="mean number of issues per project")
+    parser.add_argument("--summary-words", type=int, default=8)
+    parser.add_argument("--description-words", type=int, default=60)
+    parser.add_argument("--skew", type=float, default=0.0, help="power law exponent of the project sizes")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = generate_archive(args.path, args.projects, args.rows, args.summary_words, args.description_words,
+                              args.skew, args.duplicate_rate, seed=args.seed)
+    print(json.dumps(report, indent=1))
+
+
+if __name__ == "__main__":
+    main()
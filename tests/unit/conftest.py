@@ -0,0 +1,12 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import os
+import sys
+
+# The Lambda functions are deployed from the flat ./lambdas asset directory,
+# so make their modules importable the same way the Lambda runtime does.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "lambdas"))
+
+# boto3 clients are created at import time and need a region
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
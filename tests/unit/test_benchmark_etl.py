@@ -0,0 +1,57 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import bz2
+import sqlite3
+import zipfile
+
+from tests import benchmark_etl, synthetic_seoss
+
+
+def test_generated_archive_has_seoss_shape(tmp_path):
+    path = tmp_path / "raw_data.zip"
+    report = synthetic_seoss.generate_archive(path, projects=4, rows=100, skew=1.0, seed=7)
+
+    with zipfile.ZipFile(path) as zip_ref:
+        names = zip_ref.namelist()
+        db = bz2.decompress(zip_ref.read("project003.sqlite3.bz2"))
+    assert names[:2] == ["project000.sqlite3.bz2", "project000_requirements.txt"]
+    assert len(names) == 8
+    (tmp_path / "project003.sqlite3").write_bytes(db)
+    with sqlite3.connect(str(tmp_path / "project003.sqlite3")) as conn:
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(issue)")]
+        bugs = conn.execute("SELECT COUNT(*) FROM issue WHERE type = 'Bug' "
+                            "AND summary IS NOT NULL AND description IS NOT NULL").fetchone()[0]
+    conn.close()
+    assert tuple(columns) == synthetic_seoss.ISSUE_COLUMNS
+    assert bugs == report["projects"]["project003"]["bug_rows"]
+    # skewed project sizes, the same seed gives the same archive
+    sizes = [p["issues"] for p in report["projects"].values()]
+    assert sizes == sorted(sizes, reverse=True) and sum(sizes) == 400
+    synthetic_seoss.generate_archive(tmp_path / "again.zip", projects=4, rows=100, skew=1.0, seed=7)
+    assert (tmp_path / "again.zip").read_bytes() == path.read_bytes()
+
+
+def test_run_scenario_reports_stages(tmp_path):
+    path = tmp_path / "raw_data.zip"
+    report = synthetic_seoss.generate_archive(path, projects=3, rows=120)
+
+    result = benchmark_etl.run_scenario(str(path), str(tmp_path / "work"))
+
+    cold, warm = result["runs"]["cold"], result["runs"]["warm"]
+    assert cold["rows"] == sum(p["bug_rows"] for p in report["projects"].values())
+    assert cold["stages"]["decompress"]["calls"] == 3
+    assert cold["stages"]["extract"]["rows"] == cold["rows"]
+    assert cold["stages"]["upload"]["bytes_out"] > 0
+    assert cold["scratch"]["tmp"]["files"] == 6
+    assert warm["changed_classes"] == 0 and "decompress" not in warm["stages"]
+    assert result["peak_rss_mb"] >= result["baseline_rss_mb"] > 0
+
+
+def test_compare_flags_throughput_regressions():
+    def results(rows_per_second):
+        return {"scenarios": [{"name": "seoss33", "params": {"projects": 33},
+                               "runs": {"cold": {"rows_per_second": rows_per_second}}}]}
+
+    assert benchmark_etl.compare(results(90), results(100), 0.2) == []
+    assert benchmark_etl.compare(results(70), results(100), 0.2) == [{"name": "seoss33", "ratio": 0.7}]
@@ -0,0 +1,122 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import pytest
+
+import bulk_classify_lambda
+from tests.stubs import FakeComprehendJobs, FakeS3, FakeSNS
+
+BUCKET = "bucket"
+
+
+def _classify(text):
+    if "boom" in text:
+        raise ValueError("cannot classify")
+    return [{"Name": "HIVE" if "hive" in text else "HADOOP", "Score": 0.9}]
+
+
+@pytest.fixture
+def bulk(monkeypatch):
+    s3 = FakeS3()
+    jobs = FakeComprehendJobs(s3.meta.client, _classify)
+    monkeypatch.setattr(bulk_classify_lambda, "s3", s3)
+    monkeypatch.setattr(bulk_classify_lambda, "comprehend", jobs)
+    monkeypatch.setattr(bulk_classify_lambda, "sns", FakeSNS())
+    monkeypatch.setattr(bulk_classify_lambda, "SHARD_BYTES", 200)
+    monkeypatch.setenv("MODEL_ARN", "arn:document-classifier/model")
+    monkeypatch.setenv("TOPIC_ARN", "arn:topic")
+    return jobs
+
+
+def _event(key, etag="etag-1"):
+    return {"Records": [{"s3": {"bucket": {"name": BUCKET}, "object": {"key": key, "eTag": etag}}}]}
+
+
+def _request(jobs, run, tickets, etag="etag-1"):
+    body = "".join(json.dumps(ticket) + "\n" for ticket in tickets)
+    jobs.client.put(BUCKET, "bulk_requests/%s.jsonl" % run, body.encode("utf-8"))
+    return bulk_classify_lambda.lambda_handler(_event("bulk_requests/%s.jsonl" % run, etag), None)["results"][0]
+
+
+def _results(jobs, run):
+    body = jobs.client.get(BUCKET, "bulk_results/%s.jsonl" % run).decode("utf-8")
+    return {row["id"]: row for row in map(json.loads, body.splitlines())}
+
+
+def test_bulk_classification_joins_results_to_ticket_ids(bulk):
+    tickets = [{"id": "T-%d" % i, "text": "hive query %d fails\nafter upgrade" % i if i % 2 else "namenode %d" % i}
+               for i in range(40)]
+    tickets += [{"id": "T-boom", "text": "boom"}, {"id": "T-empty", "text": "  "}, {"id": 7, "text": None}]
+    submitted = _request(bulk, "nightly", tickets)
+
+    assert submitted["status"] == "SUBMITTED" and submitted["documents"] == 41
+    assert submitted["shards"] > 1 and submitted["rejected"] == 2
+    request = bulk.jobs[submitted["job_id"]]["request"]
+    assert request["InputDataConfig"] == {"S3Uri": "s3://bucket/bulk_input/nightly/", "InputFormat": "ONE_DOC_PER_LINE"}
+    assert request["DocumentClassifierArn"] == "arn:document-classifier/model"
+    # the shards hold the normalized text, one document per line
+    shard = bulk.client.get(BUCKET, "bulk_input/nightly/part-00000.txt").decode("utf-8")
+    assert shard.splitlines()[1] == "hive query 1 fails after upgrade"
+
+    collected = bulk_classify_lambda.lambda_handler(_event(bulk.run(submitted["job_id"])), None)["results"][0]
+
+    assert collected["status"] == "SUCCEEDED"
+    assert (collected["classified"], collected["errors"], collected["missing"], collected["rejected"]) == (40, 1, 0, 2)
+    results = _results(bulk, "nightly")
+    assert len(results) == len(tickets)
+    assert results["T-3"]["classes"] == [{"Name": "HIVE", "Score": 0.9}]
+    assert results["T-4"]["classes"] == [{"Name": "HADOOP", "Score": 0.9}]
+    assert results["T-boom"]["error"]["code"] == "INTERNAL_SERVER_ERROR"
+    assert results["T-empty"]["error"]["code"] == results[7]["error"]["code"] == "EmptyText"
+    message = bulk_classify_lambda.sns.messages[-1]
+    assert message["MessageAttributes"]["event_type"]["StringValue"] == "Bulk classification completed"
+
+
+def test_duplicate_request_events_start_one_job(bulk):
+    tickets = [{"id": i, "text": "ticket %d" % i} for i in range(5)]
+    first = _request(bulk, "run", tickets)
+    again = bulk_classify_lambda.lambda_handler(_event("bulk_requests/run.jsonl"), None)["results"][0]
+
+    assert again["status"] == "DUPLICATE" and again["job_id"] == first["job_id"]
+    assert len(bulk.jobs) == 1
+
+
+def test_duplicate_output_events_publish_once(bulk):
+    submitted = _request(bulk, "run", [{"id": i, "text": "ticket %d" % i} for i in range(5)])
+    event = _event(bulk.run(submitted["job_id"]))
+
+    first = bulk_classify_lambda.lambda_handler(event, None)["results"][0]
+    results = bulk.client.get(BUCKET, "bulk_results/run.jsonl")
+    again = bulk_classify_lambda.lambda_handler(event, None)["results"][0]
+
+    assert first["status"] == "SUCCEEDED" and again["status"] == "DUPLICATE"
+    assert again["results"] == first["results"] == "bulk_results/run.jsonl"
+    assert len(bulk_classify_lambda.sns.messages) == 1
+    assert bulk.client.get(BUCKET, "bulk_results/run.jsonl") == results
+
+
+def test_output_of_a_superseded_job_is_ignored(bulk):
+    first = _request(bulk, "run", [{"id": i, "text": "ticket %d" % i} for i in range(30)])
+    second = _request(bulk, "run", [{"id": "only", "text": "hive"}], etag="etag-2")
+    # the shards of the first request are gone, the new job reads one
+    assert [key for _, key in bulk.client.objects if key.startswith("bulk_input/")] == \
+        ["bulk_input/run/part-00000.txt"]
+
+    stale = bulk_classify_lambda.lambda_handler(_event(bulk.run(first["job_id"])), None)["results"][0]
+    assert stale["status"] == "STALE"
+    current = bulk_classify_lambda.lambda_handler(_event(bulk.run(second["job_id"])), None)["results"][0]
+    assert current["status"] == "SUCCEEDED"
+    assert list(_results(bulk, "run")) == ["only"]
+
+
+def test_tickets_without_a_prediction_are_reported(bulk, monkeypatch):
+    submitted = _request(bulk, "run", [{"id": i, "text": "ticket %d" % i} for i in range(3)])
+    output_key = bulk.run(submitted["job_id"])
+    # an archive with the predictions of no file
+    monkeypatch.setattr(bulk_classify_lambda, "_predictions", lambda body: iter(()))
+
+    collected = bulk_classify_lambda.lambda_handler(_event(output_key), None)["results"][0]
+    assert collected["missing"] == 3
+    assert {row["error"]["code"] for row in _results(bulk, "run").values()} == {"NoPrediction"}
@@ -0,0 +1,57 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import csv
+import json
+
+import pytest
+
+import cascade_calibration
+
+
+def test_thresholds_reach_the_target_precision():
+    # HADOOP is right above 0.8 and wrong below, HIVE is never precise enough
+    predictions = [("HADOOP", "HADOOP", 0.9 + i / 1000) for i in range(30)] + \
+                  [("HIVE", "HADOOP", 0.7), ("SPARK", "HADOOP", 0.6)] + \
+                  [("HADOOP", "HIVE", 0.99)] * 5 + [("HIVE", "HIVE", 0.9)] * 20 + \
+                  [("SPARK", "SPARK", 0.9)] * 3
+
+    thresholds = cascade_calibration.thresholds(predictions, target_precision=0.95, min_support=20)
+
+    assert thresholds["HADOOP"] == pytest.approx(0.7)
+    assert thresholds["HIVE"] is None
+    # too few predictions to calibrate
+    assert thresholds["SPARK"] is None
+
+
+def test_tradeoff_reports_calls_saved_and_accuracy():
+    predictions = [("A", "A", 0.95)] * 6 + [("B", "A", 0.85)] * 2 + [("B", "B", 0.55)] * 2
+    report = cascade_calibration.tradeoff(predictions, {"A": 0.9, "B": None}, grid=(0.5, 0.8, 0.9))
+
+    assert report["accuracy"] == 0.8
+    assert [row["local_share"] for row in report["thresholds"]] == [1.0, 0.8, 0.6]
+    assert [row["local_accuracy"] for row in report["thresholds"]] == [0.8, 0.75, 1.0]
+    assert report["calibrated"] == {"local_share": 0.6, "local_accuracy": 1.0, "local_errors": 0, "error_share": 0.0}
+
+
+def test_held_out_split_is_stable():
+    texts = ["ticket %d" % i for i in range(2000)]
+    held = [text for text in texts if cascade_calibration.held_out(text, 0.1)]
+    assert 150 < len(held) < 250
+    assert held == [text for text in texts if cascade_calibration.held_out(text, 0.1)]
+
+
+def test_tradeoff_report_tool(tmp_path, capsys):
+    path = tmp_path / "train.csv"
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        for i in range(400):
+            writer.writerow(("HADOOP", "namenode block replication %d" % i))
+            writer.writerow(("HIVE", "metastore query partition %d" % i))
+    output = tmp_path / "report.json"
+
+    assert cascade_calibration.main([str(path), "--output", str(output), "--min-support", "5"]) == 0
+
+    report = json.loads(output.read_text())
+    assert report["held_out"] > 0 and report["calibrated_thresholds"]["HADOOP"] is not None
+    assert "calls saved" in capsys.readouterr().out
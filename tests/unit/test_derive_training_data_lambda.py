@@ -0,0 +1,120 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import derive_training_data_lambda
+import etl_lambda
+import etl_query
+import etl_scratch
+from tests import synthetic_seoss
+from tests.stubs import FakeS3, FakeSNS
+
+SPEC = {"issue_types": ["Bug", "Improvement"], "label": "project",
+        "filters": [{"column": "priority", "op": "in", "value": ["Blocker", "Critical", "Major"]}],
+        "derived": [{"name": "task", "issue_types": ["Task"], "label": "issue_type"}]}
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(etl_lambda, "s3", fake)
+    monkeypatch.setattr(derive_training_data_lambda, "s3", fake)
+    return fake
+
+
+def _etl(tmp_path, monkeypatch, spec=None, cap=0, dedup="off"):
+    datasets = etl_query.load_spec(json.dumps(spec) if spec else None)
+    monkeypatch.setattr(etl_lambda, "QUERY_SPEC", datasets)
+    monkeypatch.setattr(etl_lambda, "QUERY", etl_query.CompiledQuery(datasets))
+    monkeypatch.setattr(etl_lambda, "PRIMARY_QUERY", etl_query.CompiledQuery(datasets[:1]))
+    monkeypatch.setattr(etl_lambda, "SAMPLE_CAP", cap)
+    monkeypatch.setattr(etl_lambda, "DEDUP_MODE", dedup)
+    with etl_scratch.ScratchSpace([("tmp", str(tmp_path / "scratch"), False)]) as scratch:
+        return etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+
+def _training_data(s3):
+    return {key: body for (_, key), body in s3.meta.client.objects.items()
+            if key.startswith(("prepped_data/", "derived_data/", "etl_state/manifest"))}
+
+
+def test_derived_training_data_matches_an_etl_run(tmp_path, monkeypatch, s3):
+    synthetic_seoss.generate_archive(tmp_path / "raw.zip", projects=3, rows=300, duplicate_rate=0.1)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", (tmp_path / "raw.zip").read_bytes())
+    monkeypatch.setattr(etl_lambda, "CORPUS_CACHE", True)
+    _etl(tmp_path, monkeypatch)
+    # the archive is not needed to derive a training set
+    s3.meta.client.delete_object(Bucket="bucket", Key="raw_data/raw.zip")
+
+    results = derive_training_data_lambda.derive("bucket", derive_training_data_lambda._settings(
+        {"query_spec": SPEC, "sample_cap": 60, "dedup": "near"}))
+
+    assert all(results["classes"].values())
+    assert sorted(results["changed"]) == ["PROJECT000", "PROJECT001", "PROJECT002"]
+    derived = _training_data(s3)
+
+    # an ETL run with the same settings finds the training data up to date
+    s3.meta.client.put("bucket", "raw_data/raw.zip", (tmp_path / "raw.zip").read_bytes())
+    etl_results = _etl(tmp_path, monkeypatch, SPEC, cap=60, dedup="near")
+    assert etl_results["classes"] == results["classes"]
+    assert etl_results["changed"] == []
+    manifest = json.loads(derived.pop("etl_state/manifest.json"))
+    etl_manifest = json.loads(_training_data(s3).pop("etl_state/manifest.json"))
+    assert {k: v for k, v in _training_data(s3).items() if k != "etl_state/manifest.json"} == derived
+    assert manifest["members"] == etl_manifest["members"]
+
+
+def test_derive_without_corpus_cache_fails(monkeypatch, s3):
+    with pytest.raises(Exception):
+        derive_training_data_lambda.derive("bucket", derive_training_data_lambda._settings({}))
+
+
+def test_handler_notifies_training(tmp_path, monkeypatch, s3):
+    sns = FakeSNS()
+    monkeypatch.setattr(derive_training_data_lambda, "sns", sns)
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    monkeypatch.setenv("TOPIC_ARN", "arn:topic")
+    monkeypatch.setattr(derive_training_data_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    synthetic_seoss.generate_archive(tmp_path / "raw.zip", projects=2, rows=50)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", (tmp_path / "raw.zip").read_bytes())
+    monkeypatch.setattr(etl_lambda, "CORPUS_CACHE", True)
+    _etl(tmp_path, monkeypatch)
+
+    response = derive_training_data_lambda.lambda_handler({"sample_cap": 5}, None)
+
+    assert response["status"] == "SUCCEEDED" and response["classes"] == {"PROJECT000": 5, "PROJECT001": 5}
+    assert "MessageAttributes" in sns.messages[-1]
+    # the same settings again change nothing
+    derive_training_data_lambda.lambda_handler({"sample_cap": 5}, None)
+    assert "MessageAttributes" not in sns.messages[-1]
+
+
+def test_handler_waits_for_the_etl_run_of_the_bucket(tmp_path, monkeypatch, s3):
+    sns = FakeSNS()
+    monkeypatch.setattr(derive_training_data_lambda, "sns", sns)
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    monkeypatch.setattr(derive_training_data_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    monkeypatch.setattr(derive_training_data_lambda, "LOCK_WAIT", 0)
+    monkeypatch.setattr(derive_training_data_lambda, "BUCKET_LOCK_POLL", 0)
+    # the lock an ETL run of the bucket holds, in another process
+    lock = etl_lambda.etl_marker.bucket_lock(str(tmp_path / "markers"), "bucket")
+    os.makedirs(lock.directory)
+    holder = subprocess.Popen([sys.executable, "-c", "import fcntl, sys, time\n"
+                               "f = open(sys.argv[1], 'w'); fcntl.lockf(f, fcntl.LOCK_EX)\n"
+                               "print('locked', flush=True); time.sleep(30)", lock.lock_path],
+                              stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline() == b"locked\n"
+        with pytest.raises(RuntimeError):
+            derive_training_data_lambda.lambda_handler({}, None)
+    finally:
+        holder.kill()
+        holder.wait()
+
+    assert sns.messages == [] and s3.meta.client.get_requests == 0
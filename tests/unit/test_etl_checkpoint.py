@@ -0,0 +1,66 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import etl_checkpoint
+from tests.stubs import FakeS3Client
+
+
+def _stored(client, run="run"):
+    return json.loads(client.get("bucket", etl_checkpoint.checkpoint_key(run)))
+
+
+def test_load_resumes_only_the_same_run_and_config():
+    client = FakeS3Client()
+    checkpoint = etl_checkpoint.Checkpoint.load(client, "bucket", "s3://bucket/raw.zip#a", "config")
+    checkpoint.done("p.sqlite3.bz2", {"class_name": "P"})
+    checkpoint.save(force=True)
+
+    again = etl_checkpoint.Checkpoint.load(client, "bucket", "s3://bucket/raw.zip#a", "config")
+    assert again.members == {"p.sqlite3.bz2": {"class_name": "P"}}
+    assert again.state["invocations"] == 2
+    assert again.state["run_id"] == checkpoint.state["run_id"]
+    assert etl_checkpoint.Checkpoint.load(client, "bucket", "s3://bucket/raw.zip#b", "config").members == {}
+    assert etl_checkpoint.Checkpoint.load(client, "bucket", "s3://bucket/raw.zip#a", "other").members == {}
+
+
+def test_runs_of_other_archives_keep_their_checkpoints():
+    client = FakeS3Client()
+    for run in ("s3://bucket/raw_data/a.zip#1", "s3://bucket/raw_data/b.zip#1"):
+        checkpoint = etl_checkpoint.Checkpoint.load(client, "bucket", run, "config")
+        checkpoint.done(run, {"class_name": "P"})
+        checkpoint.save(force=True)
+
+    for run in ("s3://bucket/raw_data/a.zip#1", "s3://bucket/raw_data/b.zip#1"):
+        assert list(etl_checkpoint.Checkpoint.load(client, "bucket", run, "config").members) == [run]
+        assert _stored(client, run)["run"] == run
+
+
+def test_saves_are_coalesced(monkeypatch):
+    client = FakeS3Client()
+    now = [100.0]
+    monkeypatch.setattr(etl_checkpoint.time, "monotonic", lambda: now[0])
+    checkpoint = etl_checkpoint.Checkpoint(etl_checkpoint.new_checkpoint("run", "config"), client, "bucket",
+                                           interval=5)
+
+    checkpoint.stage("a", etl_checkpoint.DECOMPRESSED, files={})
+    assert ("bucket", etl_checkpoint.checkpoint_key("run")) not in client.objects
+    now[0] += 6
+    checkpoint.stage("b", etl_checkpoint.DECOMPRESSED, files={})
+    assert sorted(_stored(client)["stages"]) == ["a", "b"]
+    checkpoint.done("a", {})
+    assert "a" in _stored(client)["stages"]
+    checkpoint.save(force=True)
+    assert "a" not in _stored(client)["stages"]
+
+
+def test_resume_drops_progress_with_missing_files(tmp_path):
+    checkpoint = etl_checkpoint.Checkpoint(etl_checkpoint.new_checkpoint("run", "config"))
+    (tmp_path / "a.csv").write_bytes(b"12345")
+    checkpoint.stage("a", etl_checkpoint.EXTRACTED, files={str(tmp_path / "a.csv"): 5})
+    checkpoint.stage("b", etl_checkpoint.EXTRACTED, files={str(tmp_path / "b.csv"): 5})
+
+    assert checkpoint.resume("a")["stage"] == etl_checkpoint.EXTRACTED
+    assert checkpoint.resume("b") is None and "b" not in checkpoint.state["stages"]
+    assert etl_checkpoint.Deadline().expired() is False
@@ -0,0 +1,90 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import json
+import random
+import sqlite3
+
+import pytest
+
+import etl_corpus
+import etl_query
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    rng = random.Random(3)
+    path = str(tmp_path / "hadoop.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE issue (type TEXT, summary TEXT, description TEXT, priority TEXT, "
+                 "votes INTEGER, score REAL, created_date TEXT)")
+    conn.executemany("INSERT INTO issue VALUES (?, ?, ?, ?, ?, ?, ?)", [
+        (rng.choice(["Bug", "Bug", "Task", "Improvement", None]),
+         rng.choice(["crash", "Leak  ", "héllo wörld", "100% cpu", None]),
+         rng.choice(["on start", "in rpc", "", None, "trace\nline"]),
+         rng.choice(["Major", "Minor", "Critical", None]),
+         rng.choice([0, 3, 12, None]),
+         rng.choice([0.5, 2.25, None]),
+         "20%02d-01-%02d" % (rng.randint(10, 20), rng.randint(1, 28)))
+        for _ in range(500)])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def _corpus(db_path, row_group_rows=64):
+    conn = etl_query.open_readonly(db_path)
+    f = io.BytesIO()
+    try:
+        rows, size = etl_corpus.write_corpus(conn, f, row_group_rows, metadata={"class_name": "HADOOP"},
+                                             fetch_size=50)
+    finally:
+        conn.close()
+    assert size == len(f.getvalue())
+    return etl_corpus.CorpusReader(io.BytesIO(f.getvalue())), rows
+
+
+def test_corpus_round_trips_the_issue_table(db_path):
+    reader, rows = _corpus(db_path)
+
+    conn = sqlite3.connect(db_path)
+    expected = conn.execute("SELECT * FROM issue").fetchall()
+    conn.close()
+    assert rows == reader.rows == 500 and len(reader.row_groups) == 8
+    assert reader.metadata == {"class_name": "HADOOP"}
+    columns = [[v for group in range(len(reader.row_groups)) for v in reader.read_column(group, name).to_list()]
+               for name in reader.columns]
+    assert list(zip(*columns)) == expected
+    kinds = {name: chunk["kind"] for name, chunk in reader.row_groups[0]["chunks"].items()}
+    assert kinds["type"] == "dict" and kinds["votes"] == "int" and kinds["score"] == "real"
+
+
+@pytest.mark.parametrize("spec", [
+    None,
+    {"issue_types": ["Bug", "Task"], "require_all": False, "label": "issue_type", "label_map": {"Task": None},
+     "filters": [{"column": "votes", "op": ">=", "value": "3"}, {"column": "summary", "op": "like", "value": "%E%"}]},
+    {"issue_types": [], "columns": ["summary", "votes", "score"], "label": {"column": "priority"},
+     "filters": [{"column": "priority", "op": "not_in", "value": ["Minor"]},
+                 {"column": "created_date", "op": "<", "value": "2015"},
+                 {"column": "description", "op": "not_null"}],
+     "derived": [{"name": "task", "issue_types": ["Task"], "columns": ["description"]},
+                 {"name": "scored", "issue_types": [], "filters": [{"column": "score", "op": "=", "value": 0.5}],
+                  "require_all": False}]},
+])
+def test_corpus_rows_match_the_sqlite_query(db_path, spec):
+    datasets = etl_query.load_spec(json.dumps(spec) if spec else None)
+    conn = etl_query.open_readonly(db_path)
+    expected = list(etl_query.iter_rows(conn, etl_query.CompiledQuery(datasets), "HADOOP"))
+    conn.close()
+    reader, _ = _corpus(db_path)
+
+    assert list(etl_corpus.iter_rows(reader, datasets, "HADOOP")) == expected
+    assert len(expected) > 10
+
+
+def test_unknown_column_is_a_spec_error(db_path):
+    reader, _ = _corpus(db_path)
+    datasets = etl_query.load_spec(json.dumps({"columns": ["summary", "body"]}))
+    with pytest.raises(etl_query.QuerySpecError):
+        list(etl_corpus.iter_rows(reader, datasets, "HADOOP"))
@@ -0,0 +1,72 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import csv
+
+import etl_dedup
+
+BASE = ("NameNode fails to start after upgrade because the edit log contains an "
+        "unknown opcode and the secondary namenode checkpoint is rejected with an "
+        "IOException while loading the fsimage from the shared storage directory")
+
+
+def _write(path, class_name, texts):
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows((class_name, text) for text in texts)
+    return str(path)
+
+
+def _read(path):
+    with open(path, newline="") as f:
+        return [row[1] for row in csv.reader(f)]
+
+
+def test_minhash_similarity_tracks_overlap():
+    near = BASE.replace("unknown opcode", "unexpected opcode")
+    other = "Drools rule engine ignores salience when agenda groups are activated from a listener"
+    assert etl_dedup.similarity(etl_dedup.minhash(BASE), etl_dedup.minhash(BASE.upper())) == 1.0
+    assert etl_dedup.similarity(etl_dedup.minhash(BASE), etl_dedup.minhash(near)) > 0.6
+    assert etl_dedup.similarity(etl_dedup.minhash(BASE), etl_dedup.minhash(other)) < 0.2
+
+
+def test_deduplicate_removes_within_and_across_classes(tmp_path):
+    hadoop = _write(tmp_path / "hadoop.csv", "HADOOP", [
+        BASE,
+        "  " + BASE.lower() + " ",                     # exact after normalization
+        BASE + " on the standby node",                 # near duplicate
+        "Balancer never finishes on clusters with heterogeneous storage",
+        "Shared template text filed in both trackers by the release bot",
+    ])
+    hive = _write(tmp_path / "hive.csv", "HIVE", [
+        "Shared template text filed in both trackers by the release bot",
+        "Vectorized group by returns wrong results for decimal keys",
+    ])
+
+    report = etl_dedup.deduplicate({"HIVE": hive, "HADOOP": hadoop}, threshold=0.7)
+
+    assert _read(hadoop) == [BASE, "Balancer never finishes on clusters with heterogeneous storage"]
+    assert _read(hive) == ["Vectorized group by returns wrong results for decimal keys"]
+    assert report["HADOOP"] == {"rows": 5, "exact": 1, "near": 1, "cross_label": 1, "removed": 3, "kept": 2}
+    assert report["HIVE"] == {"rows": 2, "exact": 0, "near": 0, "cross_label": 1, "removed": 1, "kept": 1}
+
+
+def test_exact_mode_keeps_near_duplicates(tmp_path):
+    path = _write(tmp_path / "hadoop.csv", "HADOOP", [BASE, BASE + " on the standby node"])
+    report = etl_dedup.deduplicate({"HADOOP": path}, near=False)
+    assert report["HADOOP"]["kept"] == 2
+
+
+def test_index_on_disk_matches_index_in_memory(tmp_path):
+    texts = [BASE, BASE.upper(), BASE + " on the standby node", "Balancer never finishes", BASE]
+    labels = ["HADOOP", "HADOOP", "HADOOP", "HDFS", "HDFS"]
+    in_memory = etl_dedup.Deduplicator(threshold=0.7)
+    on_disk = etl_dedup.Deduplicator(threshold=0.7, index_path=str(tmp_path / "index.sqlite3"))
+
+    reasons = [(in_memory.add(("c", i), label, text), on_disk.add(("c", i), label, text))
+               for i, (label, text) in enumerate(zip(labels, texts))]
+    on_disk.close()
+
+    assert reasons == [(None, None), ("exact", "exact"), ("near", "near"), (None, None),
+                       ("cross_label", "cross_label")]
+    assert in_memory.conflicts == on_disk.conflicts == {("c", 0)}
+    assert not (tmp_path / "index.sqlite3").exists()
@@ -0,0 +1,684 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import bz2
+import errno
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+import etl_lambda
+import etl_query
+import etl_scratch
+from tests.stubs import FakeLambdaClient, FakeS3, FakeSNS
+
+
+def _make_sqlite(path, rows):
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE issue (type TEXT, summary TEXT, description TEXT)")
+        conn.executemany("INSERT INTO issue VALUES (?, ?, ?)", rows)
+    conn.close()
+
+
+def _make_archive(path, projects, extra=b"not a database"):
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        for name, rows in projects.items():
+            db_path = str(path) + "." + name
+            _make_sqlite(db_path, rows)
+            with open(db_path, "rb") as f:
+                zip_ref.writestr(name + ".sqlite3.bz2", bz2.compress(f.read()))
+            # the SEOSS archive interleaves the databases with other artifacts
+            zip_ref.writestr(name + "_requirements.txt", extra)
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _projects(count, rows):
+    return {
+        "project%02d" % p: [("Bug" if i % 3 else "Task", "crash %d in %d" % (i, p), "trace " * (i % 50))
+                            for i in range(rows)]
+        for p in range(count)
+    }
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(etl_lambda, "s3", fake)
+    return fake
+
+
+@pytest.fixture
+def sns(monkeypatch):
+    fake = FakeSNS()
+    monkeypatch.setattr(etl_lambda, "sns", fake)
+    return fake
+
+
+def test_bz2_chunks_handles_multiple_streams(monkeypatch):
+    monkeypatch.setattr(etl_lambda, "CHUNK_SIZE", 7)
+    payload = bz2.compress(b"a" * 100) + bz2.compress(b"b" * 50)
+
+    class Source:
+        def __init__(self, data):
+            self.data = data
+
+        def read(self, n):
+            chunk, self.data = self.data[:n], self.data[n:]
+            return chunk
+
+    chunks = list(etl_lambda._bz2_chunks(Source(payload)))
+    assert b"".join(chunks) == b"a" * 100 + b"b" * 50
+    assert max(len(c) for c in chunks) <= 7
+
+
+@pytest.fixture
+def scratch(tmp_path):
+    with etl_scratch.ScratchSpace([("tmp", str(tmp_path / "tmp"), False), ("efs", str(tmp_path / "efs"), True)],
+                                  run_id="test") as scratch:
+        yield scratch
+
+
+def _scratch_files(scratch):
+    return sorted(name for tier in scratch.tiers for name in os.listdir(tier["dir"]))
+
+
+def test_decompress_project_streams_member(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "CHUNK_SIZE", 4096)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(2, 200)))
+
+    size, members, _ = etl_lambda._list_projects("bucket", "raw_data/raw.zip")
+    db_path, stats = etl_lambda._decompress_project("bucket", "raw_data/raw.zip", size, "project00.sqlite3.bz2",
+                                                    members["project00.sqlite3.bz2"][0], scratch, 0)
+
+    assert db_path == str(tmp_path / "tmp" / "etl-run-test" / "project00.sqlite3")
+    assert stats["scratch_tier"] == "tmp"
+    assert stats["decompressed_bytes"] == os.path.getsize(db_path)
+    assert scratch.report()["tmp"] == {"bytes_written": stats["decompressed_bytes"], "files": 1}
+    assert stats["peak_rss_mb"] > 0
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM issue").fetchone()[0] == 200
+    conn.close()
+
+
+def test_pipeline_output_matches_sequential(tmp_path, monkeypatch, s3):
+    projects = _projects(6, 120)
+    outputs = {}
+    for workers in (1, 4):
+        for name in ("DECOMPRESS_WORKERS", "EXTRACT_WORKERS", "UPLOAD_WORKERS"):
+            monkeypatch.setattr(etl_lambda, name, workers)
+        local_dir = tmp_path / str(workers)
+        local_dir.mkdir()
+        s3.meta.client.objects.clear()
+        s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(local_dir / "raw_data.zip", projects))
+
+        with etl_scratch.ScratchSpace([("tmp", str(local_dir), False)]) as scratch:
+            results = etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+        assert results["classes"] == {name.upper(): 80 for name in projects}
+        outputs[workers] = {key: body for (_, key), body in s3.meta.client.objects.items()
+                            if key.startswith("prepped_data/")}
+
+    assert sorted(outputs[4]) == ["prepped_data/project%02d.csv" % p for p in range(6)]
+    assert outputs[1] == outputs[4]
+
+
+def test_pipeline_fetches_only_project_members(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "RANGE_BLOCK_SIZE", 64 * 1024)
+    noise = os.urandom(256 * 1024)
+    archive = _make_archive(tmp_path / "raw_data.zip", _projects(3, 50), extra=noise)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", archive)
+    with zipfile.ZipFile(tmp_path / "raw_data.zip") as zip_ref:
+        project_bytes = sum(m.compress_size for m in zip_ref.infolist() if m.filename.endswith(".bz2"))
+
+    etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+    served = s3.meta.client.bytes_served
+    assert served >= project_bytes
+    # the three requirements members are never transferred
+    assert served < len(archive) - 3 * len(noise) + 64 * 1024
+    assert not (tmp_path / "project00_requirements.txt").exists()
+    # databases and CSVs are deleted as soon as they have been used
+    assert _scratch_files(scratch) == []
+    assert scratch.report()["tmp"]["files"] == 6
+
+
+def test_incremental_run_skips_unchanged_projects(tmp_path, monkeypatch, s3, sns, scratch):
+    projects = _projects(3, 60)
+
+    def run(archive):
+        s3.meta.client.put("bucket", "raw_data/raw.zip", archive)
+        s3.meta.client.bytes_served = 0
+        return etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+    first = run(_make_archive(tmp_path / "a.zip", projects))
+    assert first["changed"] == ["PROJECT00", "PROJECT01", "PROJECT02"]
+    uploaded = dict(s3.meta.client.objects)
+
+    # the same archive again only reads the central directory
+    second = run(_make_archive(tmp_path / "b.zip", projects))
+    assert second["changed"] == [] and second["removed"] == []
+    assert second["unchanged"] == ["PROJECT00", "PROJECT01", "PROJECT02"]
+    assert s3.meta.client.bytes_served < 4096
+    assert s3.meta.client.objects == uploaded
+
+    # one project changes, one disappears
+    projects["project01"] = projects["project01"][:30]
+    del projects["project02"]
+    third = run(_make_archive(tmp_path / "c.zip", projects))
+    assert third["changed"] == ["PROJECT01"]
+    assert third["unchanged"] == ["PROJECT00"]
+    assert third["removed"] == ["PROJECT02"]
+    assert ("bucket", "prepped_data/project02.csv") not in s3.meta.client.objects
+
+    etl_lambda._notify_etl_completed("arn:topic", second["changed"], second["removed"])
+    etl_lambda._notify_etl_completed("arn:topic", third["changed"], third["removed"])
+    assert "MessageAttributes" not in sns.messages[0]
+    assert sns.messages[1]["MessageAttributes"]["event_type"]["StringValue"] == \
+        "ETL completed and prepped data uploaded to S3"
+    assert "PROJECT01" in sns.messages[1]["Message"]
+
+
+def test_pipeline_deduplicates_before_upload(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "DEDUP_MODE", "exact")
+    projects = {
+        "alpha": [("Bug", "disk full", "on node %d" % (i % 5)) for i in range(20)],
+        "beta": [("Bug", "disk full", "on node 1"), ("Bug", "heap", "exhausted")],
+    }
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", projects))
+
+    results = etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+    assert results["classes"] == {"ALPHA": 4, "BETA": 1}
+    assert results["dedup"]["ALPHA"]["exact"] == 15
+    assert results["dedup"]["ALPHA"]["cross_label"] == 1
+    assert s3.meta.client.get("bucket", "prepped_data/beta.csv") == b"BETA,heap exhausted\r\n"
+
+
+def test_warm_deduplicated_run_of_the_same_archive_decompresses_nothing(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "DEDUP_MODE", "near")
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(3, 60)))
+    first = etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+    objects = dict(s3.meta.client.objects)
+
+    monkeypatch.setattr(etl_lambda, "_decompress_project", lambda *args: pytest.fail("decompressed again"))
+    results = etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+    assert results["changed"] == [] and results["unchanged"] == ["PROJECT00", "PROJECT01", "PROJECT02"]
+    assert (results["classes"], results["dedup"], results["stats"]) == (first["classes"], first["dedup"],
+                                                                       first["stats"])
+    assert s3.meta.client.objects == objects
+
+
+def test_pipeline_samples_with_caps_and_floor(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "SAMPLE_CAP", 30)
+    monkeypatch.setattr(etl_lambda, "SAMPLE_CLASS_CAPS", {"PROJECT01": 10})
+    monkeypatch.setattr(etl_lambda, "SAMPLE_FLOOR", 5)
+    projects = _projects(2, 150)
+    projects["tiny"] = [("Bug", "one", "bug")]
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", projects))
+
+    results = etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+    assert results["classes"] == {"PROJECT00": 30, "PROJECT01": 10}
+    assert results["distribution"]["classes"]["TINY"] == {"source_rows": 1, "rows": 0, "excluded": True, "share": 0.0}
+    assert results["distribution"]["classes"]["PROJECT00"]["source_rows"] == 100
+    assert ("bucket", "prepped_data/tiny.csv") not in s3.meta.client.objects
+    first = s3.meta.client.get("bucket", "prepped_data/project00.csv")
+
+    # the same seed gives the same sample
+    s3.meta.client.delete_object(Bucket="bucket", Key="etl_state/manifest.json")
+    etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+    assert s3.meta.client.get("bucket", "prepped_data/project00.csv") == first
+
+
+def test_sharded_output_streams_interleaved_rows(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "OUTPUT_MODE", "shards")
+    monkeypatch.setattr(etl_lambda, "SHARD_BYTES", 2000)
+    projects = _projects(3, 90)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", projects))
+    # a per class CSV of an earlier run in the other output mode
+    s3.meta.client.put("bucket", "prepped_data/project00.csv", b"old")
+    s3.meta.client.put("bucket", "etl_state/manifest.json", b'{"outputs": ["prepped_data/project00.csv"]}')
+
+    results = etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch)
+
+    keys = sorted(key for _, key in s3.meta.client.objects if key.startswith("prepped_data/"))
+    assert len(keys) > 3 and all(key.startswith("prepped_data/part-") for key in keys)
+    assert results["classes"] == {"PROJECT00": 60, "PROJECT01": 60, "PROJECT02": 60}
+    first_shard = s3.meta.client.get("bucket", keys[0]).decode()
+    assert len({line.split(",")[0] for line in first_shard.splitlines()}) > 1
+    assert _scratch_files(scratch) == []
+
+    # nothing is rewritten for the same archive
+    assert etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch)["changed"] == []
+
+
+def test_failed_sharded_run_keeps_the_previous_training_data(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "OUTPUT_MODE", "shards")
+    monkeypatch.setattr(etl_lambda, "SHARD_BYTES", 2000)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(3, 90)))
+    etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch)
+    previous = {key: body for (_, key), body in s3.meta.client.objects.items() if key.startswith("prepped_data/")}
+
+    # a new archive fails while its shards are streamed
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "new.zip", _projects(4, 90)))
+    interleave = etl_lambda.etl_output.interleave
+
+    def failing(sources, rng):
+        for i, row in enumerate(interleave(sources, rng)):
+            if i == 150:
+                raise OSError("connection reset")
+            yield row
+
+    monkeypatch.setattr(etl_lambda.etl_output, "interleave", failing)
+    with pytest.raises(OSError):
+        etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch)
+
+    assert {key: body for (_, key), body in s3.meta.client.objects.items()
+            if key.startswith("prepped_data/")} == previous
+    assert not s3.meta.client.uploads
+
+
+def test_pipeline_extracts_derived_data_sets(tmp_path, monkeypatch, s3, scratch):
+    spec = etl_lambda.etl_query.load_spec('{"derived": [{"name": "task", "issue_types": ["Task"]}]}')
+    monkeypatch.setattr(etl_lambda, "QUERY_SPEC", spec)
+    monkeypatch.setattr(etl_lambda, "QUERY", etl_lambda.etl_query.CompiledQuery(spec))
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(2, 30)))
+
+    results = etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch)
+
+    assert results["classes"] == {"PROJECT00": 20, "PROJECT01": 20}
+    tasks = s3.meta.client.get("bucket", "derived_data/task/project01.csv").decode().splitlines()
+    assert len(tasks) == 10 and all(line.startswith("PROJECT01,crash ") for line in tasks)
+
+
+def test_decompress_project_moves_to_next_tier_when_full(tmp_path, monkeypatch, s3, scratch):
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(1, 50)))
+    stream_member = etl_lambda._stream_member
+
+    def fill_tmp(zip_ref, member, destination):
+        if destination.startswith(str(tmp_path / "tmp")):
+            with open(destination, "wb") as f:
+                f.write(b"partial")
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return stream_member(zip_ref, member, destination)
+
+    monkeypatch.setattr(etl_lambda, "_stream_member", fill_tmp)
+    size, members, _ = etl_lambda._list_projects("bucket", "raw_data/raw.zip")
+    db_path, stats = etl_lambda._decompress_project("bucket", "raw_data/raw.zip", size, "project00.sqlite3.bz2",
+                                                    members["project00.sqlite3.bz2"][0], scratch, 0)
+
+    assert stats["scratch_tier"] == "efs"
+    assert db_path == str(tmp_path / "efs" / "etl-run-test" / "project00.sqlite3")
+    assert _scratch_files(scratch) == ["project00.sqlite3"]
+
+
+def test_handler_emits_stage_metrics(tmp_path, monkeypatch, capsys, s3, sns):
+    monkeypatch.setattr(etl_lambda, "SCRATCH_TIERS", [("tmp", str(tmp_path / "tmp"), False)])
+    monkeypatch.setattr(etl_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(2, 30)))
+    event = {"Records": [{"s3": {"bucket": {"name": "bucket"}, "object": {"key": "raw_data/raw.zip"}}}]}
+    # drop the values recorded by earlier tests
+    etl_lambda.metrics.flush()
+    capsys.readouterr()
+
+    etl_lambda.lambda_handler(event, None)
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines() if '"_aws"' in line]
+    stages = {(r.get("Stage"), r.get("Class")): r for r in records}
+    assert stages[("extract", "PROJECT01")]["Rows"] == 20
+    assert stages[("decompress", "PROJECT00")]["BytesWritten"] > 0
+    assert stages[("download", "PROJECT00")]["BytesRead"] > 0
+    assert stages[("upload", None)]["Files"] == 2
+    assert stages[("handler", None)]["ChangedClasses"] == 2
+
+
+class _Context:
+
+    def __init__(self, remaining):
+        self.invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:function:etl"
+        self.get_remaining_time_in_millis = remaining
+
+
+def test_handler_suspends_and_resumes_from_checkpoint(tmp_path, monkeypatch, s3, sns):
+    monkeypatch.setattr(etl_lambda, "SCRATCH_TIERS", [("tmp", str(tmp_path / "tmp"), False)])
+    monkeypatch.setattr(etl_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    monkeypatch.setattr(etl_lambda, "DECOMPRESS_WORKERS", 1)
+    monkeypatch.setattr(etl_lambda, "lambda_client", FakeLambdaClient())
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(5, 30)))
+    event = {"Records": [{"s3": {"bucket": {"name": "bucket"},
+                                 "object": {"key": "raw_data/raw.zip", "eTag": "abc"}}}]}
+    decompressed = []
+    decompress_project = etl_lambda._decompress_project
+
+    def counting(*args):
+        decompressed.append(args[3])
+        return decompress_project(*args)
+
+    monkeypatch.setattr(etl_lambda, "_decompress_project", counting)
+
+    # the time runs out while the second project is decompressed
+    first = etl_lambda.lambda_handler(event, _Context(lambda: 120000 if len(decompressed) < 2 else 1000))
+
+    assert first["status"] == "IN_PROGRESS" and first["runs"][0]["remaining_projects"] == 4
+    assert etl_lambda.lambda_client.invocations == [{"FunctionName": _Context(None).invoked_function_arn,
+                                                     "InvocationType": "Event", "Payload": event}]
+    assert sns.messages == []
+    run = etl_lambda.etl_checkpoint.run_key("bucket", "raw_data/raw.zip", "abc")
+    checkpoint = json.loads(s3.meta.client.get("bucket", etl_lambda.etl_checkpoint.checkpoint_key(run)))
+    assert list(checkpoint["members"]) == ["project00.sqlite3.bz2"]
+    assert checkpoint["stages"]["project01.sqlite3.bz2"]["stage"] == "decompressed"
+
+    second = etl_lambda.lambda_handler(event, _Context(lambda: 120000))
+
+    assert second["status"] == "SUCCEEDED"
+    assert second["runs"][0]["changed_classes"] == ["PROJECT%02d" % p for p in range(5)]
+    assert sorted(decompressed) == ["project%02d.sqlite3.bz2" % p for p in range(5)]
+    assert len(sns.messages) == 1 and "PROJECT00" in sns.messages[0]["Message"]
+    assert not [key for _, key in s3.meta.client.objects if key.startswith("etl_state/checkpoints/")]
+    assert os.listdir(str(tmp_path / "tmp")) == []
+
+
+def test_resume_redoes_projects_whose_scratch_files_are_gone(tmp_path, monkeypatch, s3):
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(2, 30)))
+    checkpoint = etl_lambda.etl_checkpoint.Checkpoint(etl_lambda.etl_checkpoint.new_checkpoint("run", "config"))
+    expired = etl_lambda.etl_checkpoint.Deadline(_Context(lambda: 0), 1)
+    tiers = [("efs", str(tmp_path / "efs"), True)]
+
+    with etl_scratch.ScratchSpace(tiers, run_id="run") as scratch:
+        # decompressed in an earlier invocation, the extraction never started
+        size, members, _ = etl_lambda._list_projects("bucket", "raw_data/raw.zip")
+        for member_name in members:
+            db_path, stats = etl_lambda._decompress_project("bucket", "raw_data/raw.zip", size, member_name,
+                                                            members[member_name][0], scratch, 0)
+            checkpoint.stage(member_name, "decompressed", db_path=db_path,
+                             files={db_path: stats["decompressed_bytes"]})
+        os.remove(db_path)
+        assert etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch, checkpoint, expired)["suspended"]
+        scratch.keep()
+
+    # the remaining database is picked up, the missing one decompressed again
+    with etl_scratch.ScratchSpace(tiers, run_id="run") as scratch:
+        results = etl_lambda._run_pipeline("bucket", "raw_data/raw.zip", scratch, checkpoint)
+    assert results["classes"] == {"PROJECT00": 20, "PROJECT01": 20}
+    assert scratch.report()["efs"]["files"] == 3
+
+
+def _record(bucket, key, etag, sequencer):
+    return {"s3": {"bucket": {"name": bucket}, "object": {"key": key, "eTag": etag, "sequencer": sequencer}}}
+
+
+def test_handler_processes_every_record_once(tmp_path, monkeypatch, s3, sns):
+    monkeypatch.setattr(etl_lambda, "SCRATCH_TIERS", [("tmp", str(tmp_path / "tmp"), False)])
+    monkeypatch.setattr(etl_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    s3.meta.client.put("alpha", "raw_data/raw.zip", _make_archive(tmp_path / "a.zip", _projects(2, 30)))
+    s3.meta.client.put("beta", "raw_data/raw.zip", _make_archive(tmp_path / "b.zip", _projects(3, 30)))
+    event = {"Records": [
+        _record("alpha", "raw_data/raw.zip", "old", "0055AED6DCD90281E4"),
+        _record("beta", "raw_data/raw.zip", "b", "0055AED6DCD90281E5"),
+        # a later upload of the same key supersedes the first record
+        _record("alpha", "raw_data/raw.zip", "new", "0055AED6DCD90281E6"),
+    ]}
+
+    response = etl_lambda.lambda_handler(event, None)
+
+    runs = {run["bucket"]: run for run in response["runs"]}
+    assert response["status"] == "SUCCEEDED" and len(runs) == 2
+    assert runs["alpha"]["changed_classes"] == ["PROJECT00", "PROJECT01"]
+    assert len(runs["beta"]["changed_classes"]) == 3
+    assert len(sns.messages) == 2
+
+    # S3 delivers the event again: nothing is read or published
+    s3.meta.client.get_requests = 0
+    again = etl_lambda.lambda_handler(event, None)
+    assert [run["status"] for run in again["runs"]] == ["DUPLICATE", "DUPLICATE"]
+    assert s3.meta.client.get_requests == 0 and len(sns.messages) == 2
+
+
+def test_handler_skips_run_locked_by_another_container(tmp_path, monkeypatch, s3, sns):
+    monkeypatch.setattr(etl_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    record = _record("bucket", "raw_data/raw.zip", "e", "01")
+    marker = etl_lambda.etl_marker.RunMarker(str(tmp_path / "markers"), "s3://bucket/raw_data/raw.zip#e#01")
+    os.makedirs(marker.directory)
+    # POSIX locks are per process, the other container is a child process
+    holder = subprocess.Popen([sys.executable, "-c", "import fcntl, sys, time\n"
+                               "f = open(sys.argv[1], 'w'); fcntl.lockf(f, fcntl.LOCK_EX)\n"
+                               "print('locked', flush=True); time.sleep(30)", marker.lock_path],
+                              stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline() == b"locked\n"
+        response = etl_lambda.lambda_handler({"Records": [record]}, None)
+    finally:
+        holder.kill()
+        holder.wait()
+
+    assert response["runs"][0]["status"] == "DUPLICATE"
+    assert sns.messages == [] and s3.meta.client.get_requests == 0
+
+
+def test_handler_waits_for_the_run_of_another_archive_of_the_bucket(tmp_path, monkeypatch, s3, sns):
+    monkeypatch.setattr(etl_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    monkeypatch.setattr(etl_lambda, "lambda_client", FakeLambdaClient())
+    record = _record("bucket", "raw_data/other.zip", "e", "02")
+    lock = etl_lambda.etl_marker.RunMarker(str(tmp_path / "markers"), "s3://bucket")
+    os.makedirs(lock.directory)
+    holder = subprocess.Popen([sys.executable, "-c", "import fcntl, sys, time\n"
+                               "f = open(sys.argv[1], 'w'); fcntl.lockf(f, fcntl.LOCK_EX)\n"
+                               "print('locked', flush=True); time.sleep(30)", lock.lock_path],
+                              stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline() == b"locked\n"
+        # the deadline has passed, the run continues in a new invocation
+        response = etl_lambda.lambda_handler({"Records": [record]}, _Context(lambda: 1000))
+    finally:
+        holder.kill()
+        holder.wait()
+
+    assert response["status"] == "IN_PROGRESS" and response["runs"][0]["status"] == "IN_PROGRESS"
+    assert etl_lambda.lambda_client.invocations[0]["Payload"] == {"Records": [record]}
+    assert sns.messages == [] and s3.meta.client.get_requests == 0
+
+
+def test_waiting_for_the_bucket_counts_as_an_invocation(tmp_path, monkeypatch, s3, sns):
+    monkeypatch.setattr(etl_lambda, "MARKER_DIR", str(tmp_path / "markers"))
+    monkeypatch.setattr(etl_lambda, "MAX_INVOCATIONS", 2)
+    monkeypatch.setattr(etl_lambda, "lambda_client", FakeLambdaClient())
+    record = _record("bucket", "raw_data/other.zip", "e", "02")
+    lock = etl_lambda.etl_marker.bucket_lock(str(tmp_path / "markers"), "bucket")
+    os.makedirs(lock.directory)
+    holder = subprocess.Popen([sys.executable, "-c", "import fcntl, sys, time\n"
+                               "f = open(sys.argv[1], 'w'); fcntl.lockf(f, fcntl.LOCK_EX)\n"
+                               "print('locked', flush=True); time.sleep(30)", lock.lock_path],
+                              stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline() == b"locked\n"
+        for _ in range(2):
+            response = etl_lambda.lambda_handler({"Records": [record]}, _Context(lambda: 1000))
+            assert response["runs"][0]["status"] == "IN_PROGRESS"
+        # the run gives up instead of continuing for ever
+        with pytest.raises(RuntimeError):
+            etl_lambda.lambda_handler({"Records": [record]}, _Context(lambda: 1000))
+    finally:
+        holder.kill()
+        holder.wait()
+
+    assert len(etl_lambda.lambda_client.invocations) == 2 and sns.messages == []
+
+
+class _ShardDeadline:
+
+    # expires once the stream finished the given number of shards
+    def __init__(self, s3, shards):
+        self.s3 = s3
+        self.shards = shards
+
+    def expired(self):
+        return len([key for _, key in self.s3.meta.client.objects if key.startswith("prepped_data/part-")]) \
+            >= self.shards
+
+
+def test_sharded_stream_suspends_and_resumes(tmp_path, monkeypatch, s3):
+    monkeypatch.setattr(etl_lambda, "OUTPUT_MODE", "shards")
+    monkeypatch.setattr(etl_lambda, "SHARD_BYTES", 2000)
+    monkeypatch.setattr(etl_lambda, "DEDUP_MODE", "exact")
+    projects = _projects(3, 90)
+    projects["project01"] += projects["project00"][:20]
+    archive = _make_archive(tmp_path / "raw_data.zip", projects)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", archive)
+    tiers = [("tmp", str(tmp_path / "tmp"), False)]
+    with etl_scratch.ScratchSpace(tiers, run_id="single") as scratch:
+        expected = etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch)
+    shards = {key: body for (_, key), body in s3.meta.client.objects.items() if key.startswith("prepped_data/")}
+    s3.meta.client.objects.clear()
+    s3.meta.client.put("bucket", "raw_data/raw.zip", archive)
+
+    checkpoint = etl_lambda.etl_checkpoint.Checkpoint(etl_lambda.etl_checkpoint.new_checkpoint("run", "config"))
+    with etl_scratch.ScratchSpace(tiers, run_id="run") as scratch:
+        first = etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch, checkpoint, _ShardDeadline(s3, 2))
+        scratch.keep()
+    assert first["suspended"] and len(checkpoint.state["stream"]["shards"]) == 2
+    written = {key: s3.meta.client.get("bucket", key) for key in shards if key.endswith(("00000.csv", "00001.csv"))}
+    assert not s3.meta.client.uploads
+
+    # the databases are reused, the finished shards are not written again
+    put_object = s3.meta.client.put_object
+    put_keys = []
+
+    def recording(**kwargs):
+        put_keys.append(kwargs["Key"])
+        return put_object(**kwargs)
+
+    monkeypatch.setattr(s3.meta.client, "put_object", recording)
+    monkeypatch.setattr(etl_lambda, "_decompress_project", lambda *args: pytest.fail("decompressed again"))
+    with etl_scratch.ScratchSpace(tiers, run_id="run") as scratch:
+        second = etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch, checkpoint)
+
+    assert not second["suspended"] and not set(put_keys) & set(written)
+    assert all(s3.meta.client.get("bucket", key) == body for key, body in written.items())
+    assert (second["classes"], second["dedup"], second["stats"]) == \
+        (expected["classes"], expected["dedup"], expected["stats"])
+    assert {key: body for (_, key), body in s3.meta.client.objects.items()
+            if key.startswith("prepped_data/")} == shards
+    assert os.listdir(str(tmp_path / "tmp")) == []
+
+
+@pytest.mark.parametrize("output", ["per_class", "shards"])
+def test_memory_budget_keeps_the_training_data(tmp_path, monkeypatch, s3, scratch, output):
+    monkeypatch.setattr(etl_lambda, "OUTPUT_MODE", output)
+    monkeypatch.setattr(etl_lambda, "DEDUP_MODE", "near")
+    monkeypatch.setattr(etl_lambda, "SAMPLE_CAP", 40)
+    projects = _projects(3, 90)
+    projects["project01"] += projects["project00"][:20]
+    archive = _make_archive(tmp_path / "raw_data.zip", projects)
+
+    outputs = {}
+    for budget in (0, 512):
+        monkeypatch.setattr(etl_lambda, "MEMORY_BUDGET_MB", budget)
+        monkeypatch.setattr(etl_lambda, "SQLITE_CACHE_KB", 1024 if budget else 0)
+        s3.meta.client.objects.clear()
+        s3.meta.client.put("bucket", "raw_data/raw.zip", archive)
+        run = etl_lambda._run_pipeline if output == "per_class" else etl_lambda._run_sharded
+        results = run("bucket", "raw_data/raw.zip", scratch)
+        outputs[budget] = (results["classes"], results["dedup"],
+                           {key: body for (_, key), body in s3.meta.client.objects.items()
+                            if key.startswith("prepped_data/")})
+
+    assert outputs[0] == outputs[512]
+    assert sum(c["cross_label"] for c in outputs[512][1].values()) > 0
+    assert _scratch_files(scratch) == []
+
+
+@pytest.mark.parametrize("output", ["per_class", "shards"])
+def test_memory_budget_samples_without_the_dropped_labels(tmp_path, monkeypatch, s3, scratch, output):
+    # Tasks match the predicate but their label is mapped to null, the
+    # sample positions are drawn from the rows that are left
+    spec = etl_query.load_spec(json.dumps({"issue_types": ["Bug", "Task"], "label": "issue_type",
+                                           "label_map": {"Task": None}}))
+    monkeypatch.setattr(etl_lambda, "QUERY_SPEC", spec)
+    monkeypatch.setattr(etl_lambda, "QUERY", etl_query.CompiledQuery(spec))
+    monkeypatch.setattr(etl_lambda, "PRIMARY_QUERY", etl_query.CompiledQuery(spec[:1]))
+    monkeypatch.setattr(etl_lambda, "OUTPUT_MODE", output)
+    monkeypatch.setattr(etl_lambda, "SAMPLE_CAP", 40)
+    archive = _make_archive(tmp_path / "raw_data.zip", _projects(3, 90))
+
+    outputs = {}
+    for budget in (0, 512):
+        monkeypatch.setattr(etl_lambda, "MEMORY_BUDGET_MB", budget)
+        s3.meta.client.objects.clear()
+        s3.meta.client.put("bucket", "raw_data/raw.zip", archive)
+        run = etl_lambda._run_pipeline if output == "per_class" else etl_lambda._run_sharded
+        results = run("bucket", "raw_data/raw.zip", scratch)
+        outputs[budget] = (results["classes"], results["distribution"],
+                           {key: body for (_, key), body in s3.meta.client.objects.items()
+                            if key.startswith("prepped_data/")})
+
+    assert outputs[0] == outputs[512]
+    assert outputs[512][0] == {"PROJECT%02d" % p: 40 for p in range(3)}
+    assert all(c["source_rows"] == 60 for c in outputs[512][1]["classes"].values())
+
+
+def test_memory_budget_bounds_peak_rss(tmp_path):
+    # a subprocess measures its own peak RSS, the S3 objects are kept on disk
+    from tests import synthetic_seoss
+    archive = tmp_path / "raw_data.zip"
+    synthetic_seoss.generate_archive(archive, projects=4, rows=3000, description_words=200, duplicate_rate=0.05)
+    env = dict(os.environ, AWS_DEFAULT_REGION="us-east-1", ETL_MEMORY_BUDGET_MB="160", ETL_OUTPUT="shards",
+               ETL_DEDUP="near", ETL_SAMPLE_CAP="1500")
+    output = subprocess.run(
+        [sys.executable, "-m", "tests.benchmark_etl", "--run-scenario", str(archive), "--work-dir",
+         str(tmp_path / "work")],
+        env=env, cwd=os.path.join(os.path.dirname(etl_lambda.__file__), ".."), check=True,
+        stdout=subprocess.PIPE).stdout
+    result = json.loads(output.decode("utf-8").splitlines()[-1])
+
+    assert 0 < result["runs"]["cold"]["rows"] <= 4 * 1500
+    assert result["memory_budget_mb"] == 160 and result["within_budget"]
+
+
+def test_sharded_output_caches_the_corpus(tmp_path, monkeypatch, s3, scratch):
+    monkeypatch.setattr(etl_lambda, "OUTPUT_MODE", "shards")
+    monkeypatch.setattr(etl_lambda, "CORPUS_CACHE", True)
+    monkeypatch.setattr(etl_lambda, "DECOMPRESS_WORKERS", 1)
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", _projects(3, 30)))
+
+    assert not etl_lambda._run_sharded("bucket", "raw_data/raw.zip", scratch)["suspended"]
+
+    index = json.loads(s3.meta.client.get("bucket", "etl_state/corpus.json"))
+    assert sorted(index["members"]) == ["project%02d.sqlite3.bz2" % p for p in range(3)]
+    assert all(("bucket", entry["key"]) in s3.meta.client.objects for entry in index["members"].values())
+    assert _scratch_files(scratch) == []
+
+
+@pytest.mark.parametrize("output", ["per_class", "shards"])
+def test_pipeline_writes_dataset_stats(tmp_path, monkeypatch, s3, sns, scratch, output):
+    monkeypatch.setattr(etl_lambda, "OUTPUT_MODE", output)
+    monkeypatch.setattr(etl_lambda, "DEDUP_MODE", "exact")
+    projects = {
+        "alpha": [("Bug", "disk full", "on node %d" % (i % 20)) for i in range(40)],
+        "beta": [("Bug", "heap exhausted", "")] + [("Bug", "leak %d" % i, "x" * 20000) for i in range(12)],
+        "gamma": [("Bug", "npe", "in %d" % i) for i in range(3)],
+    }
+    s3.meta.client.put("bucket", "raw_data/raw.zip", _make_archive(tmp_path / "raw_data.zip", projects))
+
+    run = etl_lambda._run_pipeline if output == "per_class" else etl_lambda._run_sharded
+    results = run("bucket", "raw_data/raw.zip", scratch)
+
+    stats = json.loads(s3.meta.client.get("bucket", "etl_state/dataset_stats.json"))
+    alpha, beta = stats["classes"]["ALPHA"], stats["classes"]["BETA"]
+    # the statistics describe the deduplicated training data
+    assert alpha["rows"] == 20 and alpha["duplicates"] == 0
+    assert beta["rows"] == 13 and beta["oversized"] == 12 and beta["empty"] == 0
+    assert stats["total"]["rows"] == 36
+    assert {"level": "error", "class": "GAMMA", "message": "3 documents, a class needs at least 10"} \
+        in stats["issues"]
+
+    etl_lambda._notify_etl_completed("arn:topic", results["changed"], results["removed"], results["stats"])
+    attribute = json.loads(sns.messages[0]["MessageAttributes"]["dataset_stats"]["StringValue"])
+    assert attribute["classes"]["BETA"]["oversized"] == 12
+    assert "36 documents in 3 classes" in sns.messages[0]["Message"]
@@ -0,0 +1,112 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import csv
+import io
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import etl_output
+from tests.stubs import FakeS3Client
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(4) as pool:
+        yield pool
+
+
+def test_multipart_writer_uploads_parts_in_parallel(executor):
+    client = FakeS3Client()
+    writer = etl_output.MultipartWriter(client, "bucket", "key", executor, part_size=0, max_in_flight=3)
+    writer.part_size = 1000  # below the S3 minimum to keep the test small
+    data = bytes(random.Random(1).getrandbits(8) for _ in range(10500))
+    for i in range(0, len(data), 500):
+        writer.write(data[i:i + 500])
+    result = writer.close()
+
+    assert client.get("bucket", "key") == data
+    assert client.parts_uploaded == 11
+    assert result["bytes"] == len(data)
+    assert not client.uploads
+
+
+def test_small_object_is_a_single_put(executor):
+    client = FakeS3Client()
+    writer = etl_output.MultipartWriter(client, "bucket", "key", executor)
+    writer.write(b"HADOOP,text\r\n")
+    writer.close()
+    assert client.get("bucket", "key") == b"HADOOP,text\r\n"
+    assert client.parts_uploaded == 0
+
+
+def test_sharded_writer_rolls_over_at_target_size(executor):
+    client = FakeS3Client()
+    writer = etl_output.ShardedCsvWriter(client, "bucket", "prepped_data/", executor, shard_bytes=100)
+    rows = [("HADOOP", "row, number %d" % i) for i in range(40)]
+    for row in rows:
+        writer.writerow(row)
+    shards = writer.close()
+
+    assert [s["key"] for s in shards][:2] == ["prepped_data/part-00000.csv", "prepped_data/part-00001.csv"]
+    assert all(s["bytes"] >= 100 for s in shards[:-1])
+    read = []
+    for shard in shards:
+        read += [tuple(r) for r in csv.reader(io.StringIO(client.get("bucket", shard["key"]).decode()))]
+    assert read == rows
+
+
+def test_abort_waits_for_the_parts_in_flight(executor):
+    class SlowClient(FakeS3Client):
+        def __init__(self):
+            super().__init__()
+            self.calls = []
+            self.release = threading.Event()
+
+        def upload_part(self, **kwargs):
+            self.release.wait(5)
+            response = super().upload_part(**kwargs)
+            self.calls.append("upload_part")
+            return response
+
+        def abort_multipart_upload(self, **kwargs):
+            self.calls.append("abort_multipart_upload")
+            return super().abort_multipart_upload(**kwargs)
+
+    client = SlowClient()
+    writer = etl_output.MultipartWriter(client, "bucket", "key", executor, max_in_flight=2)
+    writer.part_size = 100
+    writer.write(b"x" * 100)
+    writer.write(b"y" * 100)
+    threading.Timer(0.05, client.release.set).start()
+    writer.abort()
+
+    assert client.calls == ["upload_part", "upload_part", "abort_multipart_upload"]
+    assert not client.uploads and ("bucket", "key") not in client.objects
+
+
+def test_aborted_sharded_writer_deletes_its_shards(executor):
+    client = FakeS3Client()
+    client.put("bucket", "prepped_data/part-a-00000.csv", b"previous run")
+    writer = etl_output.ShardedCsvWriter(client, "bucket", "prepped_data/", executor, shard_bytes=100, name="b")
+    for i in range(20):
+        writer.writerow(("HADOOP", "row, number %d" % i))
+    assert writer.shards and writer.shards[0]["key"] == "prepped_data/part-b-00000.csv"
+    writer.abort()
+
+    assert sorted(key for _, key in client.objects) == ["prepped_data/part-a-00000.csv"]
+
+
+def test_interleave_mixes_sources_and_keeps_their_order():
+    a = [("A", i) for i in range(100)]
+    b = [("B", i) for i in range(50)]
+    merged = list(etl_output.interleave([(100, a), (50, b)], random.Random(3)))
+
+    assert sorted(merged) == sorted(a + b)
+    assert [r for r in merged if r[0] == "A"] == a
+    assert [r for r in merged if r[0] == "B"] == b
+    # the classes are spread over the whole output
+    assert 10 < sum(1 for r in merged[:75] if r[0] == "B") < 40
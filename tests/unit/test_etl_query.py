@@ -0,0 +1,99 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+import sqlite3
+
+import pytest
+
+import etl_query
+
+ORIGINAL_QUERY = ("SELECT (?) AS type, summary || ' ' || description FROM issue "
+                  "WHERE type = 'Bug' AND summary IS NOT NULL AND description IS NOT NULL")
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "hadoop.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE issue (type TEXT, summary TEXT, description TEXT, priority TEXT)")
+    conn.executemany("INSERT INTO issue VALUES (?, ?, ?, ?)", [
+        ("Bug", "crash", "on start", "Major"),
+        ("Bug", "leak", None, "Minor"),
+        ("Improvement", "faster", "startup", "Minor"),
+        ("Task", "release", "2.0", None),
+        ("Bug", "hang", "in rpc", "Critical"),
+    ])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def _rows(db_path, spec=None, fetch_size=2):
+    query = etl_query.CompiledQuery(etl_query.load_spec(json.dumps(spec) if spec else None))
+    conn = etl_query.open_readonly(db_path, mmap_size=1024 * 1024)
+    try:
+        return list(etl_query.iter_rows(conn, query, "HADOOP", fetch_size))
+    finally:
+        conn.close()
+
+
+def test_default_spec_matches_original_query(db_path):
+    conn = sqlite3.connect(db_path)
+    expected = conn.execute(ORIGINAL_QUERY, ("HADOOP",)).fetchall()
+    conn.close()
+    assert [(label, text) for _, label, text in _rows(db_path)] == expected
+
+
+def test_derived_data_sets_come_from_the_same_scan(db_path):
+    rows = _rows(db_path, {
+        "derived": [
+            {"name": "improvement", "issue_types": ["Improvement", "Task"], "require_all": False,
+             "label": "issue_type", "label_map": {"Task": None}},
+            {"name": "priority", "issue_types": [], "columns": ["summary"], "label": {"column": "priority"},
+             "filters": [{"column": "priority", "op": "in", "value": ["Major", "Critical"]}]},
+        ]})
+    assert rows == [
+        (0, "HADOOP", "crash on start"),
+        (2, "Major", "crash"),
+        (1, "Improvement", "faster startup"),
+        (0, "HADOOP", "hang in rpc"),
+        (2, "Critical", "hang"),
+    ]
+
+
+def test_count_matches_the_rows_of_a_data_set(db_path):
+    spec = {"issue_types": ["Bug", "Task", "Improvement"], "require_all": False, "label": "issue_type",
+            "label_map": {"Task": None, "Improvement": "Feature"}}
+    query = etl_query.CompiledQuery(etl_query.load_spec(json.dumps(spec)))
+    conn = etl_query.open_readonly(db_path)
+    try:
+        sql, params = query.count_sql(project="HADOOP")
+        assert conn.execute(sql, params).fetchone()[0] == len(list(etl_query.iter_rows(conn, query, "HADOOP"))) == 4
+    finally:
+        conn.close()
+
+    # a project mapped to null has no rows
+    query = etl_query.CompiledQuery(etl_query.load_spec(json.dumps({"label_map": {"HADOOP": None}})))
+    conn = etl_query.open_readonly(db_path)
+    try:
+        sql, params = query.count_sql(project="HADOOP")
+        assert conn.execute(sql, params).fetchone()[0] == len(list(etl_query.iter_rows(conn, query, "HADOOP"))) == 0
+    finally:
+        conn.close()
+
+
+def test_spec_rejects_unsafe_identifiers():
+    with pytest.raises(etl_query.QuerySpecError):
+        etl_query.load_spec(json.dumps({"columns": ["summary; DROP TABLE issue"]}))
+    with pytest.raises(etl_query.QuerySpecError):
+        etl_query.load_spec(json.dumps({"filters": [{"column": "priority", "op": "regexp", "value": "x"}]}))
+    with pytest.raises(etl_query.QuerySpecError):
+        etl_query.load_spec(json.dumps({"derived": [{"name": "bug"}]}))
+
+
+def test_connection_is_read_only(db_path):
+    conn = etl_query.open_readonly(db_path)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM issue")
+    conn.close()
@@ -0,0 +1,43 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import etl_sampling
+
+
+def test_reservoir_sample_is_deterministic_and_ordered():
+    first, seen = etl_sampling.reservoir_sample(iter(range(1000)), 50, etl_sampling.class_rng(7, "HADOOP"))
+    again, _ = etl_sampling.reservoir_sample(iter(range(1000)), 50, etl_sampling.class_rng(7, "HADOOP"))
+    other, _ = etl_sampling.reservoir_sample(iter(range(1000)), 50, etl_sampling.class_rng(8, "HADOOP"))
+
+    assert seen == 1000
+    assert first == again
+    assert first != other
+    assert first == sorted(first) and len(set(first)) == 50
+
+
+def test_reservoir_sample_keeps_short_inputs():
+    rows, seen = etl_sampling.reservoir_sample(["a", "b"], 10, etl_sampling.class_rng(0, "X"))
+    assert rows == ["a", "b"] and seen == 2
+
+
+def test_reservoir_sample_is_uniform():
+    hits = [0] * 10
+    for seed in range(2000):
+        rows, _ = etl_sampling.reservoir_sample(range(10), 3, etl_sampling.class_rng(seed, "X"))
+        for row in rows:
+            hits[row] += 1
+    # every row is expected 600 times
+    assert all(500 < h < 700 for h in hits)
+
+
+def test_class_caps():
+    caps = etl_sampling.parse_class_caps('{"hadoop": 10}')
+    assert etl_sampling.class_cap("HADOOP", 100, caps) == 10
+    assert etl_sampling.class_cap("SPARK", 100, caps) == 100
+
+
+def test_reservoir_positions_select_the_reservoir_sample():
+    for n, k in ((1000, 50), (30, 50), (50, 50)):
+        sample, _ = etl_sampling.reservoir_sample(iter(range(n)), k, etl_sampling.class_rng(7, "HADOOP"))
+        positions = etl_sampling.reservoir_positions(n, k, etl_sampling.class_rng(7, "HADOOP"))
+        assert list(etl_sampling.select_positions(iter(range(n)), positions)) == sample
@@ -0,0 +1,96 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import errno
+import os
+import time
+from collections import namedtuple
+
+import pytest
+
+import etl_scratch
+
+DiskUsage = namedtuple("DiskUsage", "total used free")
+
+
+def _tiers(tmp_path):
+    return [("tmp", str(tmp_path / "tmp"), False), ("efs", str(tmp_path / "efs"), True)]
+
+
+def test_allocate_falls_back_to_next_tier(tmp_path, monkeypatch):
+    free = {str(tmp_path / "tmp"): 1000, str(tmp_path / "efs"): 10 ** 9}
+    monkeypatch.setattr(etl_scratch.shutil, "disk_usage", lambda root: DiskUsage(0, 0, free[root]))
+
+    with etl_scratch.ScratchSpace(_tiers(tmp_path), run_id="a", reserve_bytes=100) as scratch:
+        small = scratch.allocate("small", 600)
+        # the first allocation is reserved, the second does not fit any more
+        large = scratch.allocate("large", 600)
+        assert (scratch.tier_of(small), scratch.tier_of(large)) == ("tmp", "efs")
+
+        scratch.release(small)
+        assert scratch.tier_of(scratch.allocate("again", 600)) == "tmp"
+        assert scratch.tier_of(scratch.allocate("skipped", 0, skip=["tmp"])) == "efs"
+        with pytest.raises(OSError) as e:
+            scratch.allocate("none", 0, skip=["tmp", "efs"])
+        assert e.value.errno == errno.ENOSPC
+
+
+def test_commit_counts_bytes_and_close_removes_files(tmp_path):
+    with etl_scratch.ScratchSpace(_tiers(tmp_path), run_id="b") as scratch:
+        path = scratch.allocate("data.csv", 10)
+        with open(path, "wb") as f:
+            f.write(b"x" * 42)
+        assert scratch.commit(path) == 42
+        assert scratch.report() == {"tmp": {"bytes_written": 42, "files": 1},
+                                    "efs": {"bytes_written": 0, "files": 0}}
+
+    assert os.listdir(str(tmp_path / "tmp")) == []
+
+
+def test_open_removes_leftovers_of_earlier_runs(tmp_path):
+    for tier in ("tmp", "efs"):
+        for run in ("old", "recent"):
+            (tmp_path / tier / ("etl-run-" + run)).mkdir(parents=True)
+    (tmp_path / "efs" / "model").mkdir()
+    stale = time.time() - 7200
+    os.utime(str(tmp_path / "efs" / "etl-run-old"), (stale, stale))
+
+    with etl_scratch.ScratchSpace(_tiers(tmp_path), run_id="c"):
+        # every leftover on the private tier goes, the shared tier keeps recent
+        # runs of other containers and anything else on the mount
+        assert sorted(os.listdir(str(tmp_path / "tmp"))) == ["etl-run-c"]
+        assert sorted(os.listdir(str(tmp_path / "efs"))) == ["etl-run-c", "etl-run-recent", "model"]
+
+
+def test_concurrent_runs_keep_each_others_directories(tmp_path):
+    tiers = [("tmp", str(tmp_path / "tmp"), False)]
+    with etl_scratch.ScratchSpace(tiers, run_id="first") as first:
+        path = first.allocate("data", 0)
+        open(path, "w").close()
+        with etl_scratch.ScratchSpace(tiers, run_id="second"):
+            assert os.path.exists(path)
+        first.keep()
+    assert os.path.exists(path)
+
+
+def test_kept_directory_is_removed_by_a_later_run(tmp_path):
+    tiers = [("tmp", str(tmp_path / "tmp"), False), ("efs", str(tmp_path / "efs"), True)]
+    with etl_scratch.ScratchSpace(tiers, run_id="suspended") as scratch:
+        path = scratch.allocate("data", 0)
+        open(path, "w").close()
+        scratch.keep()
+    # the continuation of the run in this container finds its files
+    with etl_scratch.ScratchSpace(tiers, run_id="suspended") as scratch:
+        assert scratch.adopt(path)
+        scratch.keep()
+    assert not etl_scratch._in_use
+
+    # the continuation went to another container, the next run cleans up the
+    # private tier and the shared one once the directory is stale
+    with etl_scratch.ScratchSpace(tiers, run_id="next"):
+        assert os.listdir(str(tmp_path / "tmp")) == ["etl-run-next"]
+        assert sorted(os.listdir(str(tmp_path / "efs"))) == ["etl-run-next", "etl-run-suspended"]
+    stale = time.time() - 7200
+    os.utime(str(tmp_path / "efs" / "etl-run-suspended"), (stale, stale))
+    with etl_scratch.ScratchSpace(tiers, run_id="later"):
+        assert os.listdir(str(tmp_path / "efs")) == ["etl-run-later"]
@@ -0,0 +1,52 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import etl_stats
+
+
+def test_text_stats_counts_and_histograms():
+    stats = etl_stats.TextStats(max_bytes=20)
+    for text in ["disk full", "disk full", "", None, "é" * 4, "x" * 30]:
+        stats.add(text)
+    s = stats.to_dict()
+
+    assert (s["rows"], s["empty"], s["duplicates"], s["oversized"]) == (6, 2, 1, 1)
+    assert s["chars"] == 9 + 9 + 4 + 30 and s["bytes"] == 9 + 9 + 8 + 30
+    assert s["chars_histogram"] == {"0": 2, "4": 1, "8": 2, "16": 1}
+    assert s["bytes_histogram"] == {"0": 2, "8": 3, "16": 1}
+    assert s["max_chars"] == 30 and s["mean_chars"] == 8.7
+
+    untracked = etl_stats.TextStats(track_duplicates=False)
+    untracked.add("a")
+    total = etl_stats.combine([s, untracked.to_dict()])
+    assert total["rows"] == 7 and total["duplicates"] is None
+    assert total["chars_histogram"] == {"0": 2, "1": 1, "4": 1, "8": 2, "16": 1}
+
+
+def _class(rows, empty=0, duplicates=0, oversized=0):
+    return {"rows": rows, "empty": empty, "duplicates": duplicates, "oversized": oversized}
+
+
+def test_check_reports_degenerate_training_data():
+    assert etl_stats.check({"A": _class(100), "B": _class(50)}) == []
+
+    issues = etl_stats.check({"A": _class(5)})
+    assert [(i["level"], i["class"]) for i in issues] == [("error", None), ("error", "A")]
+
+    issues = etl_stats.check({"A": _class(100, empty=100), "B": _class(100, duplicates=30, oversized=1),
+                              "C": _class(100000)})
+    assert [(i["level"], i["class"]) for i in issues] == \
+        [("error", "A"), ("warning", "B"), ("warning", None)]
+    assert issues[1]["message"] == "30 of 100 documents are duplicates"
+
+
+def test_dataset_stats_lists_excluded_and_unknown_classes():
+    members = {
+        "a.sqlite3.bz2": {"class_name": "A", "excluded": False, "stats": etl_stats.TextStats().to_dict()},
+        "b.sqlite3.bz2": {"class_name": "B", "excluded": True, "stats": None},
+        "c.sqlite3.bz2": {"class_name": "C", "excluded": False},
+    }
+    stats = etl_stats.dataset_stats("s3://bucket/raw.zip", members)
+    assert list(stats["classes"]) == ["A"]
+    assert stats["excluded"] == ["B"] and stats["unknown"] == ["C"]
+    assert etl_stats.summary(stats)["classes"]["A"]["rows"] == 0
@@ -0,0 +1,383 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import botocore.exceptions
+import pytest
+
+import invoke_comprehend_lambda
+import local_model
+import result_cache
+from tests.stubs import FakeS3
+
+ENDPOINT = "arn:aws:comprehend:us-east-1:123456789012:document-classifier-endpoint/tickets"
+
+
+class _Comprehend:
+    """Records the calls of the function, classify_document fails with the
+    next error in errors."""
+
+    def __init__(self, status="IN_SERVICE"):
+        self.status = status
+        self.model = "arn:aws:comprehend:us-east-1:123456789012:document-classifier/tickets/version/v1"
+        self.units = 100
+        self.calls = []
+        self.errors = []
+
+    def describe_endpoint(self, EndpointArn):
+        self.calls.append(("describe_endpoint", EndpointArn))
+        return {"EndpointProperties": {"EndpointArn": EndpointArn, "Status": self.status, "ModelArn": self.model,
+                                       "CurrentInferenceUnits": self.units}}
+
+    def classify_document(self, EndpointArn, Text):
+        self.calls.append(("classify_document", Text))
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"Classes": [{"Name": "HADOOP", "Score": 0.9}, {"Name": "HIVE", "Score": 0.1}]}
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def comprehend(monkeypatch):
+    fake = _Comprehend()
+    monkeypatch.setattr(invoke_comprehend_lambda, "comprehend", fake)
+    monkeypatch.setattr(invoke_comprehend_lambda, "_endpoint_status", {})
+    monkeypatch.setattr(invoke_comprehend_lambda, "_limiters", {})
+    monkeypatch.setattr(invoke_comprehend_lambda, "_local", None)
+    monkeypatch.delenv("BUCKET_NAME", raising=False)
+    monkeypatch.setattr(invoke_comprehend_lambda, "_results", result_cache.ResultCache(
+        result_cache.LruTtlCache(1024 * 1024, 3600), result_cache.LocalBackend()))
+    monkeypatch.setattr(invoke_comprehend_lambda, "_results_model", None)
+    monkeypatch.setenv("ENDPOINT_ARN", ENDPOINT)
+    return fake
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = _Clock()
+    monkeypatch.setattr(invoke_comprehend_lambda.time, "monotonic", fake.monotonic)
+    return fake
+
+
+def _names(calls):
+    return [name for name, _ in calls]
+
+
+def test_steady_state_requests_make_one_call(comprehend, clock):
+    for i in range(5):
+        response = invoke_comprehend_lambda.lambda_handler({"Text": "namenode crash %d" % i}, None)
+        assert response["body"][0]["Name"] == "HADOOP"
+        clock.now += 10
+
+    assert _names(comprehend.calls) == ["describe_endpoint"] + ["classify_document"] * 5
+
+
+def test_status_is_checked_again_after_the_ttl(comprehend, clock):
+    invoke_comprehend_lambda.lambda_handler({"Text": "a"}, None)
+    clock.now += invoke_comprehend_lambda.ENDPOINT_STATUS_TTL
+    invoke_comprehend_lambda.lambda_handler({"Text": "b"}, None)
+
+    assert _names(comprehend.calls) == ["describe_endpoint", "classify_document"] * 2
+
+
+def test_failed_classification_checks_the_status(comprehend, clock):
+    invoke_comprehend_lambda.lambda_handler({"Text": "a"}, None)
+    comprehend.calls.clear()
+
+    # the endpoint is being updated
+    comprehend.status = "UPDATING"
+    comprehend.errors.append(botocore.exceptions.ClientError(
+        {"Error": {"Code": "ResourceUnavailableException", "Message": "updating"}}, "ClassifyDocument"))
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "b"}, None)
+    assert "not created" in response["body"]
+    assert _names(comprehend.calls) == ["classify_document", "describe_endpoint"]
+
+    # requests wait for the TTL until they check the status again
+    comprehend.calls.clear()
+    invoke_comprehend_lambda.lambda_handler({"Text": "c"}, None)
+    assert comprehend.calls == []
+
+    # an endpoint in service re-raises the error
+    comprehend.status = "IN_SERVICE"
+    clock.now += invoke_comprehend_lambda.ENDPOINT_STATUS_TTL
+    comprehend.errors.append(botocore.exceptions.ClientError(
+        {"Error": {"Code": "InvalidRequestException", "Message": "bad text"}}, "ClassifyDocument"))
+    with pytest.raises(botocore.exceptions.ClientError):
+        invoke_comprehend_lambda.lambda_handler({"Text": "d"}, None)
+
+
+def test_identical_texts_are_classified_once(comprehend, clock):
+    first = invoke_comprehend_lambda.lambda_handler({"Text": "NameNode  crash\n"}, None)
+    again = invoke_comprehend_lambda.lambda_handler({"Text": "NameNode crash"}, None)
+
+    assert again == first
+    assert _names(comprehend.calls) == ["describe_endpoint", "classify_document"]
+    assert invoke_comprehend_lambda._results.stats == {"miss": 1, "local": 1}
+
+
+def test_new_model_invalidates_the_cache(comprehend, clock, monkeypatch):
+    invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+
+    # the endpoint is updated to a new model
+    comprehend.model = comprehend.model.replace("v1", "v2")
+    clock.now += invoke_comprehend_lambda.ENDPOINT_STATUS_TTL
+    invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+    # ENDPOINT_ARN points to another endpoint
+    monkeypatch.setenv("ENDPOINT_ARN", ENDPOINT + "-2")
+    invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+
+    assert _names(comprehend.calls) == ["describe_endpoint", "classify_document"] * 3
+
+
+def test_shared_tier_serves_other_containers(comprehend, clock):
+    invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+    # a cold container shares only the backend
+    results = invoke_comprehend_lambda._results
+    results.local.clear()
+    invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+    invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+
+    assert _names(comprehend.calls) == ["describe_endpoint", "classify_document"]
+    assert results.stats == {"miss": 1, "shared": 1, "local": 1}
+
+
+def test_batch_results_keep_the_input_order(comprehend, clock, monkeypatch):
+    class Scoring(_Comprehend):
+        def classify_document(self, EndpointArn, Text):
+            super().classify_document(EndpointArn, Text)
+            if Text == "bad":
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "InvalidRequestException", "Message": "bad text"}}, "ClassifyDocument")
+            return {"Classes": [{"Name": Text.upper(), "Score": 1.0}]}
+
+    scoring = Scoring()
+    monkeypatch.setattr(invoke_comprehend_lambda, "comprehend", scoring)
+    texts = ["hive %d" % i for i in range(20)] + ["bad", "hive  3", "spark"]
+
+    response = invoke_comprehend_lambda.lambda_handler({"Texts": texts}, None)
+
+    body = response["body"]
+    assert response["statusCode"] == 200 and len(body) == len(texts)
+    assert [item["Classes"][0]["Name"] for item in body[:20]] == ["HIVE %d" % i for i in range(20)]
+    assert body[20] == {"Error": {"Code": "InvalidRequestException", "Message": "bad text"}}
+    assert body[21] == body[3] and body[22]["Classes"][0]["Name"] == "SPARK"
+    # identical texts are classified once, the failure checks the endpoint status
+    assert _names(scoring.calls).count("classify_document") == 22
+    assert _names(scoring.calls).count("describe_endpoint") == 2
+
+
+def test_batch_concurrency_is_bounded(comprehend, clock, monkeypatch):
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    class Slow(_Comprehend):
+        def __init__(self):
+            super().__init__()
+            self.running = 0
+            self.peak = 0
+            self.lock = threading.Lock()
+
+        def classify_document(self, EndpointArn, Text):
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(0.01)
+            with self.lock:
+                self.running -= 1
+            return super().classify_document(EndpointArn, Text)
+
+    slow = Slow()
+    monkeypatch.setattr(invoke_comprehend_lambda, "comprehend", slow)
+    monkeypatch.setattr(invoke_comprehend_lambda, "_executor", ThreadPoolExecutor(3))
+
+    response = invoke_comprehend_lambda.lambda_handler({"Texts": ["t%d" % i for i in range(30)]}, None)
+
+    assert len(response["body"]) == 30 and slow.peak == 3
+
+
+def test_oversized_batch_is_rejected(comprehend, monkeypatch):
+    monkeypatch.setattr(invoke_comprehend_lambda, "MAX_BATCH_SIZE", 2)
+    assert invoke_comprehend_lambda.lambda_handler({"Texts": ["a", "b", "c"]}, None)["statusCode"] == 400
+    assert invoke_comprehend_lambda.lambda_handler({"Texts": "a"}, None)["statusCode"] == 400
+    assert comprehend.calls == []
+
+
+def test_long_text_is_classified_by_all_its_chunks(comprehend, monkeypatch):
+    monkeypatch.setattr(invoke_comprehend_lambda.text_normalization, "MAX_BYTES", 200)
+    text = " ".join("Line %d of a pasted log." % i for i in range(40))
+
+    response = invoke_comprehend_lambda.lambda_handler(
+        {"Text": text, "Policy": "all_chunks", "Aggregation": "mean"}, None)
+
+    chunks = [text for name, text in comprehend.calls if name == "classify_document"]
+    assert len(chunks) > 1 and all(len(chunk) <= 200 for chunk in chunks)
+    assert response["body"] == [{"Name": "HADOOP", "Score": pytest.approx(0.9)},
+                                {"Name": "HIVE", "Score": pytest.approx(0.1)}]
+
+
+def test_first_bytes_policy_sends_one_short_text(comprehend):
+    text = "disk full on the datanode. " * 100
+    invoke_comprehend_lambda.lambda_handler({"Text": text, "Policy": "first_bytes", "FirstBytes": 50}, None)
+
+    chunks = [text for name, text in comprehend.calls if name == "classify_document"]
+    assert len(chunks) == 1 and len(chunks[0]) <= 50
+
+
+@pytest.mark.parametrize("options", [{"Policy": "some"}, {"Aggregation": "median"}, {"FirstBytes": 0}])
+def test_invalid_long_text_options_are_rejected(comprehend, options):
+    response = invoke_comprehend_lambda.lambda_handler(dict(options, Text="a"), None)
+    assert response["statusCode"] == 400 and comprehend.calls == []
+
+
+def _throttling():
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "ClassifyDocument")
+
+
+def test_throttled_calls_are_retried_and_lower_the_rate(comprehend, clock, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(invoke_comprehend_lambda.time, "sleep", sleeps.append)
+    comprehend.errors = [_throttling(), _throttling()]
+
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+
+    assert response["body"][0]["Name"] == "HADOOP"
+    assert _names(comprehend.calls) == ["describe_endpoint"] + ["classify_document"] * 3
+    assert len(sleeps) == 2 and all(0 <= s <= 0.2 for s in sleeps)
+    limiter = invoke_comprehend_lambda._limiters[ENDPOINT]
+    assert limiter.max_rate == 100 * invoke_comprehend_lambda.RATE_LIMIT_CHARS_PER_UNIT
+    assert limiter.rate < limiter.max_rate
+
+
+def test_requests_beyond_the_limit_get_429(comprehend, clock, monkeypatch):
+    monkeypatch.setattr(invoke_comprehend_lambda.time, "sleep", lambda seconds: None)
+    comprehend.errors = [_throttling()] * (invoke_comprehend_lambda.THROTTLE_RETRIES + 1)
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "crash"}, None)
+    assert response["statusCode"] == 429 and "retry later" in response["body"]
+
+
+class _LimiterClock:
+    """The clock of the rate limiters, sleeping advances it."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def one_unit(comprehend, clock, monkeypatch):
+    # an endpoint of one inference unit, as the stack deploys it, with the
+    # default limits
+    comprehend.units = 1
+    limiter_clock = _LimiterClock()
+    monkeypatch.setattr(invoke_comprehend_lambda.rate_limiter.TokenBucket.__init__, "__defaults__",
+                        (1.0, 0.5, 0.05, 0.1, limiter_clock.monotonic, limiter_clock.sleep))
+    return limiter_clock
+
+
+def test_texts_at_one_inference_unit_wait_for_their_characters(comprehend, one_unit):
+    # 1800 characters take 18 seconds of one inference unit, the bucket holds
+    # a full text and the texts after it wait for their own characters only
+    statuses = [invoke_comprehend_lambda.lambda_handler({"Text": "%d %s" % (i, "x" * 1800)}, None)["statusCode"]
+                for i in range(8)]
+
+    assert statuses == [200] * 8
+    assert _names(comprehend.calls) == ["describe_endpoint"] + ["classify_document"] * 8
+    assert sum(one_unit.waits) == pytest.approx((8 * 1802 - 10000) / 100.0)
+    assert max(one_unit.waits) == pytest.approx(18.02)
+
+    # a text the empty bucket cannot serve within the maximum wait fails
+    # before it is sent
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "y" * 5000}, None)
+    assert response["statusCode"] == 429 and "retry later" in response["body"]
+    assert len(comprehend.calls) == 9
+
+
+def test_chunks_at_one_inference_unit_are_reserved_before_the_first_call(comprehend, one_unit):
+    text = " ".join("Line %d of a pasted log with a stack trace." % i for i in range(1000))
+
+    response = invoke_comprehend_lambda.lambda_handler({"Text": text, "Policy": "all_chunks"}, None)
+
+    # the text is cut to what one inference unit serves within the wait
+    chunks = [text for name, text in comprehend.calls if name == "classify_document"]
+    assert response["statusCode"] == 200 and len(chunks) == 2
+    assert sum(len(chunk) for chunk in chunks) <= 12000
+    assert len(one_unit.waits) == 1 and one_unit.waits[0] <= invoke_comprehend_lambda.RATE_LIMIT_MAX_WAIT
+
+    # the next long text would wait too long and fails before any call
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "Again. " + text, "Policy": "all_chunks"}, None)
+    assert response["statusCode"] == 429
+    assert len([name for name, _ in comprehend.calls if name == "classify_document"]) == 2
+
+
+def test_local_model_answers_while_the_endpoint_is_not_in_service(comprehend, clock, monkeypatch):
+    comprehend.status = "CREATING"
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "namenode crash"}, None)
+    assert "not created" in response["body"]
+
+    # a local model was trained
+    rows = [("HADOOP", "namenode block lost %d" % i) for i in range(10)] + \
+           [("HIVE", "metastore query fails %d" % i) for i in range(10)]
+    s3 = FakeS3()
+    s3.meta.client.put("bucket", local_model.MODEL_KEY, local_model.train(lambda: iter(rows)).to_bytes())
+    monkeypatch.setattr(invoke_comprehend_lambda, "s3", s3)
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    clock.now += invoke_comprehend_lambda.LOCAL_MODEL_TTL
+
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "NameNode  crash, block lost"}, None)
+    assert response["statusCode"] == 200 and response["body"][0]["Name"] == "HADOOP"
+    batch = invoke_comprehend_lambda.lambda_handler({"Texts": ["metastore query", "namenode"]}, None)
+    assert [item["Classes"][0]["Name"] for item in batch["body"]] == ["HIVE", "HADOOP"]
+    assert "classify_document" not in _names(comprehend.calls)
+
+
+@pytest.fixture
+def local(monkeypatch):
+    rows = [("HADOOP", "namenode block lost %d" % i) for i in range(10)] + \
+           [("HIVE", "metastore query fails %d" % i) for i in range(10)]
+    model = local_model.train(lambda: iter(rows))
+    model.metadata["thresholds"] = {"HADOOP": 0.8, "HIVE": None}
+    s3 = FakeS3()
+    s3.meta.client.put("bucket", local_model.MODEL_KEY, model.to_bytes())
+    monkeypatch.setattr(invoke_comprehend_lambda, "s3", s3)
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    return model
+
+
+def test_cascade_answers_confident_texts_locally(comprehend, clock, local):
+    confident = invoke_comprehend_lambda.lambda_handler({"Text": "namenode block lost", "Cascade": True}, None)
+    assert confident["tier"] == "local" and confident["body"][0]["Name"] == "HADOOP"
+    assert "classify_document" not in _names(comprehend.calls)
+
+    # HIVE has no calibrated threshold, it is always escalated
+    escalated = invoke_comprehend_lambda.lambda_handler({"Text": "metastore query fails", "Cascade": True}, None)
+    assert escalated["tier"] == "endpoint"
+    assert _names(comprehend.calls).count("classify_document") == 1
+
+    batch = invoke_comprehend_lambda.lambda_handler(
+        {"Texts": ["namenode block lost", "metastore query"], "Cascade": True}, None)
+    assert [item["Tier"] for item in batch["body"]] == ["local", "endpoint"]
+
+    # without the cascade every text goes to the endpoint
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "namenode block lost"}, None)
+    assert response["tier"] == "endpoint"
+
+
+def test_cascade_option_is_validated(comprehend, clock):
+    response = invoke_comprehend_lambda.lambda_handler({"Text": "a", "Cascade": "yes"}, None)
+    assert response["statusCode"] == 400
@@ -0,0 +1,66 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import math
+import random
+
+import pytest
+
+import local_model
+
+WORDS = {
+    "HADOOP": ["namenode", "datanode", "hdfs", "block", "replication", "yarn"],
+    "HIVE": ["query", "metastore", "partition", "table", "hiveserver2", "join"],
+    "SPARK": ["executor", "rdd", "dataframe", "driver", "shuffle", "stage"],
+}
+COMMON = ["error", "fails", "after", "upgrade", "the", "when", "with", "exception"]
+
+
+def _rows(count=60, seed=7):
+    rng = random.Random(seed)
+    return [(label, " ".join(rng.choice(words if rng.random() < 0.4 else COMMON) for _ in range(30)))
+            for label, words in WORDS.items() for _ in range(count)]
+
+
+@pytest.fixture(scope="module")
+def model():
+    rows = _rows()
+    return local_model.train(lambda: iter(rows))
+
+
+def test_local_model_classifies_held_out_texts(model):
+    held_out = _rows(count=20, seed=8)
+    correct = sum(model.classify(text)[0]["Name"] == label for label, text in held_out)
+    assert correct >= 0.9 * len(held_out)
+
+    classes = model.classify("namenode lost a block after the upgrade")
+    assert [c["Name"] for c in classes][0] == "HADOOP"
+    assert sorted(c["Name"] for c in classes) == sorted(WORDS)
+    assert sum(c["Score"] for c in classes) == pytest.approx(1.0)
+    assert classes == sorted(classes, key=lambda c: -c["Score"])
+
+
+def test_local_model_round_trips_through_bytes(model):
+    loaded = local_model.LocalModel.from_bytes(model.to_bytes())
+    assert loaded.classes == model.classes and loaded.metadata["rows"] == 180
+    text = "hiveserver2 query on a partition fails"
+    assert loaded.classify(text) == model.classify(text)
+    # unknown words only leave the class priors
+    assert loaded.classify("zzz")[0]["Score"] == pytest.approx(1 / 3, abs=0.01)
+
+
+def test_scores_are_the_softmax_of_the_tfidf_dot_products(model):
+    idf = {key: model.idf[i] for i, key in enumerate(model.vocabulary)}
+    k = len(model.classes)
+    rows = {key: model.weights[i * k:(i + 1) * k] for i, key in enumerate(model.vocabulary)}
+    for text in ("hdfs hdfs block replication after the upgrade fails fails", "zzz", "", "yarn"):
+        logits = list(model.bias)
+        for key, value in local_model._tfidf(local_model.features(text), idf).items():
+            logits = [s + value * w for s, w in zip(logits, rows[key])]
+        exp = [math.exp(s - max(logits)) for s in logits]
+        assert model.scores(text) == pytest.approx([e / sum(exp) for e in exp], abs=1e-6)
+
+
+def test_local_model_needs_two_classes():
+    with pytest.raises(ValueError):
+        local_model.train(lambda: iter([("HIVE", "query")] * 5))
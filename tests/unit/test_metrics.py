@@ -0,0 +1,65 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import json
+
+import pytest
+
+import metrics
+
+
+def _emf(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_flush_writes_aggregated_emf_records():
+    stream = io.StringIO()
+    logger = metrics.MetricsLogger("etl", namespace="Test", stream=stream)
+    logger.put("Rows", 10, stage="extract", class_name="HADOOP")
+    logger.put("Rows", 5, stage="extract", class_name="HADOOP")
+    logger.put("BytesWritten", 100, "Bytes", stage="upload")
+    logger.put("PeakMemory", 300, "Megabytes", stage="upload")
+    logger.put("PeakMemory", 200, "Megabytes", stage="upload")
+    logger.flush()
+
+    extract, upload = _emf(stream)
+    assert extract["Function"] == "etl" and extract["Stage"] == "extract" and extract["Class"] == "HADOOP"
+    assert extract["Rows"] == 15
+    directive = extract["_aws"]["CloudWatchMetrics"][0]
+    assert directive["Namespace"] == "Test"
+    assert directive["Dimensions"] == [["Function", "Stage", "Class"], ["Function", "Stage"]]
+    assert directive["Metrics"] == [{"Name": "Rows", "Unit": "Count"}]
+    assert "Class" not in upload and upload["BytesWritten"] == 100 and upload["PeakMemory"] == 300
+    assert upload["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Function", "Stage"]]
+
+    # values are reset by a flush
+    logger.flush()
+    assert len(_emf(stream)) == 2
+
+
+def test_handler_times_invocation_and_flushes_on_error():
+    stream = io.StringIO()
+    logger = metrics.MetricsLogger("invoke", stream=stream)
+
+    @logger.handler
+    def handler(event, context):
+        with logger.timer("classify"):
+            pass
+        raise RuntimeError(event)
+
+    with pytest.raises(RuntimeError):
+        handler("boom", None)
+
+    records = {record["Stage"]: record for record in _emf(stream)}
+    assert records["handler"]["Errors"] == 1
+    assert records["handler"]["Duration"] >= records["classify"]["Duration"] >= 0
+    assert records["classify"]["PeakMemory"] > 0
+
+
+def test_disabled_logger_writes_nothing():
+    stream = io.StringIO()
+    logger = metrics.MetricsLogger(stream=stream, enabled=False)
+    logger.put("Rows", 1)
+    logger.flush()
+    assert stream.getvalue() == ""
@@ -0,0 +1,82 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+import rate_limiter
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 0.0
+        self.waits = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.waits.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return _Clock()
+
+
+def _bucket(clock, rate=100, burst=2):
+    return rate_limiter.TokenBucket(rate, burst, clock=clock.monotonic, sleep=clock.sleep)
+
+
+def test_bursts_queue_at_the_rate(clock):
+    bucket = _bucket(clock)
+    # the full bucket takes the burst, the rest waits its turn
+    bucket.acquire(100)
+    bucket.acquire(100)
+    assert clock.waits == []
+    bucket.acquire(100)
+    bucket.acquire(50)
+    assert clock.waits == [pytest.approx(1.0), pytest.approx(0.5)]
+
+
+def test_large_requests_wait_for_all_their_tokens(clock):
+    bucket = _bucket(clock)
+    # the 800 tokens beyond the full bucket accrue first
+    bucket.acquire(1000)
+    assert clock.waits == [pytest.approx(8.0)]
+    # the next request does not pay for them
+    bucket.acquire(100)
+    assert clock.waits == [pytest.approx(8.0), pytest.approx(1.0)]
+    with pytest.raises(rate_limiter.RateLimitExceeded):
+        bucket.acquire(1000, max_wait=5)
+
+
+def test_requests_do_not_wait_longer_than_max_wait(clock):
+    bucket = _bucket(clock)
+    bucket.acquire(200)
+    with pytest.raises(rate_limiter.RateLimitExceeded):
+        bucket.acquire(200, max_wait=1)
+    # the rejected request took nothing
+    assert bucket.acquire(100, max_wait=1) == pytest.approx(1.0)
+
+
+def test_rate_adapts_to_throttling(clock):
+    bucket = _bucket(clock)
+    bucket.throttled()
+    assert bucket.rate == 50 and bucket.capacity == 100
+    for _ in range(10):
+        bucket.throttled()
+    assert bucket.rate == 10
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 100
+    bucket.set_max_rate(300)
+    assert bucket.rate == bucket.max_rate == 300
+
+
+def test_backoff_is_jittered_and_capped():
+    assert rate_limiter.backoff(1, random=lambda: 1.0) == pytest.approx(0.1)
+    assert rate_limiter.backoff(4, random=lambda: 1.0) == pytest.approx(0.8)
+    assert rate_limiter.backoff(20, random=lambda: 1.0) == 5.0
+    assert rate_limiter.backoff(3, random=lambda: 0.5) == pytest.approx(0.2)
@@ -0,0 +1,58 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import result_cache
+
+
+class _Clock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_evicts_least_recently_used_entries_above_the_size_cap():
+    value = [{"Name": "HADOOP", "Score": 0.5}]
+    entry_bytes = 1 + len('[{"Name": "HADOOP", "Score": 0.5}]') + result_cache.ENTRY_OVERHEAD
+    cache = result_cache.LruTtlCache(3 * entry_bytes, 60)
+    for key in "abc":
+        cache.put(key, value)
+    assert cache.get("a") == value
+    cache.put("d", value)
+
+    assert len(cache) == 3 and cache.bytes == 3 * entry_bytes
+    assert cache.get("b") is None
+    assert all(cache.get(key) == value for key in "acd")
+
+
+def test_entries_expire_after_the_ttl():
+    clock = _Clock()
+    cache = result_cache.LruTtlCache(1024, 10, clock=clock)
+    cache.put("a", [1])
+    clock.now = 9.9
+    assert cache.get("a") == [1]
+    clock.now = 10
+    assert cache.get("a") is None and cache.bytes == 0
+
+    # too large for the cache
+    cache.put("b", "x" * 2000)
+    assert len(cache) == 0
+
+
+def test_result_cache_survives_a_failing_backend():
+    class Broken:
+        def get(self, key):
+            raise ConnectionError("down")
+
+        def put(self, key, value, ttl):
+            raise ConnectionError("down")
+
+    cache = result_cache.ResultCache(result_cache.LruTtlCache(1024, 10), Broken())
+    assert cache.get("a") == (None, None)
+    cache.put("a", [1])
+    assert cache.get("a") == ([1], "local")
+    assert result_cache.cache_key("e", "m1", "text") != result_cache.cache_key("e", "m2", "text")
+    assert isinstance(result_cache.load_backend("local"), result_cache.LocalBackend)
+    assert result_cache.load_backend("") is None
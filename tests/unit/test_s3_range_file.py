@@ -0,0 +1,61 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import os
+import random
+import zipfile
+
+from s3_range_file import S3RangeFile
+from tests.stubs import FakeS3Client
+
+
+def _client(data):
+    client = FakeS3Client()
+    client.put("bucket", "key", data)
+    return client
+
+
+def test_random_reads_match_object():
+    data = os.urandom(10000)
+    client = _client(data)
+    f = S3RangeFile(client, "bucket", "key", block_size=1024)
+    rng = random.Random(7)
+    for _ in range(200):
+        offset = rng.randrange(len(data) + 10)
+        length = rng.randrange(3000)
+        f.seek(offset)
+        assert f.read(length) == data[offset:offset + length]
+        assert f.tell() == max(offset, min(offset + length, len(data)))
+    f.seek(-5, io.SEEK_END)
+    assert f.read() == data[-5:]
+
+
+def test_read_ahead_stops_at_limit():
+    client = _client(b"x" * 100000)
+    f = S3RangeFile(client, "bucket", "key", size=100000, block_size=50000)
+    f.limit = 1000
+    f.seek(10)
+    assert f.read(4) == b"xxxx"
+    assert f.bytes_fetched == 990
+    assert f.requests == 1
+    # reads beyond the limit are still served, without read-ahead
+    f.seek(2000)
+    assert f.read(10) == b"x" * 10
+    assert f.bytes_fetched == 1000
+
+
+def test_zipfile_reads_member_in_place():
+    buffer = io.BytesIO()
+    big = os.urandom(200000)
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        zip_ref.writestr("big.bin", big)
+        zip_ref.writestr("small.txt", b"hello")
+    client = _client(buffer.getvalue())
+
+    f = S3RangeFile(client, "bucket", "key", block_size=4096)
+    with zipfile.ZipFile(f) as zip_ref:
+        assert zip_ref.read("small.txt") == b"hello"
+
+    assert f.bytes_fetched < 10000
+    assert client.bytes_served == f.bytes_fetched
@@ -0,0 +1,46 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+import text_chunks
+
+
+def test_split_packs_sentences_under_the_byte_limit():
+    text = " ".join("Sentence number %d is here." % i for i in range(50))
+    chunks = text_chunks.split(text, max_bytes=100)
+
+    assert len(chunks) > 1
+    assert all(len(chunk.encode("utf-8")) <= 100 for chunk in chunks)
+    # chunks end at sentence ends and together hold the whole text
+    assert all(chunk.endswith(".") for chunk in chunks)
+    assert " ".join(chunks) == text
+
+
+@pytest.mark.parametrize("text", ["word " * 100, "x" * 250, "é" * 120, "ab€" * 40])
+def test_split_cuts_sentences_longer_than_a_chunk(text):
+    chunks = text_chunks.split(text.strip(), max_bytes=50)
+    assert all(0 < len(chunk.encode("utf-8")) <= 50 for chunk in chunks)
+    assert "".join(chunks).replace(" ", "") == text.replace(" ", "")
+
+
+def test_split_keeps_short_text_whole():
+    assert text_chunks.split("one. two.", max_bytes=100) == ["one. two."]
+    assert text_chunks.split("", max_bytes=100) == []
+
+
+def test_aggregate():
+    results = [[{"Name": "HADOOP", "Score": 0.8}, {"Name": "HIVE", "Score": 0.2}],
+               [{"Name": "HIVE", "Score": 0.9}]]
+    sizes = [100, 300]
+
+    mean = text_chunks.aggregate(results, sizes, "mean")
+    assert [c["Name"] for c in mean] == ["HIVE", "HADOOP"]
+    assert mean[0]["Score"] == pytest.approx(0.55) and mean[1]["Score"] == pytest.approx(0.4)
+    assert text_chunks.aggregate(results, sizes, "max") == [{"Name": "HIVE", "Score": 0.9},
+                                                            {"Name": "HADOOP", "Score": 0.8}]
+    weighted = text_chunks.aggregate(results, sizes, "weighted")
+    assert weighted[0]["Score"] == pytest.approx((0.2 * 100 + 0.9 * 300) / 400)
+    assert weighted[1]["Score"] == pytest.approx(0.8 * 100 / 400)
+    with pytest.raises(ValueError):
+        text_chunks.aggregate(results, sizes, "median")
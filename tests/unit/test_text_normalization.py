@@ -0,0 +1,84 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import pytest
+
+import text_normalization
+
+TICKET = """NPE in the NameNode after restart
+
+See https://issues.apache.org/jira/browse/HDFS-1234?focusedCommentId=1 for details.
+{code}
+2013-04-02 10:11:12,345 ERROR namenode.NameNode: Exception in namenode join
+java.lang.NullPointerException
+	at org.apache.hadoop.hdfs.server.namenode.FSNamesystem.loadFSImage(FSNamesystem.java:512)
+	at org.apache.hadoop.hdfs.server.namenode.NameNode.initialize(NameNode.java:301)
+	... 12 more
+{code}
+=====================
+block blk_0x7f3a2b1c and txid 3f9a8b7c6d5e4f30a1b2 were lost
+"""
+
+
+def test_normalize_compresses_noise():
+    text = text_normalization.normalize(TICKET)
+    assert text == ("NPE in the NameNode after restart See issues.apache.org for details. "
+                    "ERROR namenode.NameNode: Exception in namenode join java.lang.NullPointerException "
+                    "org.apache.hadoop.hdfs.server.namenode.FSNamesystem.loadFSImage "
+                    "block blk_0x7f3a2b1c and txid were lost")
+    # plain text only has its whitespace folded
+    assert text_normalization.normalize("  disk\tfull \n on node 3 ") == "disk full on node 3"
+    assert text_normalization.normalize(text) == text
+
+
+def test_normalize_many_matches_normalize():
+    texts = [TICKET, "plain text", None, "", "x" * 20000, "ü" * 6000, "see http://a.b/c -- ok"]
+    assert text_normalization.normalize_many(texts) == [text_normalization.normalize(t) for t in texts]
+
+
+@pytest.mark.parametrize("text", ["a" * 10, "é" * 10, "€" * 10, "𝄞" * 10, "ab𝄞é€"])
+def test_truncate_utf8_keeps_whole_characters(text):
+    for max_bytes in range(len(text.encode("utf-8")) + 2):
+        truncated = text_normalization.truncate_utf8(text, max_bytes)
+        encoded = truncated.encode("utf-8")
+        assert len(encoded) <= max_bytes
+        assert text.startswith(truncated)
+        # no more than one character was cut short
+        assert max_bytes - len(encoded) < 4
+
+
+def test_normalize_truncates_to_the_byte_budget():
+    text = text_normalization.normalize("word " * 5000, max_bytes=100)
+    assert len(text.encode("utf-8")) <= 100 and text.endswith("word")
+    assert len(text_normalization.normalize("€" * 5000).encode("utf-8")) <= text_normalization.MAX_BYTES
+
+
+def test_disabled_normalization_only_truncates(monkeypatch):
+    monkeypatch.setattr(text_normalization, "ENABLED", False)
+    assert text_normalization.normalize(TICKET) == TICKET
+    assert text_normalization.normalize_many([TICKET, "a" * 20000]) == [TICKET, "a" * 10000]
+    assert text_normalization.config()["normalization"] is None
+
+
+class _Comprehend:
+
+    def __init__(self):
+        self.texts = []
+
+    def describe_endpoint(self, EndpointArn):
+        return {"EndpointProperties": {"Status": "IN_SERVICE"}}
+
+    def classify_document(self, EndpointArn, Text):
+        self.texts.append(Text)
+        return {"Classes": [{"Name": "HADOOP", "Score": 0.9}]}
+
+
+def test_inference_sends_the_text_the_etl_trains_on(monkeypatch):
+    import invoke_comprehend_lambda
+
+    comprehend = _Comprehend()
+    monkeypatch.setattr(invoke_comprehend_lambda, "comprehend", comprehend)
+    response = invoke_comprehend_lambda.lambda_handler({"Text": TICKET}, None)
+
+    assert response["body"] == [{"Name": "HADOOP", "Score": 0.9}]
+    assert comprehend.texts == text_normalization.normalize_many([TICKET])
@@ -0,0 +1,57 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import json
+
+import pytest
+
+import train_classifier_lambda
+from tests.stubs import FakeSNS
+
+
+class _Comprehend:
+
+    def __init__(self):
+        self.classifiers = []
+
+    def create_document_classifier(self, **kwargs):
+        self.classifiers.append(kwargs)
+        return {"DocumentClassifierArn": "arn:classifier/" + kwargs["DocumentClassifierName"]}
+
+
+@pytest.fixture
+def comprehend(monkeypatch):
+    fake = _Comprehend()
+    monkeypatch.setattr(train_classifier_lambda, "comprehend", fake)
+    monkeypatch.setattr(train_classifier_lambda, "sns", FakeSNS())
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    monkeypatch.setenv("TOPIC_ARN", "arn:topic")
+    return fake
+
+
+def _event(classes):
+    stats = {"classes": {name: {"rows": rows, "empty": 0, "duplicates": 0, "oversized": 0}
+                         for name, rows in classes.items()}}
+    return {"Records": [{"Sns": {"Message": "ETL completed",
+                                 "MessageAttributes": {"dataset_stats": {"Type": "String",
+                                                                         "Value": json.dumps(stats)}}}}]}
+
+
+def test_training_starts_on_sound_training_data(comprehend):
+    response = train_classifier_lambda.lambda_handler(_event({"HADOOP": 500, "HIVE": 300}), None)
+    assert response["status"] == "SUCCEEDED" and len(comprehend.classifiers) == 1
+
+
+def test_training_is_refused_on_degenerate_training_data(comprehend):
+    response = train_classifier_lambda.lambda_handler(_event({"HADOOP": 500, "HIVE": 3}), None)
+
+    assert response["status"] == "REFUSED" and comprehend.classifiers == []
+    assert [issue["class"] for issue in response["issues"]] == ["HIVE"]
+    message = train_classifier_lambda.sns.messages[-1]
+    assert "MessageAttributes" not in message and "HIVE: 3 documents" in message["Message"]
+
+
+def test_training_check_can_only_warn(comprehend, monkeypatch):
+    monkeypatch.setattr(train_classifier_lambda, "TRAINING_DATA_CHECK", "warn")
+    response = train_classifier_lambda.lambda_handler(_event({"HADOOP": 500}), None)
+    assert response["status"] == "SUCCEEDED" and len(comprehend.classifiers) == 1
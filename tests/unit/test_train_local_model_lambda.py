@@ -0,0 +1,52 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import csv
+import io
+import json
+
+import local_model
+import train_local_model_lambda
+from tests.stubs import FakeS3
+
+
+def _csv(rows):
+    out = io.StringIO()
+    csv.writer(out).writerows(rows)
+    return out.getvalue().encode("utf-8")
+
+
+def test_local_model_is_trained_from_the_training_data(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(train_local_model_lambda, "s3", s3)
+    monkeypatch.setattr(train_local_model_lambda, "MAX_ROWS_PER_CLASS", 15)
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    client = s3.meta.client
+    client.put("bucket", "etl_state/manifest.json",
+               json.dumps({"outputs": ["prepped_data/hadoop.csv", "prepped_data/hive.csv",
+                                       "derived_data/issue_type/improvement.csv"]}).encode("utf-8"))
+    client.put("bucket", "prepped_data/hadoop.csv", _csv([("HADOOP", "namenode block %d, lost" % i) for i in range(20)]))
+    client.put("bucket", "prepped_data/hive.csv", _csv([("HIVE", "metastore query %d" % i) for i in range(20)]))
+    client.put("bucket", "derived_data/issue_type/improvement.csv",
+               _csv([("Improvement", "speed up the namenode %d" % i) for i in range(20)]))
+
+    response = train_local_model_lambda.lambda_handler({"Records": []}, None)
+
+    # the derived datasets are not trained into the model
+    assert response["classes"] == ["HADOOP", "HIVE"]
+
+    # the held-out rows calibrate the cascade thresholds
+    assert response["status"] == "SUCCEEDED" and response["rows"] + response["held_out"] == 30
+    assert response["held_out"] > 0
+    model = local_model.LocalModel.from_bytes(client.get("bucket", local_model.MODEL_KEY))
+    assert sum(model.metadata["class_rows"].values()) == response["rows"]
+    assert model.metadata["thresholds"] == response["thresholds"]
+    report = json.loads(client.get("bucket", "local_model/calibration.json"))
+    assert report["held_out"] == response["held_out"] and len(report["thresholds"]) == 7
+    assert model.classify("namenode block")[0]["Name"] == "HADOOP"
+
+
+def test_nothing_is_trained_without_training_data(monkeypatch):
+    monkeypatch.setattr(train_local_model_lambda, "s3", FakeS3())
+    monkeypatch.setenv("BUCKET_NAME", "bucket")
+    assert train_local_model_lambda.lambda_handler({"Records": []}, None)["status"] == "SKIPPED"